@@ -4,9 +4,17 @@
 
 """This module provides function to process data and unify the data format."""
 
+import re
+import json
+import struct
+import zipfile
+import itertools
+from collections import namedtuple
+
 import numpy as np
 import pandas as pd
-from pymatgen import Structure
+from monty.json import MSONable
+from pymatgen import Structure, Lattice, Element
 
 
 def doc_from(structure, energy=None, force=None, stress=None):
@@ -62,45 +70,428 @@ def pool_from(structures, energies=None, forces=None, stresses=None):
     return datapool
 
 
-def convert_docs(docs, include_stress=False, **kwargs):
+def convert_docs(docs, include_stress=False, return_structures=True, **kwargs):
     """
     Method to convert a list of docs into objects, e.g.,
     Structure and DataFrame. 重新整理结构数据，返回pymatgen中的Structure对象和pandas的DataFrame对象
     Args:
         docs ([dict]): List of docs. Each doc should have the same
-            format as one returned from .dft.parse_dir.
+            format as one returned from .dft.parse_dir. A Dataset is
+            also accepted.
         include_stress (bool): Whether to include stress.
+        return_structures (bool): Whether to convert the structures in
+            docs into Structure objects. If False, the conversion is
+            skipped and None is returned in place of structures.
+            Default to True.
     Returns:
         A list of structures, and a DataFrame with energy and force
         data in 'y_orig' column, data type ('energy' or 'force') in
-        'dtype' column, No. of atoms in 'n' column sharing the same row
-        of energy data while 'n' being 1 for the rows of force data.
+        'dtype' column as categorical, No. of atoms in 'n' column sharing
+        the same row of energy data while 'n' being 1 for the rows of
+        force data.
     """
-    structures, y_orig, n, dtype = [], [], [], []
-    for d in docs:
-        if isinstance(d['structure'], dict):
-            structure = Structure.from_dict(d['structure'])
-        else:
+    if isinstance(docs, Dataset):
+        structures = docs.structures if return_structures else None
+        num_sites = num_atoms = docs.num_atoms
+        energies = docs.energies if docs.energies is not None else np.zeros(len(docs))
+        forces = docs.forces if docs.forces is not None else np.zeros((num_sites.sum(), 3))
+        stresses = docs.stresses if docs.stresses is not None else np.zeros((len(docs), 6))
+    else:
+        structures = [] if return_structures else None
+        num_sites, num_atoms, energies, forces, stresses = [], [], [], [], []
+        for d in docs:
             structure = d['structure']
-        outputs = d['outputs']
-        force_arr = np.array(outputs['forces'])
-        assert force_arr.shape == (len(structure), 3), \
-            'Wrong force array not matching structure'
-        force_arr = force_arr.ravel()                           # 将数组维度拉为一维数组
-
-        if include_stress:
-            stress_arr = np.array(outputs['virial_stress'])
-            y = np.concatenate(([outputs['energy']], force_arr, stress_arr))
-            n.append(np.insert(np.ones(len(y) - 1), 0, d['num_atoms']))
-            dtype.extend(['energy'] + ['force'] * len(force_arr) + ['stress'] * 6)
-        else:
-            y = np.concatenate(([outputs['energy']], force_arr))
-            n.append(np.insert(np.ones(len(y) - 1), 0, d['num_atoms']))
-            dtype.extend(['energy'] + ['force'] * len(force_arr))
-        y_orig.append(y)
-        structures.append(structure)
-    df = pd.DataFrame(dict(y_orig=np.concatenate(y_orig), n=np.concatenate(n),
-                           dtype=dtype))
+            if isinstance(structure, dict):
+                if return_structures:
+                    structure = Structure.from_dict(structure)
+                    num_sites.append(len(structure))
+                else:
+                    num_sites.append(len(structure['sites']))
+            else:
+                num_sites.append(len(structure))
+            outputs = d['outputs']
+            force_arr = np.asarray(outputs['forces'], dtype=float)
+            assert force_arr.shape == (num_sites[-1], 3), \
+                'Wrong force array not matching structure'
+            forces.append(force_arr)
+            energies.append(outputs['energy'])
+            num_atoms.append(d['num_atoms'])
+            if include_stress:
+                stresses.append(outputs['virial_stress'])
+            if return_structures:
+                structures.append(structure)
+        num_sites = np.array(num_sites, dtype=int)
+        forces = np.concatenate(forces + [np.zeros((0, 3))])
+
+    # rows of each structure: energy, forces and optionally stresses
+    n_rows = 1 + 3 * num_sites + (6 if include_stress else 0)
+    starts = np.cumsum(n_rows) - n_rows
+    y_orig = np.zeros(n_rows.sum())
+    n = np.ones(n_rows.sum())
+    codes = np.ones(n_rows.sum(), dtype=np.int8)
+    y_orig[starts] = energies
+    n[starts] = num_atoms
+    codes[starts] = 0
+    n_forces = 3 * num_sites
+    force_rows = np.repeat(starts + 1 - (np.cumsum(n_forces) - n_forces), n_forces) + \
+        np.arange(n_forces.sum())
+    y_orig[force_rows] = np.ravel(forces)
+    if include_stress:
+        stress_rows = (starts + 1 + n_forces)[:, None] + np.arange(6)
+        y_orig[stress_rows] = np.reshape(stresses, (-1, 6))
+        codes[stress_rows] = 2
+    dtype = pd.Categorical.from_codes(codes, categories=['energy', 'force', 'stress'])
+    df = pd.DataFrame(dict(y_orig=y_orig, n=n, dtype=dtype))
     for k, v in kwargs.items():
         df[k] = v
     return structures, df
+
+
+Frame = namedtuple('Frame', ['lattice', 'species', 'positions', 'energy',
+                             'forces', 'stress'])
+
+
+_DATASET_ARRAYS = ['lattices', 'species', 'positions', 'offsets', 'energies',
+                   'forces', 'stresses']
+
+
+class Dataset(MSONable):
+    """
+    Columnar container of structures and their properties, backed by flat
+    NumPy arrays instead of a list of docs. The atomic data of all
+    structures are concatenated and indexed by per-structure offsets, so
+    that the data of each structure is a view without copy.
+
+    """
+
+    def __init__(self, lattices, species, positions, offsets, energies=None,
+                 forces=None, stresses=None):
+        """
+
+        Args:
+            lattices (np.array): The (N, 3, 3) lattice matrices of N
+                structures.
+            species (np.array): The (M, ) atomic numbers of all M atoms
+                of the structures concatenated.
+            positions (np.array): The (M, 3) Cartesian coordinates of
+                all atoms.
+            offsets (np.array): The (N + 1, ) offsets of the atoms of
+                each structure, i.e., structure i holds atoms
+                offsets[i]:offsets[i + 1].
+            energies (np.array): The (N, ) total energies. Default to
+                None, i.e., zeros.
+            forces (np.array): The (M, 3) forces of all atoms. Default
+                to None, i.e., zeros.
+            stresses (np.array): The (N, 6) virial stresses. Default to
+                None, i.e., zeros.
+        """
+        self.lattices = np.asarray(lattices, dtype=float).reshape(-1, 3, 3)
+        self.species = np.asarray(species, dtype=int)
+        self.positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+        self.offsets = np.asarray(offsets, dtype=int)
+        n_structures, n_atoms = len(self.lattices), len(self.species)
+        self.energies = np.zeros(n_structures) if energies is None \
+            else np.asarray(energies, dtype=float)
+        self.forces = np.zeros((n_atoms, 3)) if forces is None \
+            else np.asarray(forces, dtype=float).reshape(-1, 3)
+        self.stresses = np.zeros((n_structures, 6)) if stresses is None \
+            else np.asarray(stresses, dtype=float).reshape(-1, 6)
+        if len(self.offsets) != n_structures + 1 or self.offsets[-1] != n_atoms \
+                or len(self.positions) != n_atoms or len(self.forces) != n_atoms \
+                or len(self.energies) != n_structures or len(self.stresses) != n_structures:
+            raise ValueError('Inconsistent array sizes of dataset')
+
+    @property
+    def num_atoms(self):
+        """
+        No. of atoms of each structure.
+        """
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.lattices)
+
+    def __getitem__(self, index):
+        """
+        Data of a structure as Frame of array views for an integer index,
+        or a Dataset for a slice, which shares memory if contiguous.
+        """
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return self.take(np.arange(start, stop, step))
+            stop = max(start, stop)
+            lo, hi = self.offsets[start], self.offsets[stop]
+            return Dataset(self.lattices[start:stop], self.species[lo:hi],
+                           self.positions[lo:hi], self.offsets[start:stop + 1] - lo,
+                           self.energies[start:stop], self.forces[lo:hi],
+                           self.stresses[start:stop])
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Dataset index out of range')
+        atoms = slice(self.offsets[index], self.offsets[index + 1])
+        return Frame(self.lattices[index], self.species[atoms],
+                     self.positions[atoms], self.energies[index],
+                     self.forces[atoms], self.stresses[index])
+
+    def take(self, indices):
+        """
+        Dataset of the structures with given indices, copying the data.
+
+        Args:
+            indices ([int]): Indices of structures.
+
+        Returns:
+            Dataset.
+        """
+        indices = np.asarray(indices, dtype=int)
+        num_atoms = self.num_atoms[indices]
+        atoms = np.repeat(self.offsets[indices] - np.cumsum(num_atoms) + num_atoms, num_atoms) \
+            + np.arange(num_atoms.sum())
+        return Dataset(self.lattices[indices], self.species[atoms],
+                       self.positions[atoms], np.concatenate([[0], np.cumsum(num_atoms)]),
+                       self.energies[indices], self.forces[atoms],
+                       self.stresses[indices])
+
+    def get_structure(self, index):
+        """
+        Pymatgen Structure of the structure with index.
+        """
+        frame = self[index]
+        return Structure(Lattice(frame.lattice), frame.species, frame.positions,
+                         coords_are_cartesian=True)
+
+    @property
+    def structures(self):
+        """
+        List of pymatgen Structure objects.
+        """
+        return [self.get_structure(i) for i in range(len(self))]
+
+    @classmethod
+    def from_structures(cls, structures, energies=None, forces=None, stresses=None):
+        """
+        Build dataset from structures and their properties, with the same
+        arguments as pool_from.
+
+        Args:
+            structures ([Structure]): The list of Pymatgen Structure object.
+            energies ([float]): The list of total energies of each structure
+                in structures list.
+            forces ([np.array]): List of (m, 3) forces array of each structure
+                with m atoms in structures list. m can be varied with each
+                single structure case.
+            stresses (list): List of (6, ) virial stresses of each
+                structure in structures list.
+
+        Returns:
+            Dataset.
+        """
+        num_atoms = [len(s) for s in structures]
+        return cls(lattices=[s.lattice.matrix for s in structures],
+                   species=np.concatenate([s.atomic_numbers for s in structures] + [[]]),
+                   positions=np.concatenate([s.cart_coords for s in structures] + [np.zeros((0, 3))]),
+                   offsets=np.concatenate([[0], np.cumsum(num_atoms, dtype=int)]),
+                   energies=energies,
+                   forces=np.concatenate([np.reshape(f, (-1, 3)) for f in forces] + [np.zeros((0, 3))])
+                   if forces is not None else None,
+                   stresses=stresses)
+
+    @classmethod
+    def from_frames(cls, frames):
+        """
+        Build dataset from Frames, e.g., parsed from configuration files.
+
+        Args:
+            frames ([Frame]): List of Frames.
+
+        Returns:
+            Dataset.
+        """
+        frames = list(frames)
+        num_atoms = [len(frame.species) for frame in frames]
+        return cls(lattices=[frame.lattice for frame in frames],
+                   species=np.concatenate([frame.species for frame in frames] + [[]]),
+                   positions=np.concatenate([frame.positions for frame in frames] + [np.zeros((0, 3))]),
+                   offsets=np.concatenate([[0], np.cumsum(num_atoms, dtype=int)]),
+                   energies=[frame.energy for frame in frames],
+                   forces=np.concatenate([frame.forces for frame in frames] + [np.zeros((0, 3))]),
+                   stresses=[frame.stress for frame in frames])
+
+    @classmethod
+    def from_docs(cls, docs):
+        """
+        Build dataset from docs, e.g., the datapool returned by pool_from,
+        with structures either as Structure or serialized dict, which is
+        parsed directly without creating Structure objects.
+
+        Args:
+            docs ([dict]): List of docs.
+
+        Returns:
+            Dataset.
+        """
+        lattices, species, positions, num_atoms = [], [], [], []
+        energies, forces, stresses = [], [], []
+        atomic_numbers = {}
+        for d in docs:
+            structure = d['structure']
+            if isinstance(structure, Structure):
+                lattices.append(structure.lattice.matrix)
+                species.append(structure.atomic_numbers)
+                positions.append(structure.cart_coords)
+            else:
+                matrix = np.array(structure['lattice']['matrix'], dtype=float)
+                sites = structure['sites']
+                symbols = [site['species'][0]['element'] for site in sites]
+                for symbol in set(symbols).difference(atomic_numbers):
+                    atomic_numbers[symbol] = Element(symbol).Z
+                lattices.append(matrix)
+                species.append([atomic_numbers[symbol] for symbol in symbols])
+                if all('xyz' in site for site in sites):
+                    positions.append(np.array([site['xyz'] for site in sites], dtype=float))
+                else:
+                    positions.append(np.dot([site['abc'] for site in sites], matrix))
+            num_atoms.append(len(species[-1]))
+            outputs = d['outputs']
+            energies.append(outputs['energy'])
+            forces.append(np.reshape(outputs['forces'], (-1, 3)))
+            stresses.append(outputs.get('virial_stress', np.zeros(6)))
+        return cls(lattices=lattices,
+                   species=np.concatenate(species + [[]]),
+                   positions=np.concatenate(positions + [np.zeros((0, 3))]),
+                   offsets=np.concatenate([[0], np.cumsum(num_atoms, dtype=int)]),
+                   energies=energies,
+                   forces=np.concatenate(forces + [np.zeros((0, 3))]),
+                   stresses=stresses)
+
+    def to_file(self, filename):
+        """
+        Save dataset into an uncompressed npz file, which can be
+        memory-mapped by from_file.
+
+        Args:
+            filename (str): The npz file to be written, the name is kept
+                as given, i.e., without the .npz suffix added.
+        """
+        with open(filename, 'wb') as f:
+            np.savez(f, **{name: getattr(self, name) for name in _DATASET_ARRAYS})
+
+    @classmethod
+    def from_file(cls, filename, mmap=True):
+        """
+        Load dataset from npz file written by to_file.
+
+        Args:
+            filename (str): The npz file to be read.
+            mmap (bool): Whether to memory-map the arrays instead of
+                reading them, so that only the data of the structures
+                accessed, e.g., by slicing, are read from disk.
+                Default to True.
+
+        Returns:
+            Dataset.
+        """
+        if not mmap:
+            with np.load(filename) as f:
+                return cls(**{name: f[name] for name in _DATASET_ARRAYS})
+        arrays = {}
+        with zipfile.ZipFile(filename) as z, open(filename, 'rb') as f:
+            for info in z.infolist():
+                if info.compress_type != zipfile.ZIP_STORED:
+                    raise ValueError('Compressed npz file can not be memory-mapped')
+                # the array is stored after the local file header of the member
+                f.seek(info.header_offset + 26)
+                name_length, extra_length = struct.unpack('<HH', f.read(4))
+                f.seek(name_length + extra_length, 1)
+                version = np.lib.format.read_magic(f)
+                read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) \
+                    else np.lib.format.read_array_header_2_0
+                shape, fortran_order, dtype = read_header(f)
+                name = info.filename[:-len('.npy')]
+                if np.prod(shape) == 0:
+                    arrays[name] = np.zeros(shape, dtype=dtype)
+                else:
+                    arrays[name] = np.memmap(filename, dtype=dtype, mode='r', offset=f.tell(),
+                                             shape=shape, order='F' if fortran_order else 'C')
+        return cls(**{name: arrays[name] for name in _DATASET_ARRAYS})
+
+    def to_docs(self):
+        """
+        Convert dataset into list of docs in the format of pool_from.
+
+        Returns:
+            ([dict])
+        """
+        docs = []
+        for i in range(len(self)):
+            frame = self[i]
+            outputs = dict(energy=float(frame.energy), forces=frame.forces.tolist(),
+                           virial_stress=frame.stress.tolist())
+            docs.append(dict(structure=self.get_structure(i).as_dict(),
+                             num_atoms=len(frame.species), outputs=outputs))
+        return docs
+
+
+_SEPARATORS = re.compile(r'[\s,]*')
+
+
+def iter_docs(filename, chunk_size=1 << 20):
+    """
+    Lazily read docs from a json file, either a single json array of
+    docs as data/*/training.json or json lines with one doc per line,
+    so that only one doc is held in memory at a time.
+
+    Args:
+        filename (str): The json file to be read.
+        chunk_size (int): No. of characters read from file at a time.
+
+    Yields:
+        (dict) The doc, with the structure kept as serialized dict.
+    """
+    decoder = json.JSONDecoder()
+    with open(filename) as f:
+        buf, pos, eof, in_array = '', 0, False, None
+        while True:
+            pos = _SEPARATORS.match(buf, pos).end()
+            if pos < len(buf):
+                if in_array is None:
+                    in_array = buf[pos] == '['
+                    pos += in_array
+                    continue
+                if in_array and buf[pos] == ']':
+                    break
+                try:
+                    doc, end = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    if eof:
+                        raise
+                else:
+                    pos = end
+                    yield doc
+                    continue
+            elif eof:
+                break
+            chunk = f.read(chunk_size)
+            buf, pos, eof = buf[pos:] + chunk, 0, not chunk
+
+
+def iter_datasets(docs, batch_size=100):
+    """
+    Lazily read docs in batches of Dataset.
+
+    Args:
+        docs (str/iterable): The json file to be read, see iter_docs,
+            or an iterable of docs.
+        batch_size (int): Max No. of structures in each Dataset.
+
+    Yields:
+        (Dataset)
+    """
+    docs = iter_docs(docs) if isinstance(docs, str) else iter(docs)
+    while True:
+        batch = list(itertools.islice(docs, batch_size))
+        if not batch:
+            break
+        yield Dataset.from_docs(batch)
@@ -4,13 +4,149 @@
 
 """This module provides local environment describers."""
 
+import os
+import math
+import zipfile
+import tempfile
 import itertools
+from collections import namedtuple
+from functools import lru_cache
 
 import numpy as np
 import pandas as pd
 from monty.json import MSONable
 from pymatgen.core.periodic_table import get_el_sp
+from pymatgen.io.lammps.data import lattice_2_lmpbox
 from sklearn.base import TransformerMixin, BaseEstimator
+from mlearn.potentials import hash_params
+from mlearn.neighbors import find_neighbors
+
+
+BispectrumIndex = namedtuple('BispectrumIndex',
+                             ['subscripts', 'columns', 'quadratic_pairs'])
+
+
+@lru_cache(maxsize=None)
+def get_bs_index(twojmax, diagonalstyle, quadratic=False):
+    """
+    Memoised index table of bispectrum components.
+
+    Args:
+        twojmax (int): Band limit for bispectrum components.
+        diagonalstyle (int): Parameter defining which bispectrum
+            components are generated. Choose among 0, 1, 2 and 3.
+        quadratic (bool): Whether including quadratic terms.
+
+    Returns:
+        BispectrumIndex of read-only arrays, with subscripts being the
+        (2j1, 2j2, 2j) of components with shape (n_bs, 3), columns
+        being the labels of linear (and quadratic) terms and
+        quadratic_pairs being the component indices of quadratic terms
+        with shape (n_quadratic, 2).
+
+    """
+    subs = np.array(list(itertools.product(range(twojmax + 1), repeat=3)),
+                    dtype=int).reshape(-1, 3)
+    j1, j2, j = subs.T
+    mask = j1 >= j2
+    if diagonalstyle == 2:
+        mask &= (j1 == j2) & (j2 == j)
+    else:
+        if diagonalstyle == 1:
+            mask &= j1 == j2
+        elif diagonalstyle == 3:
+            mask &= j >= j1
+        mask &= (j >= j1 - j2) & (j <= np.minimum(twojmax, j1 + j2)) & \
+            ((j - j1 + j2) % 2 == 0)
+    subscripts = subs[mask]
+    columns = ['-'.join(['%d' % i for i in sub]) for sub in subscripts]
+    if quadratic:
+        quadratic_pairs = np.array(np.triu_indices(len(subscripts))).T
+        columns += ['-'.join(['%d%d%d' % tuple(subscripts[i]) for i in pair])
+                    for pair in quadratic_pairs]
+    else:
+        quadratic_pairs = np.zeros((0, 2), dtype=int)
+    columns = np.array(columns, dtype=object)
+    for array in [subscripts, columns, quadratic_pairs]:
+        array.setflags(write=False)
+    return BispectrumIndex(subscripts, columns, quadratic_pairs)
+
+
+class FeatureCache(object):
+    """
+    On-disk store of describer outputs, with each entry saved as a npz
+    file named by its content hash. Entries beyond the size bound are
+    evicted in least recently used order.
+
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        """
+
+        Args:
+            cache_dir (str): Directory of the cache.
+            max_size (int): Max total size of cached files in bytes.
+                Default to None, i.e., unbounded.
+
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, '%s.npz' % key)
+
+    def get(self, key):
+        """
+        Get the arrays stored with key, or None if missing.
+
+        """
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as f:
+                arrays = tuple(f['arr_%d' % i] for i in range(len(f.files)))
+            # access time as modification time for LRU eviction
+            os.utime(path, None)
+        except (IOError, OSError, ValueError, KeyError, zipfile.BadZipFile):
+            return None
+        return arrays
+
+    def put(self, key, arrays):
+        """
+        Store arrays with key, written atomically.
+
+        """
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, *arrays)
+            os.replace(temp_path, self._path(key))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def evict(self):
+        """
+        Remove least recently used entries until the total size is
+        within max_size.
+
+        """
+        if self.max_size is None:
+            return
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npz'):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(e[1] for e in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            total -= size
 
 
 class BispectrumCoefficients(BaseEstimator, MSONable, TransformerMixin):
@@ -21,7 +157,8 @@ class BispectrumCoefficients(BaseEstimator, MSONable, TransformerMixin):
     """
 
     def __init__(self, rcutfac, twojmax, element_profile, rfac0=0.99363,
-                 rmin0=0, diagonalstyle=3, quadratic=False, pot_fit=False):
+                 rmin0=0, diagonalstyle=3, quadratic=False, pot_fit=False,
+                 backend='subprocess', cache_dir=None, cache_size=None):
         """
 
         Args:
@@ -43,14 +180,35 @@ class BispectrumCoefficients(BaseEstimator, MSONable, TransformerMixin):
             pot_fit (bool): Whether to output in potentials fitting
                 format. Default to False, i.e., returning the bispectrum
                 coefficients for each site.
+            backend (str): 'subprocess' or 'library' computes the
+                bispectrum with LAMMPS through SpectralNeighborAnalysis,
+                'numpy' uses the native NumPy implementation without
+                LAMMPS. Default to 'subprocess'.
+            cache_dir (str): Directory of the on-disk feature cache,
+                keyed by the structure, the bispectrum parameters and the
+                backend, so that only structures not seen before are
+                computed. Entries are not shared across backends, which
+                differ in site order and precision of the outputs.
+                Default to None, i.e., no cache.
+            cache_size (int): Max size of the feature cache in bytes,
+                beyond which least recently used entries are evicted.
+                Default to None, i.e., unbounded.
 
         """
-        from mlearn.potentials.lammps.calcs import SpectralNeighborAnalysis
-        self.calculator = SpectralNeighborAnalysis(rcutfac, twojmax,
-                                                   element_profile,
-                                                   rfac0, rmin0,
-                                                   diagonalstyle,
-                                                   quadratic)
+        if backend == 'numpy':
+            self.calculator = NativeSpectralNeighborAnalysis(rcutfac, twojmax,
+                                                             element_profile,
+                                                             rfac0, rmin0,
+                                                             diagonalstyle,
+                                                             quadratic)
+        else:
+            from mlearn.potentials.lammps.calcs import SpectralNeighborAnalysis
+            self.calculator = SpectralNeighborAnalysis(rcutfac, twojmax,
+                                                       element_profile,
+                                                       rfac0, rmin0,
+                                                       diagonalstyle,
+                                                       quadratic,
+                                                       backend=backend)
         self.rcutfac = rcutfac
         self.twojmax = twojmax
         self.element_profile = element_profile
@@ -61,6 +219,9 @@ class BispectrumCoefficients(BaseEstimator, MSONable, TransformerMixin):
                                key=lambda sym: get_el_sp(sym).X)
         self.quadratic = quadratic
         self.pot_fit = pot_fit
+        self.backend = backend
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
 
     @property
     def subscripts(self):
@@ -69,8 +230,31 @@ class BispectrumCoefficients(BaseEstimator, MSONable, TransformerMixin):
         involved.
 
         """
-        return self.calculator.get_bs_subscripts(self.twojmax,
-                                                 self.diagonalstyle)
+        return get_bs_index(self.twojmax, self.diagonalstyle).subscripts.tolist()
+
+    def _feature_key(self, structure):
+        settings = [self.rcutfac, self.twojmax, self.element_profile,
+                    self.rfac0, self.rmin0, self.diagonalstyle, self.quadratic,
+                    self.backend]
+        species = [site.specie.symbol for site in structure]
+        return hash_params(settings, species,
+                           np.round(structure.lattice.matrix, 8),
+                           np.round(structure.frac_coords, 8))
+
+    def _calculate(self, structures):
+        if self.cache_dir is None:
+            return self.calculator.calculate(structures)
+        cache = FeatureCache(self.cache_dir, self.cache_size)
+        keys = [self._feature_key(s) for s in structures]
+        raw_data = [cache.get(key) for key in keys]
+        misses = [i for i, d in enumerate(raw_data) if d is None]
+        if misses:
+            outputs = self.calculator.calculate([structures[i] for i in misses])
+            for i, output in zip(misses, outputs):
+                cache.put(keys[i], output)
+                raw_data[i] = output
+            cache.evict()
+        return raw_data
 
     def describe(self, structure, include_stress=False):
         """
@@ -101,63 +285,416 @@ class BispectrumCoefficients(BaseEstimator, MSONable, TransformerMixin):
         """
         return self.describe_all([structure], include_stress).xs(0, level='input_index')
 
-    def describe_all(self, structures, include_stress=False):
+    def describe_all(self, structures, include_stress=False, raw=False,
+                     batch_size=100):
         """
         Returns data for all input structures in a single DataFrame.
 
         Args:
-            structures (Structure): Input structures as a list.
+            structures (Structure): Input structures as a list, or an
+                iterable, e.g., a generator, consumed in batches.
             include_stress (bool): Whether to include stress descriptors.
+            raw (bool): Whether to return the NumPy design matrix and the
+                input index of each row, i.e., (X, row_index), which
+                skips building the DataFrame. Default to False.
+            batch_size (int): No. of structures computed at a time when
+                structures is not a list, so that only one batch of
+                structures is held in memory. Default to 100.
 
         Returns:
             DataFrame with indices of input list preserved. To retrieve
             the data for structures[i], use
-            df.xs(i, level='input_index').
-
-        """
-        columns = list(map(lambda s: '-'.join(['%d' % i for i in s]),
-                           self.subscripts))
-        if self.quadratic:
-            columns += list(map(lambda s: '-'.join(['%d%d%d' % (i, j, k)
-                                                    for i, j, k in s]),
-                                itertools.combinations_with_replacement(self.subscripts, 2)))
-
-        raw_data = self.calculator.calculate(structures)
-
-        def process(output, combine, idx, include_stress):
-            b, db, vb, e = output
-            df = pd.DataFrame(b, columns=columns)
-            if combine:
-                df_add = pd.DataFrame({'element': e, 'n': np.ones(len(e))})
-                df_b = df_add.join(df)
-                n_atoms = df_b.shape[0]
-                b_by_el = [df_b[df_b['element'] == e] for e in self.elements]
-                sum_b = [df[df.columns[1:]].sum(axis=0) for df in b_by_el]
-                hstack_b = pd.concat(sum_b, keys=self.elements)
-                hstack_b = hstack_b.to_frame().T / n_atoms
-                hstack_b.fillna(0, inplace=True)
-                dbs = np.split(db, len(self.elements), axis=1)
-                dbs = np.hstack([np.insert(d.reshape(-1, len(columns)),
-                                           0, 0, axis=1) for d in dbs])
-                db_index = ['%d_%s' % (i, d)
-                            for i in df_b.index for d in 'xyz']
-                df_db = pd.DataFrame(dbs, index=db_index,
-                                     columns=hstack_b.columns)
-                if include_stress:
-                    vbs = np.split(vb.sum(axis=0), len(self.elements))
-                    vbs = np.hstack([np.insert(v.reshape(-1, len(columns)),
-                                               0, 0, axis=1) for v in vbs])
-                    volume = structures[idx].volume
-                    vbs = vbs / volume * 160.21766208  # from eV to GPa
-                    vb_index = ['xx', 'yy', 'zz', 'yz', 'xz', 'xy']
-                    df_vb = pd.DataFrame(vbs, index=vb_index,
-                                         columns=hstack_b.columns)
-                    df = pd.concat([hstack_b, df_db, df_vb])
-                else:
-                    df = pd.concat([hstack_b, df_db])
-            return df
-
-        df = pd.concat([process(d, self.pot_fit, i, include_stress)
-                        for i, d in enumerate(raw_data)],
-                       keys=range(len(raw_data)), names=["input_index", None])
-        return df
+            df.xs(i, level='input_index'). With raw=True, the array
+            (X, row_index) with rows in the same order.
+
+        """
+        if hasattr(structures, '__len__'):
+            batches = [structures]
+        else:
+            structures = iter(structures)
+            batches = iter(lambda: list(itertools.islice(structures, batch_size)), [])
+        results = [self._describe_batch(batch, include_stress) for batch in batches]
+        if not results:
+            results = [self._describe_batch([], include_stress)]
+        xs, n_atoms = zip(*results)
+        x = np.concatenate(xs) if len(xs) > 1 else xs[0]
+        n_atoms = np.concatenate(n_atoms)
+        columns = get_bs_index(self.twojmax, self.diagonalstyle,
+                               self.quadratic).columns
+
+        if not self.pot_fit:
+            row_index = np.repeat(np.arange(len(n_atoms)), n_atoms)
+            if raw:
+                return x, row_index
+            labels = np.concatenate([np.arange(n) for n in n_atoms]) \
+                if len(n_atoms) else np.zeros(0, dtype=int)
+            index = pd.MultiIndex.from_arrays([row_index, labels],
+                                              names=['input_index', None])
+            return pd.DataFrame(x, index=index, columns=columns)
+
+        n_rows = 1 + 3 * n_atoms + (6 if include_stress else 0)
+        row_index = np.repeat(np.arange(len(n_atoms)), n_rows)
+        if raw:
+            return x, row_index
+
+        vb_index = ['xx', 'yy', 'zz', 'yz', 'xz', 'xy'] if include_stress else []
+        labels = [label for n in n_atoms for label in
+                  itertools.chain([0], ('%d_%s' % (i, d) for i in range(n) for d in 'xyz'), vb_index)]
+        index = pd.MultiIndex.from_arrays([row_index, np.array(labels, dtype=object)],
+                                          names=['input_index', None])
+        df_columns = pd.MultiIndex.from_product([self.elements, ['n'] + list(columns)])
+        return pd.DataFrame(x, index=index, columns=df_columns)
+
+    def _describe_batch(self, structures, include_stress):
+        """
+        Compute the design matrix rows of a list of structures.
+
+        Returns:
+            (x, n_atoms), the design matrix and No. of atoms of each
+            structure.
+        """
+        columns = get_bs_index(self.twojmax, self.diagonalstyle,
+                               self.quadratic).columns
+        raw_data = self._calculate(structures)
+        n_atoms = np.array([len(d[0]) for d in raw_data], dtype=int)
+
+        if not self.pot_fit:
+            x = np.concatenate([d[0] for d in raw_data]) if raw_data \
+                else np.zeros((0, len(columns)))
+            return x, n_atoms
+
+        n_elements, n_columns = len(self.elements), len(columns) + 1
+        n_rows = 1 + 3 * n_atoms + (6 if include_stress else 0)
+        x = np.zeros((n_rows.sum(), n_elements * n_columns))
+        starts = np.cumsum(n_rows) - n_rows
+        for i, ((b, db, vb, e), start) in enumerate(zip(raw_data, starts)):
+            n = n_atoms[i]
+            # rows of the structure viewed as (row, element, ['n'] + columns)
+            rows = x[start:start + n_rows[i]].reshape(-1, n_elements, n_columns)
+            onehot = (np.asarray(e)[:, None] == np.array(self.elements)[None, :]).astype(float)
+            rows[0, :, 0] = onehot.sum(axis=0) / n
+            rows[0, :, 1:] = np.dot(onehot.T, b) / n
+            rows[1:1 + 3 * n, :, 1:] = db.reshape(n, n_elements, 3, -1). \
+                transpose(0, 2, 1, 3).reshape(3 * n, n_elements, -1)
+            if include_stress:
+                vbs = vb.sum(axis=0).reshape(n_elements, 6, -1).transpose(1, 0, 2)
+                rows[1 + 3 * n:, :, 1:] = vbs / structures[i].volume * 160.21766208  # from eV to GPa
+        return x, n_atoms
+
+
+_VOIGT = [(0, 0), (1, 1), (2, 2), (1, 2), (0, 2), (0, 1)]
+
+
+def _factorial(n):
+    return float(math.factorial(n))
+
+
+@lru_cache(maxsize=None)
+def _clebsch_gordan(j1, j2, j):
+    """
+    Clebsch-Gordan coefficients <j1/2 m1, j2/2 m2 | j/2 m> as an array
+    indexed by [ma1, ma2, ma] with m = ma - j / 2, following the
+    convention of LAMMPS compute sna/atom. Couplings violating the parity
+    rule, i.e., with odd j1 + j2 + j, vanish.
+
+    """
+    cg = np.zeros((j1 + 1, j2 + 1, j + 1))
+    if (j1 + j2 + j) % 2 == 1:
+        return cg
+    dcg = math.sqrt(_factorial((j1 + j2 - j) // 2) *
+                    _factorial((j1 - j2 + j) // 2) *
+                    _factorial((-j1 + j2 + j) // 2) /
+                    _factorial((j1 + j2 + j) // 2 + 1))
+    for m1 in range(j1 + 1):
+        aa2 = 2 * m1 - j1
+        for m2 in range(j2 + 1):
+            bb2 = 2 * m2 - j2
+            m = (aa2 + bb2 + j) // 2
+            if m < 0 or m > j:
+                continue
+            total = 0.0
+            for z in range(max(0, -(j - j2 + aa2) // 2, -(j - j1 - bb2) // 2),
+                           min((j1 + j2 - j) // 2, (j1 - aa2) // 2, (j2 + bb2) // 2) + 1):
+                total += (-1) ** z / (_factorial(z) *
+                                      _factorial((j1 + j2 - j) // 2 - z) *
+                                      _factorial((j1 - aa2) // 2 - z) *
+                                      _factorial((j2 + bb2) // 2 - z) *
+                                      _factorial((j - j2 + aa2) // 2 + z) *
+                                      _factorial((j - j1 - bb2) // 2 + z))
+            cc2 = 2 * m - j
+            sfaccg = math.sqrt(_factorial((j1 + aa2) // 2) * _factorial((j1 - aa2) // 2) *
+                               _factorial((j2 + bb2) // 2) * _factorial((j2 - bb2) // 2) *
+                               _factorial((j + cc2) // 2) * _factorial((j - cc2) // 2) *
+                               (j + 1))
+            cg[m1, m2, m] = total * dcg * sfaccg
+    return cg
+
+
+@lru_cache(maxsize=None)
+def _wigner_coeffs(j):
+    """
+    Coefficients of the recursion of hyperspherical harmonics from layer
+    j - 1 to j for the upper half rows, and the signs relating the lower
+    half rows to the upper ones.
+
+    """
+    mb, ma = np.mgrid[0:j // 2 + 1, 0:j + 1]
+    coeff_a = np.sqrt((j - ma) / (j - mb))
+    coeff_b = np.sqrt(ma / (j - mb))
+    rows, cols = np.mgrid[0:j + 1, 0:j + 1]
+    signs = np.where((rows + cols) % 2 == 0, 1.0, -1.0)[j // 2 + 1:]
+    return coeff_a, coeff_b, signs
+
+
+def _wigner_u(vectors, rcut, twojmax, rfac0, rmin0, derivatives=True):
+    """
+    Hyperspherical harmonics U_j of neighbor vectors weighted by the
+    cutoff function, and their derivatives with respect to the vectors.
+
+    Returns:
+        Flattened U with shape (n_pairs, n_u) and dU with shape
+        (n_pairs, 3, n_u), where n_u = sum_j (j + 1) ** 2. dU is None
+        if derivatives is False.
+
+    """
+    x, y, z = vectors.T
+    r = np.linalg.norm(vectors, axis=1)
+    rscale0 = rfac0 * np.pi / (rcut - rmin0)
+    theta0 = (r - rmin0) * rscale0
+    z0 = r / np.tan(theta0)
+    dz0dr = z0 / r - (r * rscale0) * (r ** 2 + z0 ** 2) / r ** 2
+    r0inv = 1.0 / np.sqrt(r ** 2 + z0 ** 2)
+    dr0invdr = -r0inv ** 3 * (r + z0 * dz0dr)
+    unit = vectors / r[:, None]
+    dz0 = dz0dr[:, None] * unit
+    dr0inv = dr0invdr[:, None] * unit
+
+    ca = r0inv * (z0 + 1j * z)
+    cb = r0inv * (y + 1j * x)
+    da = dz0 * r0inv[:, None] + z0[:, None] * dr0inv - 1j * z[:, None] * dr0inv
+    da[:, 2] -= 1j * r0inv
+    db = y[:, None] * dr0inv - 1j * x[:, None] * dr0inv
+    db[:, 0] -= 1j * r0inv
+    db[:, 1] += r0inv
+    cda, cdb = np.conj(da)[:, :, None, None], np.conj(db)[:, :, None, None]
+    ca, cb = ca[:, None, None], cb[:, None, None]
+
+    n_pairs = len(vectors)
+    u = np.ones((n_pairs, 1, 1), dtype=complex)
+    du = np.zeros((n_pairs, 3, 1, 1), dtype=complex)
+    us, dus = [u], [du]
+    for j in range(1, twojmax + 1):
+        coeff_a, coeff_b, signs = _wigner_coeffs(j)
+        nr = j // 2 + 1
+        u_prev = u[:, :nr]
+        u = np.zeros((n_pairs, j + 1, j + 1), dtype=complex)
+        u[:, :nr, :j] = coeff_a[:, :j] * ca * u_prev
+        u[:, :nr, 1:] -= coeff_b[:, 1:] * cb * u_prev
+        # inversion symmetry u[j - mb][j - ma] = (-1)^(ma - mb) * conj(u[mb][ma])
+        u[:, nr:] = signs * np.conj(u[:, (j - 1) // 2::-1, ::-1])
+        us.append(u)
+        if not derivatives:
+            continue
+        du_prev = du[:, :, :nr]
+        du = np.zeros((n_pairs, 3, j + 1, j + 1), dtype=complex)
+        du[:, :, :nr, :j] = coeff_a[:, :j] * (cda * u_prev[:, None] + ca[:, None] * du_prev)
+        du[:, :, :nr, 1:] -= coeff_b[:, 1:] * (cdb * u_prev[:, None] + cb[:, None] * du_prev)
+        du[:, :, nr:] = signs * np.conj(du[:, :, (j - 1) // 2::-1, ::-1])
+        dus.append(du)
+
+    rcutfac = np.pi / (rcut - rmin0)
+    inside = (r > rmin0) & (r <= rcut)
+    sfac = np.where(r <= rmin0, 1.0, np.where(inside, 0.5 * (np.cos((r - rmin0) * rcutfac) + 1.0), 0.0))
+    dsfac = np.where(inside, -0.5 * np.sin((r - rmin0) * rcutfac) * rcutfac, 0.0)
+    u = np.concatenate([u.reshape(n_pairs, u.shape[-1] ** 2) for u in us], axis=1)
+    if not derivatives:
+        return sfac[:, None] * u, None
+    du = np.concatenate([du.reshape(n_pairs, 3, du.shape[-1] ** 2) for du in dus], axis=2)
+    du = dsfac[:, None, None] * unit[:, :, None] * u[:, None, :] + sfac[:, None, None] * du
+    return sfac[:, None] * u, du
+
+
+class NativeSpectralNeighborAnalysis(object):
+    """
+    Native NumPy implementation of LAMMPS compute sna/atom, snad/atom and
+    snav/atom, serving the same outputs as SpectralNeighborAnalysis
+    without running LAMMPS.
+
+    Usage:
+        [(b, db, vb, e)] = sna.calculate([Structure])
+        b, db, vb and e are in the same format as the outputs of
+        SpectralNeighborAnalysis, with the atomic coordinates transformed
+        into the LAMMPS box frame. Components with odd j1 + j2 + j,
+        which only appear with diagonalstyle 2, are zero.
+
+    """
+
+    def __init__(self, rcutfac, twojmax, element_profile, rfac0=0.99363,
+                 rmin0=0, diagonalstyle=3, quadratic=False, max_size=4000000):
+        """
+        For more details on the parameters, please refer to
+        SpectralNeighborAnalysis.
+
+        Args:
+            rcutfac (float): Global cutoff distance.
+            twojmax (int): Band limit for bispectrum components.
+            element_profile (dict): Parameters (cutoff factor 'r' and
+                weight 'w') related to each element, e.g.,
+                {'Na': {'r': 0.3, 'w': 0.9},
+                 'Cl': {'r': 0.7, 'w': 3.0}}
+            rfac0 (float): Parameter in distance to angle conversion.
+                Set between (0, 1), default to 0.99363.
+            rmin0 (float): Parameter in distance to angle conversion.
+                Default to 0.
+            diagonalstyle (int): Parameter defining which bispectrum
+                components are generated. Choose among 0, 1, 2 and 3,
+                default to 3.
+            quadratic (bool): Whether including quadratic terms.
+                Default to False.
+            max_size (int): Max No. of complex numbers held for the
+                derivatives of a chunk of atoms, which bounds the memory
+                usage. Default to 4000000.
+
+        """
+        self.rcutfac = rcutfac
+        self.twojmax = twojmax
+        self.element_profile = element_profile
+        self.rfac0 = rfac0
+        self.rmin0 = rmin0
+        assert diagonalstyle in range(4), 'Invalid diagonalstype, ' \
+                                          'choose among 0, 1, 2 and 3'
+        self.diagonalstyle = diagonalstyle
+        self.quadratic = quadratic
+        self.max_size = max_size
+        self.elements = sorted(element_profile.keys(),
+                               key=lambda sym: get_el_sp(sym).X)
+
+    @staticmethod
+    def get_bs_subscripts(twojmax, diagonal):
+        """
+        Method to list the subscripts 2j1, 2j2, 2j of bispectrum
+        components, see SpectralNeighborAnalysis.get_bs_subscripts.
+
+        """
+        return get_bs_index(twojmax, diagonal).subscripts.tolist()
+
+    @property
+    def n_bs(self):
+        """
+        Returns No. of bispectrum components to be calculated.
+
+        """
+        return len(get_bs_index(self.twojmax, self.diagonalstyle).subscripts)
+
+    def calculate(self, structures):
+        """
+        Calculate the bispectrum components of structures.
+
+        Args:
+            structures ([Structure]): Input structures.
+
+        Returns:
+            List of (b, db, vb, e) for each structure.
+
+        """
+        return [self._calculate(s) for s in structures]
+
+    def _bispectrum(self, u_tot, derivatives=True):
+        """
+        Bispectrum components of atoms from the total hyperspherical
+        harmonics, together with Y, the gradients of the components with
+        respect to the harmonics, i.e., dB = Re(sum(dU * Y)). Y is None if
+        derivatives is False.
+
+        """
+        subscripts = get_bs_index(self.twojmax, self.diagonalstyle).subscripts
+        offsets = np.cumsum([0] + [(j + 1) ** 2 for j in range(self.twojmax + 1)])
+        n_atoms = len(u_tot)
+        u_block = lambda j: u_tot[:, offsets[j]:offsets[j + 1]].reshape(n_atoms, j + 1, j + 1)
+        b = np.zeros((n_atoms, len(subscripts)))
+        y = np.zeros((n_atoms, len(subscripts), offsets[-1]), dtype=complex) if derivatives else None
+        for i, (j1, j2, j) in enumerate(subscripts):
+            # CG table with shape (j1 + 1) * (j2 + 1) x (j + 1)
+            cg = _clebsch_gordan(j1, j2, j).reshape(-1, j + 1)
+            u1, u2, cuj = u_block(j1), u_block(j2), np.conj(u_block(j))
+            # outer product u1[x][a] * u2[y][c] as matrix [xy][ac]
+            u12 = (u1[:, :, None, :, None] * u2[:, None, :, None, :]).reshape(n_atoms, len(cg), len(cg))
+            z = np.matmul(np.matmul(cg.T, u12), cg)
+            b[:, i] = np.sum(cuj * z, axis=(1, 2)).real
+            if not derivatives:
+                continue
+            y[:, i, offsets[j]:offsets[j + 1]] += np.conj(z).reshape(n_atoms, -1)
+            q = np.matmul(np.matmul(cg, cuj), cg.T).reshape(n_atoms, j1 + 1, j2 + 1, j1 + 1, j2 + 1)
+            y[:, i, offsets[j1]:offsets[j1 + 1]] += np.einsum('kxyac,kyc->kxa', q, u2).reshape(n_atoms, -1)
+            y[:, i, offsets[j2]:offsets[j2 + 1]] += np.einsum('kxyac,kxa->kyc', q, u1).reshape(n_atoms, -1)
+        return b, y
+
+    def _neighbors(self, structure):
+        """
+        Element types, Cartesian coordinates in the LAMMPS box frame and
+        the neighbor pairs within the element-pair cutoffs of a structure.
+
+        Returns:
+            (types, coords, centers, neighbors, vectors, rcuts), the pairs
+            are sorted by center indices.
+
+        """
+        _, symmop = lattice_2_lmpbox(structure.lattice)
+        matrix = np.dot(structure.lattice.matrix, symmop.rotation_matrix.T)
+        coords = np.dot(structure.frac_coords % 1.0, matrix)
+        types = np.array([self.elements.index(site.specie.symbol) for site in structure], dtype=int)
+        radii = np.array([self.element_profile[e]['r'] * self.rcutfac for e in self.elements])
+
+        centers, neighbors, _, vectors, _ = find_neighbors(coords, matrix, 2 * radii.max())
+        rcuts = radii[types[centers]] + radii[types[neighbors]]
+        inside = np.sum(vectors ** 2, axis=1) < rcuts ** 2
+        return types, coords, centers[inside], neighbors[inside], vectors[inside], rcuts[inside]
+
+    def _calculate(self, structure):
+        symbols = [site.specie.symbol for site in structure]
+        weights = np.array([self.element_profile[e]['w'] for e in self.elements])
+        types, coords, centers, neighbors, vectors, rcuts = self._neighbors(structure)
+
+        n_atoms, n_elements = len(structure), len(self.elements)
+        n_u = sum((j + 1) ** 2 for j in range(self.twojmax + 1))
+        index = get_bs_index(self.twojmax, self.diagonalstyle, self.quadratic)
+        n_bs, n_per = len(index.subscripts), len(index.columns)
+        diagonal = np.concatenate([np.arange(j + 1) * (j + 2) + sum((k + 1) ** 2 for k in range(j))
+                                   for j in range(self.twojmax + 1)])
+        b_all = np.zeros((n_atoms, n_per))
+        snad = np.zeros((n_atoms, n_elements, 3, n_per))
+        snav = np.zeros((n_atoms, n_elements, 6, n_per))
+        bounds = np.searchsorted(centers, np.arange(n_atoms + 1))
+        n_neighbors = len(centers) / max(1, n_atoms)
+        chunk = max(1, int(self.max_size // ((3 * n_neighbors + n_bs) * n_u)))
+        for start in range(0, n_atoms, chunk):
+            stop = min(start + chunk, n_atoms)
+            pairs = slice(bounds[start], bounds[stop])
+            local = centers[pairs] - start
+            u, du = _wigner_u(vectors[pairs], rcuts[pairs], self.twojmax, self.rfac0, self.rmin0)
+            weight = weights[types[neighbors[pairs]]]
+            u_tot = np.zeros((stop - start, n_u), dtype=complex)
+            u_tot[:, diagonal] = 1.0
+            np.add.at(u_tot, local, weight[:, None] * u)
+            b, y = self._bispectrum(u_tot)
+            # dB_i / dr_j of each pair with shape (n_pairs, 3, n_bs)
+            du = weight[:, None, None] * du
+            db = np.zeros((len(local), 3, n_bs))
+            local_bounds = bounds[start:stop + 1] - bounds[start]
+            for k, (lo, hi) in enumerate(zip(local_bounds[:-1], local_bounds[1:])):
+                db[lo:hi] = np.dot(du[lo:hi], y[k].T).real
+            if self.quadratic:
+                ia, ib = index.quadratic_pairs.T
+                scale = np.where(ia == ib, 0.5, 1.0)
+                b_pair = b[local]
+                db_quad = b_pair[:, None, ia] * db[:, :, ib] + b_pair[:, None, ib] * db[:, :, ia]
+                b = np.hstack([b, scale * b[:, ia] * b[:, ib]])
+                db = np.concatenate([db, scale * db_quad], axis=2)
+            b_all[start:stop] = b
+            i, j, t = centers[pairs], neighbors[pairs], types[centers[pairs]]
+            np.add.at(snad, (i, t), db)
+            np.add.at(snad, (j, t), -db)
+            xi, xj = coords[i], coords[i] + vectors[pairs]
+            np.add.at(snav, (i, t), np.stack([db[:, d1] * xi[:, d2, None] for d1, d2 in _VOIGT], axis=1))
+            np.add.at(snav, (j, t), -np.stack([db[:, d1] * xj[:, d2, None] for d1, d2 in _VOIGT], axis=1))
+        return b_all, snad.reshape(n_atoms, -1), snav.reshape(n_atoms, -1), np.array(symbols)
@@ -0,0 +1,212 @@
+# coding: utf-8
+# Copyright (c) Materials Virtual Lab
+# Distributed under the terms of the BSD License.
+
+"""This module provides periodic neighbor lists for native describers
+and potentials."""
+
+import itertools
+from collections import namedtuple
+
+import numpy as np
+
+
+class Neighbors(namedtuple('Neighbors', ['centers', 'neighbors', 'images',
+                                         'vectors', 'offsets'])):
+    """
+    Neighbor pairs in CSR layout, i.e., sorted by center indices with the
+    pairs of center i being offsets[i]:offsets[i + 1].
+
+    Attributes:
+        centers (np.ndarray): Center indices with shape (P, ).
+        neighbors (np.ndarray): Neighbor indices with shape (P, ).
+        images (np.ndarray): Integer lattice shifts of the neighbor
+            images with shape (P, 3), such that vectors equal
+            cart_coords[neighbors] + images @ lattice_matrix - cart_coords[centers].
+        vectors (np.ndarray): Displacement vectors from center to neighbor
+            image with shape (P, 3).
+        offsets (np.ndarray): Row pointers with shape (N + 1, ).
+
+    """
+    __slots__ = ()
+
+    @property
+    def distances(self):
+        return np.linalg.norm(self.vectors, axis=1)
+
+    def within(self, cutoff):
+        """
+        Subset of the pairs within a smaller cutoff, which allows one
+        neighbor search to serve several cutoffs.
+
+        Args:
+            cutoff (float): Cutoff distance.
+
+        Returns:
+            Neighbors.
+        """
+        inside = np.sum(self.vectors ** 2, axis=1) < cutoff ** 2
+        centers = self.centers[inside]
+        return Neighbors(centers, self.neighbors[inside], self.images[inside],
+                         self.vectors[inside],
+                         np.searchsorted(centers, np.arange(len(self.offsets))))
+
+
+def find_neighbors(cart_coords, lattice_matrix, cutoff, max_size=2000000):
+    """
+    Find all neighbor images within cutoff of each site under periodic
+    boundary conditions with a linked-cell algorithm. Sites are wrapped
+    into the cell and padded with the periodic images within cutoff of the
+    cell faces, then binned along the lattice vectors with bins no thinner
+    than cutoff, so that the neighbors of a site lie in the 27 adjacent
+    bins regardless of the cell tilt.
+
+    Args:
+        cart_coords (np.ndarray): Cartesian coordinates with shape (N, 3),
+            which are not required to be inside the cell.
+        lattice_matrix (np.ndarray): Lattice vectors as rows.
+        cutoff (float): Cutoff distance.
+        max_size (int): Max No. of candidate pairs evaluated at once.
+
+    Returns:
+        Neighbors.
+    """
+    cart_coords = np.asarray(cart_coords, dtype=float).reshape(-1, 3)
+    lattice_matrix = np.asarray(lattice_matrix, dtype=float)
+    n_sites = len(cart_coords)
+    inv_matrix = np.linalg.inv(lattice_matrix)
+    frac_coords = np.dot(cart_coords, inv_matrix)
+    shifts = np.floor(frac_coords).astype(int)
+    frac_coords -= shifts
+
+    # thickness of the cutoff sphere along each lattice vector in fractional units
+    margins = cutoff * np.linalg.norm(inv_matrix, axis=0)
+    n_max = np.ceil(margins).astype(int)
+    images = np.array(list(itertools.product(*[range(-n, n + 1) for n in n_max])))
+    ghost_frac = (frac_coords[None, :, :] + images[:, None, :]).reshape(-1, 3)
+    owners = np.tile(np.arange(n_sites), len(images))
+    ghost_images = np.repeat(images, n_sites, axis=0)
+    padded = np.all((ghost_frac >= -margins) & (ghost_frac < 1 + margins), axis=1)
+    ghost_frac, owners, ghost_images = ghost_frac[padded], owners[padded], ghost_images[padded]
+
+    n_bins = np.maximum(1, np.floor((1 + 2 * margins) / np.maximum(margins, 1e-8))).astype(int)
+    excess = np.prod(n_bins.astype(float)) / max(1, len(owners))
+    if excess > 1:
+        n_bins = np.maximum(1, np.floor(n_bins / excess ** (1 / 3.))).astype(int)
+    widths = (1 + 2 * margins) / n_bins
+
+    def bin_index(frac):
+        return np.clip(np.floor((frac + margins) / widths).astype(int), 0, n_bins - 1)
+
+    ghost_bins = np.ravel_multi_index(bin_index(ghost_frac).T, n_bins)
+    order = np.argsort(ghost_bins, kind='stable')
+    ghost_frac, owners, ghost_images = ghost_frac[order], owners[order], ghost_images[order]
+    bin_counts = np.bincount(ghost_bins, minlength=np.prod(n_bins))
+    bin_starts = np.cumsum(bin_counts) - bin_counts
+
+    # candidate bins of each site, (N, 27)
+    site_bins = bin_index(frac_coords)[:, None, :] + np.array(list(itertools.product([-1, 0, 1], repeat=3)))
+    valid = np.all((site_bins >= 0) & (site_bins < n_bins), axis=-1)
+    flat = np.ravel_multi_index(np.clip(site_bins, 0, n_bins - 1).transpose(2, 0, 1), n_bins)
+    counts = np.where(valid, bin_counts[flat], 0)
+    starts = bin_starts[flat]
+
+    ghost_cart = np.dot(ghost_frac, lattice_matrix)
+    site_cart = np.dot(frac_coords, lattice_matrix)
+    totals = np.cumsum(counts.sum(axis=1))
+    bounds = np.searchsorted(totals, np.arange(max_size, totals[-1] if n_sites else 0, max_size), side='right')
+    centers, neighbors, shifts_out, vectors = [], [], [], []
+    for start, stop in zip(np.concatenate([[0], bounds]), np.concatenate([bounds, [n_sites]])):
+        if stop <= start:
+            continue
+        c = counts[start:stop].ravel()
+        i = np.repeat(np.repeat(np.arange(start, stop), 27), c)
+        k = np.repeat(starts[start:stop].ravel(), c) + np.arange(c.sum()) - np.repeat(np.cumsum(c) - c, c)
+        diff = ghost_cart[k] - site_cart[i]
+        dist_sq = np.sum(diff ** 2, axis=1)
+        inside = (dist_sq < cutoff ** 2) & (dist_sq > 1e-20)
+        i, k = i[inside], k[inside]
+        centers.append(i)
+        neighbors.append(owners[k])
+        shifts_out.append(ghost_images[k] + shifts[i] - shifts[owners[k]])
+        vectors.append(diff[inside])
+    if not centers:
+        return Neighbors(np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros((0, 3), dtype=int),
+                         np.zeros((0, 3)), np.zeros(n_sites + 1, dtype=int))
+    centers, neighbors = np.concatenate(centers), np.concatenate(neighbors)
+    order = np.lexsort((neighbors, centers))
+    centers, neighbors = centers[order], neighbors[order]
+    return Neighbors(centers, neighbors, np.concatenate(shifts_out)[order],
+                     np.concatenate(vectors)[order],
+                     np.searchsorted(centers, np.arange(n_sites + 1)))
+
+
+class NeighborList(object):
+    """
+    Periodic neighbor list with a Verlet skin for repeated evaluations of
+    slightly moved configurations, e.g., finite differences or MD steps.
+    Pairs are searched within cutoff + skin and only the displacement
+    vectors are updated until some site has moved by more than skin / 2
+    or the lattice changes.
+
+    Usage:
+        neighbor_list = NeighborList(cutoff=5.0, skin=0.3)
+        for coords in trajectory:
+            pairs = neighbor_list.update(coords, lattice_matrix)
+
+    """
+
+    def __init__(self, cutoff, skin=0.3, max_size=2000000):
+        """
+        Args:
+            cutoff (float): Cutoff distance.
+            skin (float): Extra distance searched beyond cutoff.
+                Default to 0.3.
+            max_size (int): Max No. of candidate pairs evaluated at once
+                in the neighbor search.
+        """
+        self.cutoff = cutoff
+        self.skin = skin
+        self.max_size = max_size
+        self.n_builds = 0
+        self._candidates = None
+        self._coords = None
+        self._matrix = None
+
+    def _need_rebuild(self, cart_coords, lattice_matrix):
+        if self._candidates is None or cart_coords.shape != self._coords.shape \
+                or not np.array_equal(lattice_matrix, self._matrix):
+            return True
+        if not len(cart_coords):
+            return False
+        moved = np.max(np.sum((cart_coords - self._coords) ** 2, axis=1))
+        return moved > (self.skin / 2.) ** 2
+
+    def update(self, cart_coords, lattice_matrix):
+        """
+        Neighbors within cutoff of the configuration, rebuilding the
+        candidate pairs only when needed. Sites should be moved
+        continuously, i.e., without wrapping back into the cell, for the
+        candidate pairs to be reused.
+
+        Args:
+            cart_coords (np.ndarray): Cartesian coordinates with shape (N, 3).
+            lattice_matrix (np.ndarray): Lattice vectors as rows.
+
+        Returns:
+            Neighbors.
+        """
+        cart_coords = np.asarray(cart_coords, dtype=float).reshape(-1, 3)
+        lattice_matrix = np.asarray(lattice_matrix, dtype=float)
+        if self._need_rebuild(cart_coords, lattice_matrix):
+            self._candidates = find_neighbors(cart_coords, lattice_matrix,
+                                              self.cutoff + self.skin, self.max_size)
+            self._coords, self._matrix = cart_coords.copy(), lattice_matrix.copy()
+            self.n_builds += 1
+            candidates = self._candidates
+        else:
+            candidates = self._candidates
+            vectors = cart_coords[candidates.neighbors] + np.dot(candidates.images, lattice_matrix) \
+                - cart_coords[candidates.centers]
+            candidates = candidates._replace(vectors=vectors)
+        return candidates.within(self.cutoff)
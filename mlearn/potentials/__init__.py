@@ -5,10 +5,39 @@
 """This package contains Potential classes representing Interatomic Potentials."""
 
 import abc
+import json
+import hashlib
+
 import six
+import numpy as np
+import pandas as pd
 from monty.json import MSONable
 
 
+def hash_params(*params):
+    """
+    Compute a content hash of potential parameters, i.e., NumPy arrays,
+    pandas DataFrames, or JSON serializable objects.
+
+    Args:
+        params: Parameters to be hashed.
+
+    Returns:
+        Hex digest string.
+    """
+    sha = hashlib.sha1()
+    for param in params:
+        if isinstance(param, np.ndarray):
+            sha.update('{} {}'.format(param.dtype, param.shape).encode('utf-8'))
+            sha.update(np.ascontiguousarray(param).tobytes())
+        elif isinstance(param, pd.DataFrame):
+            sha.update(json.dumps(list(map(str, param.columns))).encode('utf-8'))
+            sha.update(pd.util.hash_pandas_object(param).values.tobytes())
+        else:
+            sha.update(json.dumps(param, sort_keys=True, default=str).encode('utf-8'))
+    return sha.hexdigest()
+
+
 class Potential(six.with_metaclass(abc.ABCMeta, MSONable)):
     """
     Abstract Base class for a Interatomic Potential.
@@ -65,3 +94,14 @@ class Potential(six.with_metaclass(abc.ABCMeta, MSONable)):
             energy, forces, stress
         """
         pass
+
+    def param_hash(self):
+        """
+        Content hash of the parameters determining the files written by
+        write_param, used to cache the written potential files. None if
+        the potential does not support caching.
+
+        Returns:
+            Hex digest string or None.
+        """
+        return None
@@ -4,27 +4,34 @@
 
 """This module provides SOAP-GAP interatomic potential class."""
 
+import io
 import re
 import os
+import math
+import itertools
 import ruamel.yaml as yaml
 import subprocess
 import xml.etree.ElementTree as ET
-from collections import OrderedDict, defaultdict
 
 import numpy as np
 from monty.io import zopen
 from monty.os.path import which
 from monty.tempfile import ScratchDir
 from monty.serialization import loadfn
-from pymatgen import Structure, Lattice, Element
+from pymatgen import Element
+from pymatgen.io.lammps.data import lattice_2_lmpbox
 
-from mlearn.potentials import Potential
-from mlearn.data import pool_from, convert_docs
+from mlearn.potentials import Potential, hash_params
+from mlearn.data import pool_from, convert_docs, Dataset, Frame, iter_datasets
+from mlearn.neighbors import find_neighbors
 from mlearn.potentials.lammps.calcs import EnergyForceStress
 
 module_dir = os.path.dirname(__file__)
 soap_params = loadfn(os.path.join(module_dir, 'params', 'GAP.json'))
 
+_TYPE_CONVERT = {'R': np.float32, 'I': int, 'S': str}
+_KEY_VALUE_PATTERN = re.compile(r'([^\s=]+)=("[^"]*"|{[^}]*}|\S*)')
+
 
 class GAPotential(Potential):
     """
@@ -59,37 +66,37 @@ class GAPotential(Potential):
 
         Returns:
         """
-        full_virial_stress = [virial_stress[0], virial_stress[3], virial_stress[5],
-                              virial_stress[3], virial_stress[1], virial_stress[4],
-                              virial_stress[5], virial_stress[4], virial_stress[2]]
-
-        inputs = OrderedDict(Size=structure.num_sites,
-                             SuperCell=structure.lattice,
-                             AtomData=(structure, forces),
-                             Energy=energy,
-                             Stress=full_virial_stress)
-
-        lines = []
-        if 'Size' in inputs:
-            lines.append(str(inputs['Size']))
-
-        description = []
-        if 'Energy' in inputs:
-            description.append('dft_energy={}'.format(inputs['Energy']))
-        if 'Stress' in inputs:
-            description.append('dft_virial={%s}' %
-                               '\t'.join(list(map(lambda f: str(f), inputs['Stress']))))
-        if 'SuperCell' in inputs:
-            SuperCell_str = list(map(lambda f: str(f), inputs['SuperCell'].matrix.ravel()))
-            description.append('Lattice="{}"'.format('     '.join(SuperCell_str)))
-        description.append("Properties=species:S:1:pos:R:3:Z:I:1:dft_force:R:3")
-        lines.append(' '.join(description))
-
-        if 'AtomData' in inputs:
-            format_str = '{:<10s}{:>16f}{:>16f}{:>16f}{:>8d}{:>16f}{:>16f}{:>16f}'
-            for i, (site, force) in enumerate(zip(structure, forces)):
-                lines.append(format_str.format(site.species_string, *site.coords, site.specie.Z, *force))
-        return '\n'.join(lines)
+        return self._format_cfg(structure.lattice.matrix, structure.atomic_numbers,
+                                structure.cart_coords, forces, energy, virial_stress)
+
+    @staticmethod
+    def _format_cfg(lattice, species, positions, forces, energy, virial_stress):
+        """
+        Format the configuration from arrays, with the atom block of the
+        whole structure formatted at once.
+
+        Args:
+            lattice (np.array): The (3, 3) lattice matrix.
+            species (np.array): The (m, ) atomic numbers.
+            positions (np.array): The (m, 3) Cartesian coordinates.
+            forces (np.array): The (m, 3) forces.
+            energy (float): DFT-calculated energy of the system.
+            virial_stress (list): stress should has 6 distinct
+                elements arranged in order [xx, yy, zz, xy, yz, xz].
+        """
+        species = np.asarray(species, dtype=int)
+        symbols = {z: Element.from_Z(z).symbol for z in set(species.tolist())}
+        full_virial_stress = np.asarray(virial_stress)[[0, 3, 5, 3, 1, 4, 5, 4, 2]]
+        description = ['dft_energy={}'.format(energy),
+                       'dft_virial={%s}' % '\t'.join(map(str, full_virial_stress.tolist())),
+                       'Lattice="{}"'.format('     '.join(map(str, np.ravel(lattice).tolist()))),
+                       'Properties=species:S:1:pos:R:3:Z:I:1:dft_force:R:3']
+        forces = np.reshape(forces, (-1, 3))
+        atom_data = itertools.chain.from_iterable(zip(
+            [symbols[z] for z in species.tolist()], *np.transpose(positions).tolist(),
+            species.tolist(), *forces.T.tolist()))
+        return '%d\n%s' % (len(species), ' '.join(description)) + \
+            '\n%-10s%16f%16f%16f%8d%16f%16f%16f' * len(species) % tuple(atom_data)
 
     def write_cfgs(self, filename, cfg_pool):
         """
@@ -98,29 +105,87 @@ class GAPotential(Potential):
         Args:
             filename (str): The filename to be written.
             cfg_pool (list): The configuration pool contains
-                structure and energy/forces properties.
+                structure and energy/forces properties, which can also
+                be a generator of docs, e.g., from iter_docs, or a
+                Dataset.
         """
         if not filename.endswith('.xyz'):
             raise RuntimeError('The extended xyz file should end with ".xyz"')
 
-        lines = []
-        for dataset in cfg_pool:
-            if isinstance(dataset['structure'], dict):
-                structure = Structure.from_dict(dataset['structure'])
-            else:
-                structure = dataset['structure']
-            energy = dataset['outputs']['energy']
-            forces = dataset['outputs']['forces']
-            virial_stress = dataset['outputs']['virial_stress']
+        datasets = [cfg_pool] if isinstance(cfg_pool, Dataset) \
+            else iter_datasets(cfg_pool, batch_size=1000)
+        species = None
+        with io.open(filename, 'w', buffering=1 << 20) as f:
+            for dataset in datasets:
+                for i in range(len(dataset)):
+                    frame = dataset[i]
+                    if species is not None:
+                        f.write('\n')
+                    f.write(self._format_cfg(frame.lattice, frame.species, frame.positions,
+                                             frame.forces, float(frame.energy), frame.stress))
+                    species = frame.species
+
+        self.specie = Element.from_Z(int(species[0]))
 
-            lines.append(self._line_up(structure, energy, forces, virial_stress))
+        return filename
 
-        self.specie = Element(structure.symbol_set[0])
+    def iter_cfgs(self, filename, predict=False):
+        """
+        Lazily read the extended xyz file, with the key/values of each
+        comment line parsed once and the atom block converted into typed
+        columns as given in Properties.
 
-        with open(filename, 'w') as f:
-            f.write('\n'.join(lines))
+        Args:
+            filename (str): The configuration file to be read.
+            predict (bool): Whether to read the predicted forces instead
+                of the DFT forces.
 
-        return filename
+        Yields:
+            (Frame) The lattice, species, positions, energy, forces and
+            virial stress (in vasp order) of each configuration.
+        """
+        force_key = 'force' if predict else 'dft_force'
+        atomic_numbers = {}
+        with zopen(filename, 'rt') as f:
+            lines = (line[3:] if line.startswith('AT ') else line for line in f)
+            for line in lines:
+                if not line.strip().isdigit():
+                    continue
+                size = int(line)
+                info, energy = {}, None
+                for key, value in _KEY_VALUE_PATTERN.findall(next(lines)):
+                    info[key.lower()] = value.strip('"{}')
+                    if key in ('energy', 'dft_energy'):
+                        energy = float(info[key])
+                columns = np.array(' '.join(next(lines) for _ in range(size)).split()).reshape(size, -1)
+                properties = info['properties'].split(':')
+                data, column_index = {}, 0
+                for name, dtype, num_columns in zip(properties[::3], properties[1::3], properties[2::3]):
+                    num_columns = int(num_columns)
+                    data[name] = columns[:, column_index:column_index + num_columns].astype(_TYPE_CONVERT[dtype])
+                    column_index += num_columns
+                symbols = data['species'].ravel()
+                for symbol in set(symbols).difference(atomic_numbers):
+                    atomic_numbers[symbol] = Element(symbol).Z
+                virial_stress = np.array(info['dft_virial'].split(), dtype=float)
+                yield Frame(lattice=np.array(info['lattice'].split(), dtype=float).reshape(3, 3),
+                            species=np.array([atomic_numbers[symbol] for symbol in symbols], dtype=int),
+                            positions=data['pos'], energy=energy, forces=data[force_key],
+                            stress=virial_stress[[0, 4, 8, 1, 5, 6]])
+
+    def read_dataset(self, filename, predict=False):
+        """
+        Read the configuration file into Dataset.
+
+        Args:
+            filename (str): The configuration file to be read.
+            predict (bool): Whether to read the predicted forces instead
+                of the DFT forces.
+
+        Returns:
+            Dataset.
+        """
+        return Dataset.from_frames(self.iter_cfgs(filename, predict))
 
     def read_cfgs(self, filename, predict=False):
         """
@@ -129,64 +194,9 @@ class GAPotential(Potential):
         Args:
             filename (str): The configuration file to be read.
         """
-        type_convert = {'R': np.float32, 'I': np.int, 'S': np.str}
-        data_pool = []
-        with zopen(filename, 'rt') as f:
-            lines = f.read()
-        repl = re.compile('AT ')
-        lines = repl.sub('', string=lines)
-
-        block_pattern = re.compile(r'(\n[0-9]+\n|^[0-9]+\n)(.+?)(?=\n[0-9]+\n|$)', re.S)
-        lattice_pattern = re.compile(r'Lattice="(.+)"')
-        # energy_pattern = re.compile('dft_energy=(-?[0-9]+.[0-9]+)', re.I)
-        energy_pattern = re.compile(r'(?<=\S{3}\s|dft_)energy=(-?[0-9]+.[0-9]+)')
-        # stress_pattern = re.compile('dft_virial={(.+)}')
-        stress_pattern = re.compile(r'dft_virial=({|)(.+?)(}|) \S.*')
-        properties_pattern = re.compile(r'properties=(\S+)', re.I)
-        # position_pattern = re.compile('\n(.+)', re.S)
-        position_pattern = re.compile('\n(.+?)(?=\nE.*|\n\n.*|$)', re.S)
-        # formatify = lambda string: [float(s) for s in string.split()]
-
-        for (size, block) in block_pattern.findall(lines):
-            d = {'outputs': {}}
-            size = int(size)
-            lattice_str = lattice_pattern.findall(block)[0]
-            lattice = Lattice(list(map(lambda s: float(s), lattice_str.split())))
-            # energy_str = energy_pattern.findall(block)[0]
-            energy_str = energy_pattern.findall(block)[-1]
-            energy = float(energy_str)
-            # stress_str = stress_pattern.findall(block)[0]
-            stress_str = stress_pattern.findall(block)[0][1]
-            virial_stress = np.array(list(map(lambda s: float(s), stress_str.split())))
-            virial_stress = [virial_stress[i] for i in [0, 4, 8, 1, 5, 6]]
-            properties = properties_pattern.findall(block)[0].split(":")
-            labels_columns = OrderedDict()
-            labels = defaultdict()
-            for i in range(0, len(properties), 3):
-                labels_columns[properties[i]] = [int(properties[i + 2]), properties[i + 1]]
-            position_str = position_pattern.findall(block)[0].split('\n')
-            position = np.array([p.split() for p in position_str])
-            column_index = 0
-            for key in labels_columns:
-                num_columns, dtype = labels_columns[key]
-                labels[key] = position[:, column_index: column_index + num_columns].astype(type_convert[dtype])
-                column_index += num_columns
-            struct = Structure(lattice=lattice, species=labels['species'].ravel(),
-                               coords=labels['pos'], coords_are_cartesian=True)
-            if predict:
-                forces = labels['force']
-            else:
-                forces = labels['dft_force']
-            d['structure'] = struct.as_dict()
-            d['outputs']['energy'] = energy
-            assert size == struct.num_sites
-            d['num_atoms'] = size
-            d['outputs']['forces'] = forces
-            d['outputs']['virial_stress'] = virial_stress
-
-            data_pool.append(d)
-        _, df = convert_docs(docs=data_pool)
-        return data_pool, df
+        dataset = self.read_dataset(filename, predict)
+        _, df = convert_docs(dataset, return_structures=False)
+        return dataset.to_docs(), df
 
     def train(self, train_structures, energies=None, forces=None, stresses=None,
               default_sigma=[0.0005, 0.1, 0.05, 0.01],
@@ -320,6 +330,18 @@ class GAPotential(Potential):
 
         return rc
 
+    def param_hash(self):
+        """
+        Content hash of xml and sparse points of the potential.
+        """
+        if not self.param:
+            return None
+        xml = ET.tostring(self.param.get('xml').getroot()).decode('utf-8')
+        xml = re.sub(r'sparseX_filename="[^"]*"', '', xml)
+        return hash_params([self.__class__.__name__, self.name, str(self.specie),
+                            self.param.get('potential_label'), xml],
+                           np.asarray(self.param.get('param')))
+
     def write_param(self, xml_filename='gap.xml'):
         """
         Write xml file to perform lammps calculation.
@@ -377,7 +399,7 @@ class GAPotential(Potential):
         with ScratchDir('.'):
             _ = self.write_param(xml_file)
             original_file = self.write_cfgs(original_file, cfg_pool=predict_pool)
-            _, df_orig = self.read_cfgs(original_file)
+            _, df_orig = convert_docs(self.read_dataset(original_file), return_structures=False)
 
             exe_command = ["quip"]
             exe_command.append("atoms_filename={}".format(original_file))
@@ -392,21 +414,28 @@ class GAPotential(Potential):
             p = subprocess.Popen(exe_command, stdout=open(predict_file, 'w'))
             p.communicate()[0]
 
-            _, df_predict = self.read_cfgs(predict_file, predict=True)
+            _, df_predict = convert_docs(self.read_dataset(predict_file, predict=True),
+                                         return_structures=False)
 
         return df_orig, df_predict
 
-    def predict(self, structure):
+    def predict(self, structure, backend='subprocess'):
         """
         Predict energy, forces and stresses of the structure.
 
         Args:
             structure (Structure): Pymatgen Structure object.
+            backend (str): 'subprocess' or 'library' runs LAMMPS through
+                EnergyForceStress, 'numpy' uses the native GAPCalculator.
+                Default to 'subprocess'.
 
         Returns:
             energy, forces, stress
         """
-        calculator = EnergyForceStress(self)
+        if backend == 'numpy':
+            calculator = GAPCalculator(self)
+        else:
+            calculator = EnergyForceStress(ff_settings=self, backend=backend)
         energy, forces, stress = calculator.calculate(structures=[structure])[0]
         return energy, forces, stress
 
@@ -448,9 +477,277 @@ class GAPotential(Potential):
                 potential_label = root.tag
                 gpcoordinates = list(root.iter('gpCoordinates'))[0]
                 param_file = gpcoordinates.get('sparseX_filename')
-                param = np.loadtxt(param_file)
+                param = np.loadtxt(os.path.join(os.path.dirname(xml_file), param_file))
                 return tree, param, potential_label
 
             tree, param, potential_label = get_xml(filename)
             parameters = dict(xml=tree, param=param, potential_label=potential_label)
             return GAPotential(param=parameters)
+
+
+def _real_harmonics(unit_vectors, l_max):
+    """
+    Real spherical harmonics and their gradients with respect to the
+    (unnormalized) vectors, built from the recursions of the associated
+    Legendre polynomials and of (x + iy)^m.
+
+    Args:
+        unit_vectors (np.ndarray): Unit vectors with shape (P, 3).
+        l_max (int): Band limit.
+
+    Returns:
+        Harmonics with shape (P, (l_max + 1) ** 2) indexed by
+        l ** 2 + l + m, and their gradients on the unit sphere with
+        shape (P, 3, (l_max + 1) ** 2), to be divided by the norms.
+    """
+    x, y, z = unit_vectors.T
+    ones, zeros = np.ones_like(z), np.zeros_like(z)
+    cos_m, sin_m = [ones], [zeros]
+    for m in range(1, l_max + 1):
+        cos_m.append(x * cos_m[-1] - y * sin_m[-1])
+        sin_m.append(x * sin_m[-1] + y * cos_m[-2])
+    values = np.zeros((len(z), (l_max + 1) ** 2))
+    grads = np.zeros((len(z), 3, (l_max + 1) ** 2))
+    for m in range(l_max + 1):
+        # associated Legendre polynomials q_l^m(z) and dq_l^m / dz for l >= m
+        q = {m: (-1) ** m * np.prod(np.arange(2 * m - 1, 0, -2, dtype=float)) * ones}
+        dq = {m: zeros}
+        if m < l_max:
+            q[m + 1], dq[m + 1] = (2 * m + 1) * z * q[m], (2 * m + 1) * q[m]
+        for l in range(m + 2, l_max + 1):
+            q[l] = ((2 * l - 1) * z * q[l - 1] - (l + m - 1) * q[l - 2]) / (l - m)
+            dq[l] = ((2 * l - 1) * (q[l - 1] + z * dq[l - 1]) - (l + m - 1) * dq[l - 2]) / (l - m)
+        for l in range(m, l_max + 1):
+            norm = math.sqrt((2 * l + 1) / (4 * math.pi) * math.factorial(l - m) / math.factorial(l + m))
+            if m == 0:
+                values[:, l * l + l] = norm * q[l]
+                grads[:, 2, l * l + l] = norm * dq[l]
+                continue
+            norm *= math.sqrt(2.0)
+            for sign, phi, dphi_dx, dphi_dy in [(1, cos_m[m], m * cos_m[m - 1], -m * sin_m[m - 1]),
+                                                (-1, sin_m[m], m * sin_m[m - 1], m * cos_m[m - 1])]:
+                k = l * l + l + sign * m
+                values[:, k] = norm * q[l] * phi
+                grads[:, 0, k] = norm * q[l] * dphi_dx
+                grads[:, 1, k] = norm * q[l] * dphi_dy
+                grads[:, 2, k] = norm * dq[l] * phi
+    # project out the radial components
+    grads -= unit_vectors[:, :, None] * np.einsum('pd,pdk->pk', unit_vectors, grads)[:, None, :]
+    return values, grads
+
+
+class GAPCalculator(object):
+    """
+    Native NumPy predictor of the SOAP-GAP with the dot product kernel
+    evaluated by QUIP, serving the same outputs as EnergyForceStress with
+    GAPotential without running LAMMPS or quip. The xml is parsed once,
+    the SOAP power spectra of all atoms are computed at once and the
+    kernels against the sparse points are a single matrix product.
+
+    Usage:
+        [(energy, forces, stress)] = calculator.calculate([Structure])
+        energy in eV, forces in eV/Å and stress in GPa with the order
+        xx, yy, zz, xy, xz, yz, with the atomic coordinates transformed
+        into the LAMMPS box frame as EnergyForceStress does.
+
+    """
+
+    def __init__(self, potential, max_size=4000000):
+        """
+        Args:
+            potential (GAPotential): GAP with a single soap descriptor,
+                e.g., loaded by GAPotential.from_config.
+            max_size (int): Max No. of floats held for the neighbor terms
+                of a chunk of atoms, which bounds the memory usage.
+                Default to 4000000.
+        """
+        if not potential.param:
+            raise RuntimeError("The xml and parameters should be provided.")
+        root = potential.param['xml'].getroot()
+        gp_coordinates = list(root.iter('gpCoordinates'))
+        if len(gp_coordinates) != 1:
+            raise ValueError('Only GAP with a single descriptor is supported.')
+        gp = gp_coordinates[0]
+        descriptor = gp.find('descriptor').text.split()
+        params = dict(_KEY_VALUE_PATTERN.findall(' '.join(descriptor[1:])))
+        if descriptor[0] != 'soap':
+            raise ValueError('Unsupported descriptor %s' % descriptor[0])
+        if int(gp.get('covariance_type')) != 2:
+            raise ValueError('Only the dot product covariance is supported.')
+        if int(params.get('n_species', 1)) != 1 or params.get('diagonal_radial', 'F').upper()[0] == 'T':
+            raise ValueError('Only single species SOAP with full radial '
+                             'couplings is supported.')
+
+        self.l_max, self.n_max = int(params['l_max']), int(params['n_max'])
+        self.cutoff = float(params['cutoff'])
+        self.transition_width = float(params.get('cutoff_transition_width', 0.5))
+        self.normalise = params.get('normalise', 'T').upper()[0] == 'T'
+        self.sigma0 = float(params.get('covariance_sigma0', 0.0))
+        self.zeta = float(gp.get('zeta'))
+        self.delta = float(gp.get('signal_variance'))
+        self.e0 = {int(e.get('Z')): float(e.get('value')) for e in root.iter('e0')}
+        sparse_x = sorted(gp.iter('sparseX'), key=lambda e: int(e.get('i')))
+        self.alpha = np.array([float(e.get('alpha')) for e in sparse_x])
+        self.sparse_points = np.reshape(potential.param['param'], (len(sparse_x), -1))
+        n_pairs = self.n_max * (self.n_max + 1) // 2
+        if self.sparse_points.shape[1] != n_pairs * (self.l_max + 1) + 1:
+            raise ValueError('Dimensions of sparse points do not match the descriptor.')
+        self.max_size = max_size
+
+        # Gaussian radial basis with the width of the atomic Gaussians, the
+        # expansion by interpolation on the centers is orthonormalized by the
+        # Cholesky factor of the overlap matrix as QUIP does
+        sigma = float(params.get('atom_sigma', params.get('atom_gaussian_width', 0.0)))
+        self.a = 0.5 / sigma ** 2
+        basis_error_exponent = float(params.get('basis_error_exponent', 10.0))
+        self.r_basis = np.arange(self.n_max) * (self.cutoff + math.sqrt(basis_error_exponent
+                                                                        * math.log(10.0) / self.a)) / self.n_max
+        ri, rj = self.r_basis[:, None], self.r_basis[None, :]
+        covariance = np.exp(-self.a * (ri - rj) ** 2)
+        overlap = (np.exp(-self.a * (ri ** 2 + rj ** 2)) * math.sqrt(2.0) * self.a ** 1.5 * (ri + rj)
+                   + self.a * np.exp(-0.5 * self.a * (ri - rj) ** 2) * math.sqrt(math.pi)
+                   * (1.0 + self.a * (ri + rj) ** 2)
+                   * (1.0 + np.vectorize(math.erf)(math.sqrt(self.a / 2.0) * (ri + rj)))) \
+            / math.sqrt(128.0 * self.a ** 5)
+        self.transform = np.linalg.solve(covariance, np.linalg.cholesky(overlap))
+        self.central = float(params.get('central_weight', 1.0)) / math.sqrt(4 * math.pi) \
+            * np.dot(np.exp(-self.a * self.r_basis ** 2), self.transform)
+
+        self.l_index = np.repeat(np.arange(self.l_max + 1), 2 * np.arange(self.l_max + 1) + 1)
+        self.rows, self.cols = np.tril_indices(self.n_max)
+        # off-diagonal radial couplings are counted twice, and each channel
+        # is scaled by 1 / sqrt(2l + 1)
+        self.weights = (np.where(self.rows == self.cols, 1.0, math.sqrt(2.0))[:, None]
+                        / np.sqrt(2 * np.arange(self.l_max + 1) + 1.0)).ravel()
+
+    def _cutoff(self, r):
+        """
+        Cosine transition to zero within cutoff_transition_width of cutoff.
+        """
+        x = np.clip((r - self.cutoff + self.transition_width) / self.transition_width, 0.0, 1.0)
+        fc = 0.5 * (np.cos(np.pi * x) + 1.0)
+        dfc = np.where((x > 0) & (x < 1), -0.5 * np.pi / self.transition_width * np.sin(np.pi * x), 0.0)
+        return fc, dfc
+
+    def _radial(self, r):
+        """
+        Radial coefficients of the atomic Gaussians at distances r, i.e.,
+        exp(-a(r^2 + r_n^2)) i_l(2a r r_n) with the modified spherical
+        Bessel functions by upward recursion, in the orthonormal basis.
+
+        Returns:
+            Coefficients and derivatives with shape (P, l_max + 1, n_max).
+        """
+        a, rb = self.a, self.r_basis[None, :]
+        r = r[:, None]
+        arg = 2 * a * r * rb
+        darg = 2 * a * rb
+        at_origin = arg == 0
+        arg = np.where(at_origin, 1.0, arg)
+        exp_m, exp_p = np.exp(-a * (r - rb) ** 2), np.exp(-a * (r + rb) ** 2)
+        dexp_m, dexp_p = -2 * a * (r - rb) * exp_m, -2 * a * (r + rb) * exp_p
+        values = np.zeros((len(r), self.l_max + 1, self.n_max))
+        grads = np.zeros_like(values)
+        values[:, 0] = 0.5 * (exp_m - exp_p) / arg
+        grads[:, 0] = 0.5 * (dexp_m - dexp_p) / arg - values[:, 0] * darg / arg
+        if self.l_max > 0:
+            values[:, 1] = 0.5 * (exp_m + exp_p) / arg - 0.5 * (exp_m - exp_p) / arg ** 2
+            grads[:, 1] = 0.5 * (dexp_m + dexp_p) / arg - 0.5 * (exp_m + exp_p) * darg / arg ** 2 \
+                - 0.5 * (dexp_m - dexp_p) / arg ** 2 + (exp_m - exp_p) * darg / arg ** 3
+        for l in range(2, self.l_max + 1):
+            values[:, l] = values[:, l - 2] - (2 * l - 1) / arg * values[:, l - 1]
+            grads[:, l] = grads[:, l - 2] - (2 * l - 1) * (grads[:, l - 1] / arg
+                                                           - values[:, l - 1] * darg / arg ** 2)
+        # limits at the basis center at the origin
+        gaussian = np.exp(-a * (r ** 2 + rb ** 2))
+        values[:, 0] = np.where(at_origin, gaussian, values[:, 0])
+        grads[:, 0] = np.where(at_origin, -2 * a * r * gaussian, grads[:, 0])
+        values[:, 1:] *= ~at_origin[:, None, :]
+        grads[:, 1:] *= ~at_origin[:, None, :]
+        return np.dot(values, self.transform), np.dot(grads, self.transform)
+
+    def _power_spectrum(self, fourier):
+        """
+        Power spectra of the expansion coefficients with shape
+        (n_atoms, (l_max + 1) ** 2, n_max), in the order of n1, n2 <= n1
+        and l as QUIP does.
+        """
+        power = np.stack([np.einsum('ima,imb->iab', fourier[:, l * l:(l + 1) ** 2],
+                                    fourier[:, l * l:(l + 1) ** 2])[:, self.rows, self.cols]
+                          for l in range(self.l_max + 1)], axis=-1)
+        return power.reshape(len(fourier), -1) * self.weights
+
+    def _calculate(self, structure, lammps_frame=True):
+        matrix = structure.lattice.matrix
+        if lammps_frame:
+            _, symmop = lattice_2_lmpbox(structure.lattice)
+            matrix = np.dot(matrix, symmop.rotation_matrix.T)
+        coords = np.dot(structure.frac_coords % 1.0, matrix)
+        n_atoms, n_lm = len(structure), (self.l_max + 1) ** 2
+
+        centers, neighbors, _, vectors, bounds = find_neighbors(coords, matrix, self.cutoff)
+        n_neighbors = len(centers) / max(1, n_atoms)
+        chunk = max(1, int(self.max_size // max(1.0, 4 * n_neighbors * n_lm * self.n_max)))
+        energy = sum(self.e0.get(z, 0.0) for z in structure.atomic_numbers)
+        grads = np.zeros((len(centers), 3))
+        for start in range(0, n_atoms, chunk):
+            stop = min(start + chunk, n_atoms)
+            pairs = slice(bounds[start], bounds[stop])
+            local = centers[pairs] - start
+            distances = np.linalg.norm(vectors[pairs], axis=1)
+            units = vectors[pairs] / distances[:, None]
+            fc, dfc = self._cutoff(distances)
+            c, dc = self._radial(distances)
+            c, dc = c[:, self.l_index], dc[:, self.l_index]
+            y, dy = _real_harmonics(units, self.l_max)
+
+            fourier = np.zeros((stop - start, n_lm, self.n_max))
+            fourier[:, 0] = self.central
+            np.add.at(fourier, local, (fc[:, None] * y)[:, :, None] * c)
+            power = self._power_spectrum(fourier)
+            norm = np.linalg.norm(power, axis=1)[:, None] if self.normalise else 1.0
+            q = power / norm
+
+            # dot product kernels against all sparse points at once
+            dots = np.dot(q, self.sparse_points[:, :-1].T) + self.sigma0 * self.sparse_points[:, -1]
+            energy += self.delta ** 2 * np.sum(np.dot(dots ** self.zeta, self.alpha))
+
+            dq = self.delta ** 2 * self.zeta * np.dot(dots ** (self.zeta - 1) * self.alpha,
+                                                      self.sparse_points[:, :-1])
+            if self.normalise:
+                dq = (dq - q * np.sum(q * dq, axis=1)[:, None]) / norm
+            # derivatives with respect to the expansion coefficients
+            half = np.zeros((stop - start, self.l_max + 1, self.n_max, self.n_max))
+            half[:, :, self.rows, self.cols] = (dq * self.weights).reshape(stop - start, -1,
+                                                                           self.l_max + 1).transpose(0, 2, 1)
+            half += half.transpose(0, 1, 3, 2)
+            dfourier = np.einsum('imab,imb->ima', half[:, self.l_index], fourier)[local]
+
+            s = np.einsum('pma,pma->pm', dfourier, c)
+            t = np.einsum('pma,pma->pm', dfourier, dc)
+            radial = np.sum((dfc[:, None] * s + fc[:, None] * t) * y, axis=1)
+            grads[pairs] = radial[:, None] * units \
+                + np.einsum('pdm,pm->pd', dy, fc[:, None] * s) / distances[:, None]
+
+        forces = np.zeros((n_atoms, 3))
+        np.add.at(forces, centers, grads)
+        np.subtract.at(forces, neighbors, grads)
+        virial = -np.dot(vectors.T, grads) / abs(np.linalg.det(matrix))
+        stress = virial[[0, 1, 2, 0, 0, 1], [0, 1, 2, 1, 2, 2]] * 160.21766208  # from eV/Å^3 to GPa
+        return energy, forces, stress
+
+    def calculate(self, structures, lammps_frame=True):
+        """
+        Calculate the energy, forces and stresses of structures.
+
+        Args:
+            structures ([Structure]): Input structures.
+            lammps_frame (bool): Whether to transform the structures into
+                the LAMMPS box frame as EnergyForceStress does. Default to
+                True, otherwise forces and stresses are in the Cartesian
+                frame of the structures.
+
+        Returns:
+            List of (energy, forces, stress) of each structure.
+        """
+        return [self._calculate(structure, lammps_frame) for structure in structures]
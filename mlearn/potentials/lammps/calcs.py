@@ -10,16 +10,36 @@ from __future__ import division, print_function, unicode_literals, \
 import os
 import abc
 import io
+import json
+import ctypes
+import re
+import shutil
+import tempfile
 import subprocess
-import itertools
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+try:
+    import fcntl
+except ImportError:
+    # no locking of the potential cache without fcntl, e.g., on Windows
+    fcntl = None
 
 import six
 import numpy as np
+import pandas as pd
+from monty.os import cd
 from monty.tempfile import ScratchDir
 from mlearn.potentials import Potential
-from pymatgen.io.lammps.data import LammpsData
+from pymatgen.io.lammps.data import LammpsData, lattice_2_lmpbox
 from pymatgen import Structure, Lattice, Element
 
+POTENTIAL_CACHE_DIR = os.environ.get(
+    'MLEARN_POTENTIAL_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'mlearn', 'potentials'))
+POTENTIAL_CACHE_SIZE = int(os.environ.get('MLEARN_POTENTIAL_CACHE_SIZE', 1 << 30))
+_FF_SETTINGS_FILE = 'ff_settings.json'
+
 _sort_elements = lambda symbols: [e.symbol for e in
                                   sorted([Element(e) for e in symbols])]
 
@@ -36,10 +56,424 @@ def _pretty_input(lines):
     return '\n'.join(new_lines)
 
 
-def _read_dump(file_name, dtype='float_'):
+_DUMP_HEADER = re.compile(r'ITEM: TIMESTEP\n\s*(-?\d+)\s*\nITEM: NUMBER OF ATOMS\n'
+                          r'\s*(\d+)\s*\nITEM: BOX BOUNDS[^\n]*\n(?:[^\n]*\n){3}'
+                          r'ITEM: ATOMS([^\n]*)\n')
+
+
+def _parse_dump_body(body, n_columns, dtype):
+    if len(body.strip()) == 0:
+        return np.zeros((0, n_columns), dtype=dtype)
+    is_text = np.dtype(dtype).kind in 'SU'
+    df = pd.read_csv(io.StringIO(body), sep=r'\s+', header=None, engine='c',
+                     dtype=str if is_text else None)
+    return df.values.astype(dtype)
+
+
+def _read_dumps(file_name, dtype=float):
+    """
+    Read a (multi-frame) text dump file, e.g. the one appended by a batched
+    run, and return the per-atom data of each frame in a list. The number of
+    atoms and the columns are taken from the header of each frame, and the
+    bodies of all frames are parsed in one pass with the C engine of pandas.
+    Like np.loadtxt, data with a single row or column is squeezed.
+
+    """
     with open(file_name) as f:
-        lines = f.readlines()[9:]
-    return np.loadtxt(io.StringIO(''.join(lines)), dtype=dtype)
+        text = f.read()
+    headers = list(_DUMP_HEADER.finditer(text))
+    natoms = [int(m.group(2)) for m in headers]
+    columns = [m.group(3).split() for m in headers]
+    ends = [m.start() for m in headers[1:]] + [len(text)]
+    bodies = [text[m.end():end] for m, end in zip(headers, ends)]
+    if len(set(len(c) for c in columns)) > 1:
+        data = [_parse_dump_body(body, len(c), dtype)
+                for body, c in zip(bodies, columns)]
+    else:
+        n_columns = len(columns[0]) if columns else 0
+        data = np.split(_parse_dump_body(''.join(bodies), n_columns, dtype),
+                        np.cumsum(natoms)[:-1])
+    for frame, n, c in zip(data, natoms, columns):
+        if frame.shape != (n, len(c)):
+            raise ValueError('Dump frame with {} atoms and {} columns expected '
+                             'in {}, got shape {}'.format(n, len(c), file_name,
+                                                          frame.shape))
+    return [np.squeeze(frame) for frame in data]
+
+
+def _read_dump(file_name, dtype=float):
+    return _read_dumps(file_name, dtype)[0]
+
+
+def _read_binary_dumps(file_name):
+    """
+    Read a binary dump file written by LAMMPS dump custom with '.bin'
+    suffix, supporting both the legacy header and the newer header with
+    magic string, and return the per-atom data of each frame in a list.
+    The numeric payload is read directly into NumPy arrays.
+
+    """
+    frames = []
+    with open(file_name, 'rb') as f:
+        while True:
+            ntimestep = np.fromfile(f, dtype=np.int64, count=1)
+            if len(ntimestep) == 0:
+                break
+            revision = 0
+            if ntimestep[0] < 0:
+                # negative timestep marks the header with magic string
+                f.seek(-int(ntimestep[0]), os.SEEK_CUR)
+                _, revision = np.fromfile(f, dtype=np.int32, count=2)
+                np.fromfile(f, dtype=np.int64, count=1)
+            natoms = int(np.fromfile(f, dtype=np.int64, count=1)[0])
+            triclinic = int(np.fromfile(f, dtype=np.int32, count=1)[0])
+            n_box = {0: 6, 1: 9, 2: 12}[triclinic]
+            f.seek(6 * 4 + n_box * 8, os.SEEK_CUR)
+            size_one = int(np.fromfile(f, dtype=np.int32, count=1)[0])
+            if revision > 1:
+                # unit style, time and column names
+                unit_len = int(np.fromfile(f, dtype=np.int32, count=1)[0])
+                f.seek(unit_len, os.SEEK_CUR)
+                if f.read(1) != b'\x00':
+                    f.seek(8, os.SEEK_CUR)
+                columns_len = int(np.fromfile(f, dtype=np.int32, count=1)[0])
+                f.seek(columns_len, os.SEEK_CUR)
+            nchunk = int(np.fromfile(f, dtype=np.int32, count=1)[0])
+            chunks = []
+            for _ in range(nchunk):
+                n = int(np.fromfile(f, dtype=np.int32, count=1)[0])
+                chunks.append(np.fromfile(f, dtype=np.float64, count=n))
+            data = np.concatenate(chunks) if len(chunks) > 0 else np.zeros(0)
+            frames.append(data.reshape(natoms, size_one))
+    return frames
+
+
+def _batch_input(input_file, n_structures):
+    """
+    Wrap a single-structure input script into a LAMMPS loop over
+    data.static.1 ... data.static.N, so that N structures are computed
+    within one LAMMPS process. Dumps and prints of each iteration are
+    appended to the original output files, with the dump frames tagged
+    by the structure index as timestep.
+
+    Args:
+        input_file (str): Input script written by _setup.
+        n_structures (int): No. of structures in the batch.
+
+    Returns:
+        Name of the batched input script and the list of output files.
+
+    """
+    with open(input_file) as f:
+        lines = [l.strip() for l in f.readlines()]
+    commands = ['variable sid loop {}'.format(n_structures),
+                'label batch_loop',
+                'clear']
+    outputs = []
+    for line in lines:
+        args = line.split()
+        if len(args) == 0 or args[0] == 'clear':
+            continue
+        if args[0] == 'read_data' and args[1] == 'data.static':
+            commands.append('read_data data.static.${sid}')
+            commands.append('reset_timestep ${sid}')
+        elif args[0] == 'dump':
+            commands.append(line)
+            commands.append('dump_modify {} append yes'.format(args[1]))
+            outputs.append(args[5])
+        elif args[0] == 'print' and 'file' in args:
+            idx = len(args) - 1 - args[::-1].index('file')
+            outputs.append(args[idx + 1])
+            commands.append(re.sub(r'\bfile(\s+\S+)\s*$', r'append\1', line))
+        else:
+            commands.append(line)
+    commands.extend(['next sid', 'jump SELF batch_loop'])
+    batch_file = 'in.batch'
+    with open(batch_file, 'w') as f:
+        f.write(_pretty_input(commands))
+    return batch_file, outputs
+
+
+@contextmanager
+def _potential_cache_lock(exclusive=False):
+    """
+    Lock of POTENTIAL_CACHE_DIR across processes, held shared while
+    entries are looked up, written and linked, and exclusive while
+    entries are evicted.
+
+    """
+    os.makedirs(POTENTIAL_CACHE_DIR, exist_ok=True)
+    with open(os.path.join(POTENTIAL_CACHE_DIR, '.lock'), 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        # released on closing the file
+        yield
+
+
+def _evict_potential_cache(keep):
+    """
+    Remove least recently used entries of POTENTIAL_CACHE_DIR until the
+    total size is within POTENTIAL_CACHE_SIZE bytes, together with the
+    temporary directories left by interrupted writers.
+
+    Args:
+        keep (str): Key of the entry in use, which is never removed.
+
+    """
+    with _potential_cache_lock(exclusive=True):
+        entries, total = [], 0
+        for name in os.listdir(POTENTIAL_CACHE_DIR):
+            path = os.path.join(POTENTIAL_CACHE_DIR, name)
+            if name.startswith('tmp'):
+                # writers hold the shared lock, so no one is writing here
+                shutil.rmtree(path, ignore_errors=True)
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                # the lock file
+                continue
+            total += size
+            if name != keep:
+                entries.append((mtime, size, name))
+        for _, size, name in sorted(entries):
+            if total <= POTENTIAL_CACHE_SIZE:
+                break
+            shutil.rmtree(os.path.join(POTENTIAL_CACHE_DIR, name), ignore_errors=True)
+            total -= size
+
+
+def _write_ff_settings(ff_settings):
+    """
+    Get the force field settings, with the potential files written in
+    current directory. Files written by Potential.write_param are cached
+    in POTENTIAL_CACHE_DIR, keyed by the content hash of the potential
+    parameters, and hard linked (or copied if linking is not possible)
+    into current directory, so that each set of parameters is written
+    only once. Least recently used entries are evicted once the cache
+    exceeds POTENTIAL_CACHE_SIZE bytes, which does not affect the files
+    linked before.
+
+    Args:
+        ff_settings (list/Potential): Force field settings or Potential.
+
+    Returns:
+        List of force field setting commands.
+
+    """
+    if not isinstance(ff_settings, Potential):
+        return ff_settings
+    key = ff_settings.param_hash()
+    if key is None:
+        return ff_settings.write_param()
+    cache_dir = os.path.join(POTENTIAL_CACHE_DIR, key)
+    # entries are not evicted between the lookup and the linking
+    with _potential_cache_lock():
+        created = not os.path.isdir(cache_dir)
+        if created:
+            temp_dir = tempfile.mkdtemp(dir=POTENTIAL_CACHE_DIR)
+            with cd(temp_dir):
+                settings = ff_settings.write_param()
+                with open(_FF_SETTINGS_FILE, 'w') as f:
+                    json.dump(list(settings), f)
+            try:
+                os.rename(temp_dir, cache_dir)
+            except OSError:
+                # the same parameters have been cached by another process.
+                shutil.rmtree(temp_dir, ignore_errors=True)
+        else:
+            # access time as modification time for LRU eviction
+            os.utime(cache_dir, None)
+        with open(os.path.join(cache_dir, _FF_SETTINGS_FILE)) as f:
+            settings = json.load(f)
+        for filename in os.listdir(cache_dir):
+            if filename == _FF_SETTINGS_FILE:
+                continue
+            src = os.path.join(cache_dir, filename)
+            if os.path.lexists(filename):
+                os.remove(filename)
+            try:
+                os.link(src, filename)
+            except (OSError, NotImplementedError):
+                shutil.copy(src, filename)
+    if created:
+        _evict_potential_cache(keep=key)
+    return settings
+
+
+def _run_lammps(cmd):
+    """
+    Run LAMMPS command, raise RuntimeError with the error message from
+    LAMMPS output if the run fails.
+
+    """
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    stdout = p.communicate()[0]
+    rc = p.returncode
+    if rc != 0:
+        error_msg = 'LAMMPS exited with return code %d' % rc
+        msg = stdout.decode("utf-8").split('\n')[:-1]
+        try:
+            error_line = [i for i, m in enumerate(msg)
+                          if m.startswith('ERROR')][0]
+            error_msg += ', '.join([e for e in msg[error_line:]])
+        except Exception:
+            error_msg += msg[-1]
+        raise RuntimeError(error_msg)
+    return stdout
+
+
+def _calculate_shard(calculator, structures, batch_size):
+    """
+    Worker function computing a shard of structures in a separate process.
+
+    """
+    return calculator.calculate(structures, batch_size=batch_size)
+
+
+class LMPSession(object):
+    """
+    Persistent LAMMPS instance driven through the LAMMPS Python library
+    interface. The force field (or compute) commands are issued only once,
+    afterwards structures are pushed into the instance and results are
+    extracted as NumPy arrays, without any input or dump files.
+
+    Commands are issued in a private working directory (work_dir), where
+    the potential files referred to are expected to be written.
+
+    """
+
+    def __init__(self, elements, cmdargs=('-screen', 'none', '-log', 'none')):
+        """
+        Args:
+            elements ([str]): Elements in order of LAMMPS atom types.
+            cmdargs (tuple): Command line arguments of LAMMPS instance.
+
+        """
+        from lammps import lammps
+        self.elements = list(elements)
+        self.work_dir = tempfile.mkdtemp()
+        self.lmp = lammps(cmdargs=list(cmdargs))
+        self._types = None
+        self._timestep = 0
+        init_cmds = ['units metal',
+                     'atom_style charge',
+                     'atom_modify map array',
+                     'boundary p p p']
+        box_cmds = ['region box prism 0 1 0 1 0 1 0 0 0',
+                    'create_box {} box'.format(len(self.elements))]
+        box_cmds += ['mass {} {}'.format(i + 1, float(Element(e).atomic_mass))
+                     for i, e in enumerate(self.elements)]
+        self.command(init_cmds)
+        try:
+            self.command(['box tilt large'])
+        except Exception:
+            # box command is removed in newer LAMMPS, where large tilt is allowed.
+            pass
+        self.command(box_cmds)
+
+    def command(self, commands):
+        """
+        Issue LAMMPS commands.
+
+        Args:
+            commands ([str]): LAMMPS commands.
+
+        """
+        with cd(self.work_dir):
+            for c in commands:
+                self.lmp.command(c)
+
+    def set_structure(self, structure):
+        """
+        Replace the box and atoms with the structure. Atoms are
+        arranged in the same way as LammpsData.from_structure, i.e.,
+        sorted structure rotated into LAMMPS box.
+
+        Args:
+            structure (Structure): Input structure.
+
+        Returns:
+            List of element of each atom, in order of atom ids.
+
+        """
+        s = structure.get_sorted_structure()
+        box, symmop = lattice_2_lmpbox(s.lattice)
+        lattice = box.to_lattice()
+        frac_coords = lattice.get_fractional_coords(symmop.operate_multi(s.cart_coords))
+        bounds = np.array(box.bounds)
+        coords = lattice.get_cartesian_coords(frac_coords % 1.0) + bounds[:, 0]
+        xy, xz, yz = box.tilt if box.tilt is not None else (0, 0, 0)
+        types = [self.elements.index(sp.symbol) + 1 for sp in s.species]
+
+        if types == self._types:
+            change_box = 'change_box all x final {} {} y final {} {} z final {} {} ' \
+                         'xy final {} xz final {} yz final {}'
+            self.command([change_box.format(*(list(bounds.ravel()) + [xy, xz, yz]))])
+            x = coords.ravel()
+            self.lmp.scatter_atoms('x', 1, 3, (len(x) * ctypes.c_double)(*x))
+        else:
+            if self._types is not None:
+                self.command(['delete_atoms group all'])
+            self.lmp.reset_box(list(bounds[:, 0]), list(bounds[:, 1]), xy, yz, xz)
+            self.lmp.create_atoms(len(s), list(range(1, len(s) + 1)), types,
+                                  list(coords.ravel()))
+            self._types = types
+        return [self.elements[t - 1] for t in types]
+
+    def run(self):
+        """
+        Run 0 on the current structure at a new timestep. Computes are
+        only re-invoked when the timestep has changed, so repeated runs
+        at the same timestep would leave stale per-atom results behind.
+
+        """
+        self._timestep += 1
+        self.command(['reset_timestep {}'.format(self._timestep), 'run 0'])
+
+    def extract_atom(self, name):
+        """
+        Extract per-atom property as NumPy array, in order of atom ids.
+
+        """
+        nlocal = self.lmp.extract_global('nlocal')
+        ids = np.array(self.lmp.numpy.extract_atom('id', nelem=nlocal))
+        values = np.array(self.lmp.numpy.extract_atom(name, nelem=nlocal))
+        return values[np.argsort(ids)]
+
+    def extract_compute(self, compute_id, style, dtype):
+        """
+        Extract compute results as NumPy array, per-atom results in
+        order of atom ids. Refer to lammps.extract_compute for style
+        (0: global, 1: per-atom) and dtype (0: scalar, 1: vector,
+        2: array).
+
+        """
+        if style == 0 and dtype == 0:
+            return self.lmp.extract_compute(compute_id, style, dtype)
+        values = np.array(self.lmp.numpy.extract_compute(compute_id, style, dtype))
+        if style == 1:
+            nlocal = self.lmp.extract_global('nlocal')
+            ids = np.array(self.lmp.numpy.extract_atom('id', nelem=nlocal))
+            values = values[:nlocal][np.argsort(ids)]
+        return values
+
+    def close(self):
+        """
+        Close the LAMMPS instance and remove the working directory.
+
+        """
+        if self.lmp is not None:
+            self.lmp.close()
+            self.lmp = None
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
 
 
 class LMPStaticCalculator(six.with_metaclass(abc.ABCMeta, object)):
@@ -50,6 +484,9 @@ class LMPStaticCalculator(six.with_metaclass(abc.ABCMeta, object)):
     """
 
     LMP_EXE = 'lmp_serial'
+    BACKENDS = ('subprocess', 'library')
+    backend = 'subprocess'
+    _session = None
     _COMMON_CMDS = ['units metal',
                     'atom_style charge',
                     'box tilt large',
@@ -80,44 +517,131 @@ class LMPStaticCalculator(six.with_metaclass(abc.ABCMeta, object)):
         """
         return
 
-    def calculate(self, structures):
+    def _parse_batch(self, n_structures):
+        """
+        Parse results of a batched run from the appended dump files.
+
+        """
+        raise NotImplementedError('%s does not support batched runs'
+                                  % self.__class__.__name__)
+
+    def _session_cmds(self):
+        """
+        Commands to set up the persistent LAMMPS session of library
+        backend, potential files should be written in current directory.
+
+        """
+        raise NotImplementedError('%s does not support library backend'
+                                  % self.__class__.__name__)
+
+    def _session_parse(self, session, elements):
+        """
+        Extract results from the persistent LAMMPS session after run.
+
+        """
+        raise NotImplementedError('%s does not support library backend'
+                                  % self.__class__.__name__)
+
+    def _calculate_library(self, structure, ff_elements=None):
+        symbols = set(structure.symbol_set).union(ff_elements or [])
+        elements = _sort_elements(symbols)
+        if self._session is None or self._session.elements != elements:
+            self.close()
+            self._session = LMPSession(elements)
+            with cd(self._session.work_dir):
+                commands = self._session_cmds()
+            self._session.command(commands)
+        elements = self._session.set_structure(structure)
+        self._session.run()
+        return self._session_parse(self._session, elements)
+
+    def close(self):
+        """
+        Close the persistent LAMMPS session of library backend.
+
+        """
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_session', None)
+        return state
+
+    def _calculate_parallel(self, structures, batch_size=1, n_jobs=1, executor=None):
+        if n_jobs < 1:
+            n_jobs = multiprocessing.cpu_count()
+        shards = [list(idx) for idx in np.array_split(np.arange(len(structures)), n_jobs)
+                  if len(idx) > 0]
+        shutdown = executor is None
+        if executor is None:
+            executor = ProcessPoolExecutor(max_workers=len(shards))
+        try:
+            futures = [executor.submit(_calculate_shard, self,
+                                       [structures[i] for i in idx], batch_size)
+                       for idx in shards]
+            data = [d for f in futures for d in f.result()]
+        finally:
+            if shutdown:
+                executor.shutdown()
+        return data
+
+    def calculate(self, structures, batch_size=1, n_jobs=1, executor=None):
         """
         Perform the calculation on a series of structures.
 
         Args:
             structures [Structure]: Input structures in a list.
+            batch_size (int): No. of structures computed within one
+                LAMMPS process. Default to 1, i.e., one process per
+                structure. Larger batches save the process startup and
+                potential loading time for each structure.
+            n_jobs (int): No. of worker processes the structures are
+                sharded across, -1 means using all CPU cores. Each worker
+                sets up its own scratch directory and potential files.
+                Default to 1, i.e., no parallelization.
+            executor (Executor): Process-based executor, e.g.,
+                concurrent.futures.ProcessPoolExecutor, to submit the
+                n_jobs shards to. Default to None, a ProcessPoolExecutor
+                with n_jobs workers is created for the calculation.
 
         Returns:
             List of computed data corresponding to each structure,
             varies with different subclasses.
 
         """
+        structures = list(structures)
         for s in structures:
             assert self._sanity_check(s) is True, \
                 'Incompatible structure found'
+        if n_jobs != 1 or executor is not None:
+            return self._calculate_parallel(structures, batch_size, n_jobs, executor)
         ff_elements = None
         if hasattr(self, 'element_profile'):
             ff_elements = self.element_profile.keys()
+        if self.backend == 'library':
+            return [self._calculate_library(s, ff_elements) for s in structures]
         with ScratchDir('.'):
             input_file = self._setup()
             data = []
+            if batch_size > 1:
+                for i in range(0, len(structures), batch_size):
+                    batch = structures[i:i + batch_size]
+                    for j, s in enumerate(batch):
+                        ld = LammpsData.from_structure(s, ff_elements)
+                        ld.write_file('data.static.%d' % (j + 1))
+                    batch_file, outputs = _batch_input(input_file, len(batch))
+                    for output in outputs:
+                        if os.path.exists(output):
+                            os.remove(output)
+                    _run_lammps([self.LMP_EXE, '-in', batch_file])
+                    data.extend(self._parse_batch(len(batch)))
+                return data
             for s in structures:
                 ld = LammpsData.from_structure(s, ff_elements)
                 ld.write_file('data.static')
-                p = subprocess.Popen([self.LMP_EXE, '-in', input_file],
-                                     stdout=subprocess.PIPE)
-                stdout = p.communicate()[0]
-                rc = p.returncode
-                if rc != 0:
-                    error_msg = 'LAMMPS exited with return code %d' % rc
-                    msg = stdout.decode("utf-8").split('\n')[:-1]
-                    try:
-                        error_line = [i for i, m in enumerate(msg)
-                                      if m.startswith('ERROR')][0]
-                        error_msg += ', '.join([e for e in msg[error_line:]])
-                    except Exception:
-                        error_msg += msg[-1]
-                    raise RuntimeError(error_msg)
+                _run_lammps([self.LMP_EXE, '-in', input_file])
                 results = self._parse()
                 data.append(results)
         return data
@@ -128,14 +652,24 @@ class EnergyForceStress(LMPStaticCalculator):
     Calculate energy, forces and virial stress of structures.
     """
 
-    def __init__(self, ff_settings):
+    def __init__(self, ff_settings, backend='subprocess'):
         """
         Args:
             ff_settings (list/Potential): Configure the force field settings for LAMMPS
                 calculation, if given a Potential object, should apply
                 Potential.write_param method to get the force field setting.
+            backend (str): 'subprocess' runs the LAMMPS executable for each
+                calculation. 'library' keeps a persistent LAMMPS instance
+                through the LAMMPS Python interface (requires lammps module),
+                which loads the potential only once. Default to 'subprocess'.
         """
         self.ff_settings = ff_settings
+        if backend not in self.BACKENDS:
+            raise ValueError('Invalid backend, choose among %s' % ', '.join(self.BACKENDS))
+        self.backend = backend
+
+    def _get_ff_settings(self):
+        return _write_ff_settings(self.ff_settings)
 
     def _setup(self):
         template_dir = os.path.join(os.path.dirname(__file__), 'templates', 'efs')
@@ -143,16 +677,22 @@ class EnergyForceStress(LMPStaticCalculator):
             input_template = f.read()
 
         input_file = 'in.efs'
-
-        if isinstance(self.ff_settings, Potential):
-            ff_settings = self.ff_settings.write_param()
-        else:
-            ff_settings = self.ff_settings
+        ff_settings = self._get_ff_settings()
 
         with open(input_file, 'w') as f:
             f.write(input_template.format(ff_settings='\n'.join(ff_settings)))
         return input_file
 
+    def _session_cmds(self):
+        return list(self._get_ff_settings()) + \
+            ['thermo_style custom pe pxx pyy pzz pxy pxz pyz']
+
+    def _session_parse(self, session, elements):
+        energy = float(session.extract_compute('thermo_pe', 0, 0))
+        force = session.extract_atom('f')
+        stress = session.extract_compute('thermo_press', 0, 1)[:6] * 1.0e-4
+        return energy, force, stress
+
     def _sanity_check(self, structure):
         return True
 
@@ -162,6 +702,15 @@ class EnergyForceStress(LMPStaticCalculator):
         stress = np.loadtxt('stress.txt')
         return energy, force, stress
 
+    def _parse_batch(self, n_structures):
+        energies = np.loadtxt('energy.txt', ndmin=1)
+        forces = _read_dumps('force.dump')
+        stresses = np.loadtxt('stress.txt', ndmin=2)
+        assert len(energies) == len(forces) == len(stresses) == n_structures, \
+            'Inconsistent No. of results in batched run'
+        # forces squeezed by _read_dumps as _read_dump does in _parse
+        return [(float(e), f, st) for e, f, st in zip(energies, forces, stresses)]
+
 
 class SpectralNeighborAnalysis(LMPStaticCalculator):
     """
@@ -193,7 +742,8 @@ class SpectralNeighborAnalysis(LMPStaticCalculator):
              'dump 4 all custom 1 dump.snav c_snav[*]']
 
     def __init__(self, rcutfac, twojmax, element_profile, rfac0=0.99363,
-                 rmin0=0, diagonalstyle=3, quadratic=False):
+                 rmin0=0, diagonalstyle=3, quadratic=False, backend='subprocess',
+                 binary_dump=False):
         """
         For more details on the parameters, please refer to the
         official documentation of LAMMPS.
@@ -222,6 +772,14 @@ class SpectralNeighborAnalysis(LMPStaticCalculator):
                 default to 3.
             quadratic (bool): Whether including quadratic terms.
                 Default to False.
+            backend (str): 'subprocess' runs the LAMMPS executable for
+                each structure, 'library' keeps a persistent LAMMPS
+                instance through the LAMMPS Python interface (requires
+                lammps module). Default to 'subprocess'.
+            binary_dump (bool): Whether to write the bispectrum dumps
+                of subprocess backend in LAMMPS binary format, which is
+                parsed without text conversion and keeps full precision.
+                Default to False.
 
         """
         self.rcutfac = rcutfac
@@ -233,6 +791,10 @@ class SpectralNeighborAnalysis(LMPStaticCalculator):
                                           'choose among 0, 1, 2 and 3'
         self.diagonalstyle = diagonalstyle
         self.quadratic = quadratic
+        self.binary_dump = binary_dump
+        if backend not in self.BACKENDS:
+            raise ValueError('Invalid backend, choose among %s' % ', '.join(self.BACKENDS))
+        self.backend = backend
 
     @staticmethod
     def get_bs_subscripts(twojmax, diagonal):
@@ -249,24 +811,8 @@ class SpectralNeighborAnalysis(LMPStaticCalculator):
             List of all subscripts [2j1, 2j2, 2j].
 
         """
-        subs = itertools.product(range(twojmax + 1), repeat=3)
-        filters = [lambda x: True if x[0] >= x[1] else False]
-        if diagonal == 2:
-            filters.append(lambda x: True if x[0] == x[1] == x[2] else False)
-        else:
-            if diagonal == 1:
-                filters.append(lambda x: True if x[0] == x[1] else False)
-            elif diagonal == 3:
-                filters.append(lambda x: True if x[2] >= x[0] else False)
-            elif diagonal == 0:
-                pass
-            j_filter = lambda x: True if \
-                x[2] in range(x[0] - x[1], min(twojmax, x[0] + x[1]) + 1, 2) \
-                else False
-            filters.append(j_filter)
-        for f in filters:
-            subs = filter(f, subs)
-        return list(subs)
+        from mlearn.describers import get_bs_index
+        return get_bs_index(twojmax, diagonal).subscripts.tolist()
 
     @property
     def n_bs(self):
@@ -274,9 +820,10 @@ class SpectralNeighborAnalysis(LMPStaticCalculator):
         Returns No. of bispectrum components to be calculated.
 
         """
-        return len(self.get_bs_subscripts(self.twojmax, self.diagonalstyle))
+        from mlearn.describers import get_bs_index
+        return len(get_bs_index(self.twojmax, self.diagonalstyle).subscripts)
 
-    def _setup(self):
+    def _get_cmds(self):
         compute_args = '{} {} {} '.format(1, self.rfac0, self.twojmax)
         el_in_seq = _sort_elements(self.element_profile.keys())
         cutoffs = [self.element_profile[e]['r'] * self.rcutfac
@@ -289,12 +836,19 @@ class SpectralNeighborAnalysis(LMPStaticCalculator):
         add_args = lambda l: l + compute_args if l.startswith('compute') \
             else l
         CMDS = list(map(add_args, self._CMDS))
+        if self.binary_dump:
+            # one file per timestep, as binary dumps are not appended
+            CMDS[6:9] = [re.sub(r'(dump\.\w+)', r'\1.*.bin', c) for c in CMDS[6:9]]
         CMDS[2] += ' bzeroflag 0'
         CMDS[3] += ' bzeroflag 0'
         CMDS[4] += ' bzeroflag 0'
         dump_modify = 'dump_modify 1 element '
         dump_modify += ' '.join(str(e) for e in el_in_seq)
         CMDS.append(dump_modify)
+        return CMDS
+
+    def _setup(self):
+        CMDS = self._get_cmds()
         ALL_CMDS = self._COMMON_CMDS[:]
         ALL_CMDS[-1:-1] = CMDS
         input_file = 'in.sna'
@@ -307,13 +861,44 @@ class SpectralNeighborAnalysis(LMPStaticCalculator):
         sna_elements = self.element_profile.keys()
         return struc_elements.issubset(sna_elements)
 
+    def _read_bs_dumps(self, timesteps):
+        names = ['dump.sna', 'dump.snad', 'dump.snav']
+        if self.binary_dump:
+            return [[_read_binary_dumps('%s.%d.bin' % (name, t))[0] for t in timesteps]
+                    for name in names]
+        return [_read_dumps(name) for name in names]
+
     def _parse(self):
         element = np.atleast_1d(_read_dump('dump.element', 'unicode'))
+        if self.binary_dump:
+            b, db, vb = [np.atleast_2d(frames[0]) for frames in self._read_bs_dumps([0])]
+            return b, db, vb, element
         b = np.atleast_2d(_read_dump('dump.sna'))
         db = np.atleast_2d(_read_dump('dump.snad'))
         vb = np.atleast_2d(_read_dump('dump.snav'))
         return b, db, vb, element
 
+    def _parse_batch(self, n_structures):
+        elements = _read_dumps('dump.element', 'unicode')
+        bs, dbs, vbs = self._read_bs_dumps(range(1, n_structures + 1))
+        assert len(elements) == len(bs) == n_structures, \
+            'Inconsistent No. of results in batched run'
+        return [(np.atleast_2d(b), np.atleast_2d(db), np.atleast_2d(vb),
+                 np.atleast_1d(element))
+                for b, db, vb, element in zip(bs, dbs, vbs, elements)]
+
+    def _session_cmds(self):
+        # per-atom computes are invoked in each run through thermo output
+        return [c for c in self._get_cmds() if not c.startswith('dump')] + \
+            ['compute snasum all reduce sum c_sna[1] c_snad[1] c_snav[1]',
+             'thermo_style custom step c_snasum[1] c_snasum[2] c_snasum[3]']
+
+    def _session_parse(self, session, elements):
+        b = np.atleast_2d(session.extract_compute('sna', 1, 2))
+        db = np.atleast_2d(session.extract_compute('snad', 1, 2))
+        vb = np.atleast_2d(session.extract_compute('snav', 1, 2))
+        return b, db, vb, np.array(elements)
+
 
 class ElasticConstant(LMPStaticCalculator):
     """
@@ -371,10 +956,7 @@ class ElasticConstant(LMPStaticCalculator):
 
         input_file = 'in.elastic'
 
-        if isinstance(self.ff_settings, Potential):
-            ff_settings = self.ff_settings.write_param()
-        else:
-            ff_settings = self.ff_settings
+        ff_settings = _write_ff_settings(self.ff_settings)
 
         with open(input_file, 'w') as f:
             f.write(input_template.format(write_restart=self.write_command,
@@ -397,20 +979,7 @@ class ElasticConstant(LMPStaticCalculator):
         """
         with ScratchDir('.'):
             input_file = self._setup()
-            p = subprocess.Popen([self.LMP_EXE, '-in', input_file],
-                                 stdout=subprocess.PIPE)
-            stdout = p.communicate()[0]
-            rc = p.returncode
-            if rc != 0:
-                error_msg = 'LAMMPS exited with return code %d' % rc
-                msg = stdout.decode("utf-8").split('\n')[:-1]
-                try:
-                    error_line = [i for i, m in enumerate(msg)
-                                  if m.startswith('ERROR')][0]
-                    error_msg += ', '.join([e for e in msg[error_line:]])
-                except Exception:
-                    error_msg += msg[-1]
-                raise RuntimeError(error_msg)
+            _run_lammps([self.LMP_EXE, '-in', input_file])
             result = self._parse()
         return result
 
@@ -452,10 +1021,7 @@ class LatticeConstant(LMPStaticCalculator):
 
         input_file = 'in.latt'
 
-        if isinstance(self.ff_settings, Potential):
-            ff_settings = self.ff_settings.write_param()
-        else:
-            ff_settings = self.ff_settings
+        ff_settings = _write_ff_settings(self.ff_settings)
 
         with open(input_file, 'w') as f:
             f.write(input_template.format(ff_settings='\n'.join(ff_settings)))
@@ -477,6 +1043,12 @@ class LatticeConstant(LMPStaticCalculator):
         a, b, c = np.loadtxt('lattice.txt')
         return a, b, c
 
+    def _parse_batch(self, n_structures):
+        lattices = np.loadtxt('lattice.txt', ndmin=2)
+        assert len(lattices) == n_structures, \
+            'Inconsistent No. of results in batched run'
+        return [tuple(abc) for abc in lattices]
+
 
 class NudgedElasticBand(LMPStaticCalculator):
     """
@@ -556,46 +1128,21 @@ class NudgedElasticBand(LMPStaticCalculator):
         super_cell = unit_cell * scale_factor
         super_cell_ld = LammpsData.from_structure(super_cell, atom_style='atomic')
         super_cell_ld.write_file('data.supercell')
+        ff_settings = _write_ff_settings(self.ff_settings)
 
         with open('in.relax', 'w') as f:
-            f.write(relax_template.format(ff_settings='\n'.join(self.ff_settings.write_param()),
+            f.write(relax_template.format(ff_settings='\n'.join(ff_settings),
                                           lattice=self.lattice, alat=a, specie=self.specie,
                                           del_id=start_idx + 1, relaxed_file='initial.relaxed'))
 
-        p = subprocess.Popen([self.LMP_EXE, '-in', 'in.relax'], stdout=subprocess.PIPE)
-        stdout = p.communicate()[0]
-
-        rc = p.returncode
-        if rc != 0:
-            error_msg = 'LAMMPS exited with return code %d' % rc
-            msg = stdout.decode("utf-8").split('\n')[:-1]
-            try:
-                error_line = [i for i, m in enumerate(msg)
-                              if m.startswith('ERROR')][0]
-                error_msg += ', '.join([e for e in msg[error_line:]])
-            except Exception:
-                error_msg += msg[-1]
-            raise RuntimeError(error_msg)
+        _run_lammps([self.LMP_EXE, '-in', 'in.relax'])
 
         with open('in.relax', 'w') as f:
-            f.write(relax_template.format(ff_settings='\n'.join(self.ff_settings.write_param()),
+            f.write(relax_template.format(ff_settings='\n'.join(ff_settings),
                                           lattice=self.lattice, alat=a, specie=self.specie,
                                           del_id=final_idx + 1, relaxed_file='final.relaxed'))
 
-        p = subprocess.Popen([self.LMP_EXE, '-in', 'in.relax'], stdout=subprocess.PIPE)
-        stdout = p.communicate()[0]
-
-        rc = p.returncode
-        if rc != 0:
-            error_msg = 'LAMMPS exited with return code %d' % rc
-            msg = stdout.decode("utf-8").split('\n')[:-1]
-            try:
-                error_line = [i for i, m in enumerate(msg)
-                              if m.startswith('ERROR')][0]
-                error_msg += ', '.join([e for e in msg[error_line:]])
-            except Exception:
-                error_msg += msg[-1]
-            raise RuntimeError(error_msg)
+        _run_lammps([self.LMP_EXE, '-in', 'in.relax'])
 
         final_relaxed_struct = LammpsData.from_file('final.relaxed',
                                                     atom_style='atomic').structure
@@ -617,7 +1164,7 @@ class NudgedElasticBand(LMPStaticCalculator):
         input_file = 'in.neb'
 
         with open(input_file, 'w') as f:
-            f.write(neb_template.format(ff_settings='\n'.join(self.ff_settings.write_param()),
+            f.write(neb_template.format(ff_settings='\n'.join(ff_settings),
                                         start_replica='initial.relaxed',
                                         final_replica='data.final_replica'))
 
@@ -629,22 +1176,9 @@ class NudgedElasticBand(LMPStaticCalculator):
         """
         with ScratchDir('.'):
             input_file = self._setup()
-            p = subprocess.Popen(['mpirun', '-n', str(self.num_replicas),
-                                  'lmp_mpi', '-partition', '{}x1'.format(self.num_replicas),
-                                  '-in', input_file],
-                                 stdout=subprocess.PIPE)
-            stdout = p.communicate()[0]
-            rc = p.returncode
-            if rc != 0:
-                error_msg = 'LAMMPS exited with return code %d' % rc
-                msg = stdout.decode("utf-8").split('\n')[:-1]
-                try:
-                    error_line = [i for i, m in enumerate(msg)
-                                  if m.startswith('ERROR')][0]
-                    error_msg += ', '.join([e for e in msg[error_line:]])
-                except Exception:
-                    error_msg += msg[-1]
-                raise RuntimeError(error_msg)
+            _run_lammps(['mpirun', '-n', str(self.num_replicas),
+                         'lmp_mpi', '-partition', '{}x1'.format(self.num_replicas),
+                         '-in', input_file])
             result = self._parse()
         return result
 
@@ -740,11 +1274,12 @@ class DefectFormation(LMPStaticCalculator):
 
         super_cell_ld = LammpsData.from_structure(super_cell, atom_style='atomic')
         super_cell_ld.write_file('data.supercell')
+        ff_settings = _write_ff_settings(self.ff_settings)
 
         input_file = 'in.defect'
 
         with open(input_file, 'w') as f:
-            f.write(defect_template.format(ff_settings='\n'.join(self.ff_settings.write_param()),
+            f.write(defect_template.format(ff_settings='\n'.join(ff_settings),
                                            lattice=self.lattice, alat=a, specie=self.specie,
                                            del_id=idx + 1, relaxed_file='data.relaxed'))
 
@@ -756,20 +1291,7 @@ class DefectFormation(LMPStaticCalculator):
         """
         with ScratchDir('.'):
             input_file, energy_per_atom, num_atoms = self._setup()
-            p = subprocess.Popen([self.LMP_EXE, '-in', input_file], stdout=subprocess.PIPE)
-            stdout = p.communicate()[0]
-
-            rc = p.returncode
-            if rc != 0:
-                error_msg = 'LAMMPS exited with return code %d' % rc
-                msg = stdout.decode("utf-8").split('\n')[:-1]
-                try:
-                    error_line = [i for i, m in enumerate(msg)
-                                  if m.startswith('ERROR')][0]
-                    error_msg += ', '.join([e for e in msg[error_line:]])
-                except Exception:
-                    error_msg += msg[-1]
-                raise RuntimeError(error_msg)
+            _run_lammps([self.LMP_EXE, '-in', input_file])
             defect_energy, _, _ = self._parse()
         defect_formation_energy = defect_energy - energy_per_atom * num_atoms
 
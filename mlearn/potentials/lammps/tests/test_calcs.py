@@ -9,17 +9,24 @@ import unittest
 import tempfile
 import os
 import shutil
+import threading
 
 import json
 import numpy as np
 from monty.os.path import which
+try:
+    import lammps
+except ImportError:
+    lammps = None
 from pymatgen import Structure, Lattice, Element
 from mlearn.models import LinearModel
 from mlearn.potentials.snap import SNAPotential
 from mlearn.describers import BispectrumCoefficients
 from mlearn.potentials.lammps.calcs import \
     SpectralNeighborAnalysis, EnergyForceStress, ElasticConstant, LatticeConstant, \
-    NudgedElasticBand, DefectFormation
+    NudgedElasticBand, DefectFormation, _batch_input, _read_dump, _read_dumps, _read_binary_dumps, \
+    _write_ff_settings
+from mlearn.potentials.lammps import calcs
 
 CWD = os.getcwd()
 with open(os.path.join(os.path.dirname(__file__), 'coeff.json')) as f:
@@ -157,6 +164,286 @@ class SpectralNeighborAnalysisTest(unittest.TestCase):
         self.assertEqual(snav6.shape, (len(s3), n6 * 6 * len(profile3)))
         self.assertEqual(len(np.unique(elem6)), len(profile3))
 
+    @unittest.skipIf(not which('lmp_serial'), 'No LAMMPS cmd found.')
+    @unittest.skipIf(lammps is None, 'No LAMMPS python module found.')
+    def test_calculate_library(self):
+        s = Structure.from_spacegroup(225, Lattice.cubic(5.69169),
+                                      ['Na', 'Cl'],
+                                      [[0, 0, 0], [0, 0, 0.5]])
+        perturbed = s.copy()
+        perturbed.translate_sites([0, 3], [0.05, 0.1, 0.02], frac_coords=False)
+        # atom counts change between structures, and repeated structures
+        # are pushed into the session without recreating atoms
+        structures = [s, perturbed * [2, 1, 1], perturbed, s * [1, 1, 2], perturbed]
+        profile = dict(Na=dict(r=0.3, w=0.9), Cl=dict(r=0.7, w=3.0))
+        single = SpectralNeighborAnalysis(rcutfac=5, twojmax=4, element_profile=profile,
+                                          binary_dump=True).calculate(structures)
+        calculator = SpectralNeighborAnalysis(rcutfac=5, twojmax=4, element_profile=profile,
+                                              backend='library')
+        library = calculator.calculate(structures)
+        for (b1, db1, vb1, e1), (b2, db2, vb2, e2) in zip(single, library):
+            np.testing.assert_allclose(b1, b2, rtol=1e-8, atol=1e-8)
+            np.testing.assert_allclose(db1, db2, rtol=1e-8, atol=1e-8)
+            np.testing.assert_allclose(vb1, vb2, rtol=1e-8, atol=1e-8)
+            np.testing.assert_array_equal(e1, e2)
+        calculator.close()
+
+
+class BatchInputTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_dir = tempfile.mkdtemp()
+        os.chdir(cls.test_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.chdir(CWD)
+        shutil.rmtree(cls.test_dir)
+
+    def test_batch_input(self):
+        with open('in.test', 'w') as f:
+            f.write('\n'.join(['clear', 'units metal', 'read_data data.static',
+                               'pair_style lj/cut 10',
+                               'dump 1 all custom 1 force.dump c_force[*]',
+                               'run 0',
+                               'print "${energy}" file energy.txt']))
+        batch_file, outputs = _batch_input('in.test', 3)
+        self.assertEqual(outputs, ['force.dump', 'energy.txt'])
+        with open(batch_file) as f:
+            commands = [' '.join(l.split()) for l in f.readlines()]
+        self.assertEqual(commands[:3], ['variable sid loop 3',
+                                        'label batch_loop', 'clear'])
+        self.assertIn('read_data data.static.${sid}', commands)
+        self.assertIn('dump_modify 1 append yes', commands)
+        self.assertIn('print "${energy}" append energy.txt', commands)
+        self.assertEqual(commands[-2:], ['next sid', 'jump SELF batch_loop'])
+
+    def test_read_dumps(self):
+        frames = []
+        for step, n in zip([1, 2], [2, 1]):
+            frames.append('ITEM: TIMESTEP\n{}\nITEM: NUMBER OF ATOMS\n{}\n'
+                          'ITEM: BOX BOUNDS pp pp pp\n0 1\n0 1\n0 1\n'
+                          'ITEM: ATOMS c_force[1] c_force[2] c_force[3]\n'
+                          .format(step, n))
+            frames.append('\n'.join(['0.1 0.2 0.3'] * n) + '\n')
+        with open('force.dump', 'w') as f:
+            f.write(''.join(frames))
+        forces = _read_dumps('force.dump')
+        self.assertEqual(len(forces), 2)
+        self.assertEqual(forces[0].shape, (2, 3))
+        np.testing.assert_array_almost_equal(forces[1], [0.1, 0.2, 0.3])
+        np.testing.assert_array_almost_equal(_read_dump('force.dump'), forces[0])
+
+        with open('element.dump', 'w') as f:
+            f.write('ITEM: TIMESTEP\n0\nITEM: NUMBER OF ATOMS\n3\n'
+                    'ITEM: BOX BOUNDS xy xz yz pp pp pp\n0 1 0\n0 1 0\n0 1 0\n'
+                    'ITEM: ATOMS element\nMo\nNi\nMo\n')
+        np.testing.assert_array_equal(_read_dump('element.dump', 'unicode'),
+                                      ['Mo', 'Ni', 'Mo'])
+
+        with open('force.dump', 'a') as f:
+            f.write(frames[2] + '0.1 0.2 0.3\n' * 2)
+        self.assertRaises(ValueError, _read_dumps, 'force.dump')
+
+    def test_parse_batch(self):
+        calculator = EnergyForceStress(ff_settings=[])
+        natoms = [1, 2]
+        frames = ['ITEM: TIMESTEP\n{}\nITEM: NUMBER OF ATOMS\n{}\n'
+                  'ITEM: BOX BOUNDS pp pp pp\n0 1\n0 1\n0 1\n'
+                  'ITEM: ATOMS c_force[1] c_force[2] c_force[3]\n'.format(i + 1, n)
+                  + '0.1 0.2 0.3\n' * n for i, n in enumerate(natoms)]
+        single = []
+        for frame in frames:
+            with open('force.dump', 'w') as f:
+                f.write(frame)
+            with open('energy.txt', 'w') as f:
+                f.write('-1.5\n')
+            with open('stress.txt', 'w') as f:
+                f.write('1 2 3 4 5 6\n')
+            single.append(calculator._parse())
+        with open('force.dump', 'w') as f:
+            f.write(''.join(frames))
+        with open('energy.txt', 'w') as f:
+            f.write('-1.5\n-1.5\n')
+        with open('stress.txt', 'w') as f:
+            f.write('1 2 3 4 5 6\n' * 2)
+        batched = calculator._parse_batch(2)
+        self.assertEqual(len(batched), 2)
+        for (e1, f1, s1), (e2, f2, s2) in zip(single, batched):
+            self.assertEqual(e1, e2)
+            # a single-atom structure gets the same force shape in both paths
+            self.assertEqual(f1.shape, f2.shape)
+            np.testing.assert_array_equal(f1, f2)
+            np.testing.assert_array_equal(s1, s2)
+        self.assertEqual(batched[0][1].shape, (3,))
+
+    def test_read_binary_dumps(self):
+        data = np.arange(12, dtype=np.float64).reshape(4, 3)
+        with open('dump.sna.bin', 'wb') as f:
+            # legacy header
+            np.array([1, 4], dtype=np.int64).tofile(f)
+            np.array([0] + [1] * 6, dtype=np.int32).tofile(f)
+            np.zeros(6).tofile(f)
+            np.array([3, 2, 6], dtype=np.int32).tofile(f)
+            data[:2].tofile(f)
+            np.array([6], dtype=np.int32).tofile(f)
+            data[2:].tofile(f)
+            # header with magic string, revision 2
+            magic = b'DUMPCUSTOM'
+            np.array([-len(magic)], dtype=np.int64).tofile(f)
+            f.write(magic)
+            np.array([1, 2], dtype=np.int32).tofile(f)
+            np.array([2, 4], dtype=np.int64).tofile(f)
+            np.array([1] + [1] * 6, dtype=np.int32).tofile(f)
+            np.zeros(9).tofile(f)
+            np.array([3, 5], dtype=np.int32).tofile(f)
+            f.write(b'metal')
+            f.write(b'\x00')
+            np.array([5], dtype=np.int32).tofile(f)
+            f.write(b'c_1 c')
+            np.array([1, 12], dtype=np.int32).tofile(f)
+            data.tofile(f)
+        frames = _read_binary_dumps('dump.sna.bin')
+        self.assertEqual(len(frames), 2)
+        for frame in frames:
+            np.testing.assert_array_equal(frame, data)
+
+
+class PotentialCacheTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_dir = tempfile.mkdtemp()
+        os.chdir(cls.test_dir)
+        cls.cache_dir = calcs.POTENTIAL_CACHE_DIR
+
+    @classmethod
+    def tearDownClass(cls):
+        calcs.POTENTIAL_CACHE_DIR = cls.cache_dir
+        os.chdir(CWD)
+        shutil.rmtree(cls.test_dir)
+
+    def setUp(self):
+        calcs.POTENTIAL_CACHE_DIR = os.path.join(tempfile.mkdtemp(dir=self.test_dir), 'cache')
+
+    def cache_entries(self):
+        return [name for name in os.listdir(calcs.POTENTIAL_CACHE_DIR)
+                if os.path.isdir(os.path.join(calcs.POTENTIAL_CACHE_DIR, name))]
+
+    def test_write_ff_settings(self):
+        element_profile = {'Ni': {'r': 0.5, 'w': 1}}
+        describer = BispectrumCoefficients(rcutfac=4.1, twojmax=8,
+                                           element_profile=element_profile,
+                                           pot_fit=True)
+        model = LinearModel(describer=describer)
+        model.model.coef_ = coeff
+        model.model.intercept_ = intercept
+        snap = SNAPotential(model=model)
+        snap.specie = Element('Ni')
+
+        ff_settings = _write_ff_settings(snap)
+        self.assertEqual(ff_settings[0], snap.pair_style)
+        self.assertTrue(os.path.exists('SNAPotential.snapcoeff'))
+        self.assertEqual(len(self.cache_entries()), 1)
+
+        os.mkdir('scratch')
+        os.chdir('scratch')
+        write_param, snap.write_param = snap.write_param, None
+        self.assertEqual(_write_ff_settings(snap), ff_settings)
+        self.assertTrue(os.path.exists('SNAPotential.snapparam'))
+        snap.write_param = write_param
+        os.chdir('..')
+
+        model.model.coef_ = coeff * 2
+        _write_ff_settings(snap)
+        self.assertEqual(len(self.cache_entries()), 2)
+        self.assertEqual(_write_ff_settings(['pair_style lj/cut 5']),
+                         ['pair_style lj/cut 5'])
+
+    def test_evict(self):
+        element_profile = {'Ni': {'r': 0.5, 'w': 1}}
+        describer = BispectrumCoefficients(rcutfac=4.1, twojmax=8,
+                                           element_profile=element_profile,
+                                           pot_fit=True)
+        model = LinearModel(describer=describer)
+        model.model.intercept_ = intercept
+        snap = SNAPotential(model=model)
+        snap.specie = Element('Ni')
+
+        cache_size = calcs.POTENTIAL_CACHE_SIZE
+        os.mkdir('evict')
+        os.chdir('evict')
+        keys = []
+        for i in range(4):
+            model.model.coef_ = coeff * (i + 1)
+            _write_ff_settings(snap)
+            keys.append(snap.param_hash())
+            entry = os.path.join(calcs.POTENTIAL_CACHE_DIR, keys[-1])
+            os.utime(entry, (i, i))
+            if i == 0:
+                # room for two entries
+                calcs.POTENTIAL_CACHE_SIZE = 2 * sum(os.path.getsize(os.path.join(entry, f))
+                                                     for f in os.listdir(entry)) + 1
+            if i == 1:
+                # the first entry is used again, so the second is the least recent
+                model.model.coef_ = coeff
+                _write_ff_settings(snap)
+        calcs.POTENTIAL_CACHE_SIZE = cache_size
+        entries = self.cache_entries()
+        self.assertIn(keys[0], entries)
+        self.assertNotIn(keys[1], entries)
+        self.assertNotIn(keys[2], entries)
+        self.assertIn(keys[3], entries)
+        # the linked potential files survive the eviction of their entries
+        with open('SNAPotential.snapcoeff') as f:
+            self.assertTrue(f.read())
+        os.chdir('..')
+
+    def test_evict_while_linking(self):
+        element_profile = {'Ni': {'r': 0.5, 'w': 1}}
+        describer = BispectrumCoefficients(rcutfac=4.1, twojmax=8,
+                                           element_profile=element_profile,
+                                           pot_fit=True)
+        model = LinearModel(describer=describer)
+        model.model.coef_ = coeff
+        model.model.intercept_ = intercept
+        snap = SNAPotential(model=model)
+        snap.specie = Element('Ni')
+        _write_ff_settings(snap)
+        # orphaned by an interrupted writer
+        orphan = tempfile.mkdtemp(dir=calcs.POTENTIAL_CACHE_DIR)
+
+        # another process evicts the entry between the lookup and the linking
+        cache_size, calcs.POTENTIAL_CACHE_SIZE = calcs.POTENTIAL_CACHE_SIZE, 0
+        link, evicting = os.link, []
+
+        def evict_and_link(src, dst):
+            if not evicting:
+                evicting.append(threading.Thread(target=calcs._evict_potential_cache,
+                                                 kwargs={'keep': 'other'}))
+                evicting[0].start()
+                evicting[0].join(0.5)
+            link(src, dst)
+
+        os.mkdir('race')
+        os.chdir('race')
+        os.link = evict_and_link
+        try:
+            ff_settings = _write_ff_settings(snap)
+        finally:
+            os.link = link
+            evicting[0].join()
+            calcs.POTENTIAL_CACHE_SIZE = cache_size
+        self.assertEqual(ff_settings[0], snap.pair_style)
+        for filename in ['SNAPotential.snapcoeff', 'SNAPotential.snapparam']:
+            with open(filename) as f:
+                self.assertTrue(f.read())
+        # evicted once the files are linked, along with the orphan
+        self.assertEqual(self.cache_entries(), [])
+        self.assertFalse(os.path.exists(orphan))
+        os.chdir('..')
+
 
 class EnergyForceStressTest(unittest.TestCase):
 
@@ -208,6 +495,49 @@ class EnergyForceStressTest(unittest.TestCase):
                                              np.zeros((len(self.struct), 3)))
         self.assertEqual(len(stresses1), 6)
 
+    @unittest.skipIf(not which('lmp_serial'), 'No LAMMPS cmd found.')
+    def test_calculate_batch(self):
+        calculator = EnergyForceStress(ff_settings=self.ff_settings1)
+        structures = [self.struct, self.struct * [2, 1, 1], self.struct]
+        single = calculator.calculate(structures)
+        batched = calculator.calculate(structures, batch_size=2)
+        self.assertEqual(len(batched), len(structures))
+        for (e1, f1, s1), (e2, f2, s2) in zip(single, batched):
+            self.assertAlmostEqual(e1, e2)
+            np.testing.assert_array_almost_equal(f1, f2)
+            np.testing.assert_array_almost_equal(s1, s2)
+
+    @unittest.skipIf(not which('lmp_serial'), 'No LAMMPS cmd found.')
+    def test_calculate_parallel(self):
+        calculator = EnergyForceStress(ff_settings=self.ff_settings1)
+        structures = [self.struct * [i, 1, 1] for i in range(1, 6)]
+        single = calculator.calculate(structures)
+        parallel = calculator.calculate(structures, n_jobs=2)
+        self.assertEqual(len(parallel), len(structures))
+        for (e1, f1, s1), (e2, f2, s2) in zip(single, parallel):
+            self.assertAlmostEqual(e1, e2)
+            self.assertEqual(f1.shape, f2.shape)
+            np.testing.assert_array_almost_equal(s1, s2)
+
+    @unittest.skipIf(not which('lmp_serial'), 'No LAMMPS cmd found.')
+    @unittest.skipIf(lammps is None, 'No LAMMPS python module found.')
+    def test_calculate_library(self):
+        ff_settings = ['pair_style lj/cut 4.5', 'pair_coeff * * 1 2',
+                       'pair_modify shift yes']
+        perturbed = self.struct * [2, 1, 1]
+        perturbed.translate_sites([0, 3], [0.05, 0.1, 0.02], frac_coords=False)
+        structures = [self.struct, perturbed, perturbed]
+        single = EnergyForceStress(ff_settings=ff_settings).calculate(structures)
+        calculator = EnergyForceStress(ff_settings=ff_settings, backend='library')
+        library = calculator.calculate(structures)
+        for (e1, f1, s1), (e2, f2, s2) in zip(single, library):
+            self.assertAlmostEqual(e1, e2, places=4)
+            np.testing.assert_allclose(f1, f2, rtol=1e-5, atol=1e-5)
+            np.testing.assert_allclose(s1, s2, rtol=1e-4, atol=1e-4)
+        calculator.close()
+        self.assertRaises(ValueError, EnergyForceStress,
+                          ff_settings=ff_settings, backend='mpi')
+
 
 class ElasticConstantTest(unittest.TestCase):
 
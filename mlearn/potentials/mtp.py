@@ -4,8 +4,8 @@
 
 """This module provides MTP interatomic potential class."""
 
+import io
 import os
-import re
 import json
 import ruamel.yaml as yaml
 import shutil
@@ -17,10 +17,12 @@ from monty.io import zopen
 from monty.os.path import which
 from monty.serialization import loadfn
 from monty.tempfile import ScratchDir
-from pymatgen import Structure, Lattice, Element
+from pymatgen import Structure, Element
+from pymatgen.io.lammps.data import lattice_2_lmpbox
 
-from mlearn.potentials import Potential
-from mlearn.data import pool_from, convert_docs
+from mlearn.potentials import Potential, hash_params
+from mlearn.data import pool_from, convert_docs, Dataset, Frame, iter_datasets
+from mlearn.neighbors import find_neighbors
 from mlearn.potentials.lammps.calcs import EnergyForceStress
 
 module_dir = os.path.dirname(__file__)
@@ -74,43 +76,41 @@ class MTPotential(Potential):
             virial_stress (list): stress should has 6 distinct
                 elements arranged in order [xx, yy, zz, yz, xz, xy].
         """
-        if len(structure.symbol_set) > 1:
-            raise ValueError("Structure is not unary.")
+        return self._format_cfg(structure.lattice.matrix, structure.atomic_numbers,
+                                structure.cart_coords, forces, energy, virial_stress)
+
+    @staticmethod
+    def _format_cfg(lattice, species, positions, forces, energy, virial_stress):
+        """
+        Format the configuration from arrays, with the atomic data of
+        the whole structure formatted at once.
 
-        inputs = OrderedDict(Size=structure.num_sites,
-                             SuperCell=structure.lattice,
-                             AtomData=(structure, forces),
-                             Energy=energy,
-                             Stress=virial_stress)
-
-        lines = ['BEGIN_CFG']
-
-        if 'Size' in inputs:
-            lines.append(' Size')
-            lines.append('{:>7d}'.format(inputs['Size']))
-        if 'SuperCell' in inputs:
-            lines.append(' SuperCell')
-            for vec in inputs['SuperCell'].matrix:
-                lines.append('{:>17.6f}{:>14.6f}{:>14.6f}'.format(*vec))
-        if 'AtomData' in inputs:
-            format_str = '{:>14s}{:>5s}{:>15s}{:>14s}{:>14s}{:>13s}{:>13s}{:>13s}'
-            format_float = '{:>14d}{:>5d}{:>15f}{:>14f}{:>14f}{:>13f}{:>13f}{:>13f}'
-            lines.append(format_str.format('AtomData:  id', 'type',
-                                           'cartes_x', 'cartes_y', 'cartes_z', 'fx', 'fy', 'fz'))
-            for i, (site, force) in enumerate(zip(structure, forces)):
-                lines.append(format_float.format(i + 1, 0, *site.coords, *force))
-        if 'Energy' in inputs:
-            lines.append(' Energy')
-            lines.append('{:>24.12f}'.format(inputs['Energy']))
-        if 'Stress' in inputs:
-            format_str = '{:>12s}{:>12s}{:>12s}{:>12s}{:>12s}{:>12s}'
-            format_float = '{:>12f}{:>12f}{:>12f}{:>12f}{:>12f}{:>12f}'
-            lines.append(format_str.format('Stress:  xx', 'yy', 'zz', 'yz', 'xz', 'xy'))
-            lines.append(format_float.format(*np.array(virial_stress) / 1.898))
-
-        lines.append('END_CFG')
-
-        return '\n'.join(lines)
+        Args:
+            lattice (np.array): The (3, 3) lattice matrix.
+            species (np.array): The (m, ) atomic numbers.
+            positions (np.array): The (m, 3) Cartesian coordinates.
+            forces (np.array): The (m, 3) forces.
+            energy (float): DFT-calculated energy of the system.
+            virial_stress (list): stress should has 6 distinct
+                elements arranged in order [xx, yy, zz, yz, xz, xy].
+        """
+        if len(set(species)) > 1:
+            raise ValueError("Structure is not unary.")
+        n = len(species)
+        atom_data = np.zeros((n, 8))
+        atom_data[:, 0] = np.arange(1, n + 1)
+        atom_data[:, 2:5] = positions
+        atom_data[:, 5:] = np.reshape(forces, (-1, 3))
+        return ''.join([
+            'BEGIN_CFG\n Size\n%7d\n SuperCell\n' % n,
+            '%17.6f%14.6f%14.6f\n' * 3 % tuple(np.ravel(lattice).tolist()),
+            '%14s%5s%15s%14s%14s%13s%13s%13s\n' % (
+                'AtomData:  id', 'type', 'cartes_x', 'cartes_y', 'cartes_z', 'fx', 'fy', 'fz'),
+            '%14d%5d%15f%14f%14f%13f%13f%13f\n' * n % tuple(atom_data.ravel().tolist()),
+            ' Energy\n%24.12f\n' % energy,
+            '%12s%12s%12s%12s%12s%12s\n' % ('Stress:  xx', 'yy', 'zz', 'yz', 'xz', 'xy'),
+            '%12f%12f%12f%12f%12f%12f\n' % tuple((np.array(virial_stress) / 1.898).tolist()),
+            'END_CFG'])
 
     def write_cfg(self, filename, cfg_pool):
         """
@@ -119,25 +119,26 @@ class MTPotential(Potential):
         Args:
             filename (str): The filename to be written.
             cfg_pool (list): The configuration pool contains
-                structure and energy/forces properties.
+                structure and energy/forces properties, which can also
+                be a generator of docs, e.g., from iter_docs, or a
+                Dataset.
         """
-        lines = []
-        for dataset in cfg_pool:
-            if isinstance(dataset['structure'], dict):
-                structure = Structure.from_dict(dataset['structure'])
-            else:
-                structure = dataset['structure']
-            energy = dataset['outputs']['energy']
-            forces = dataset['outputs']['forces']
-            virial_stress = dataset['outputs']['virial_stress']
-            virial_stress = [virial_stress[self.vasp_stress_order.index(n)]
-                             for n in self.mtp_stress_order]
-            lines.append(self._line_up(structure, energy, forces, virial_stress))
-
-        self.specie = Element(structure.symbol_set[0])
-
-        with open(filename, 'w') as f:
-            f.write('\n'.join(lines))
+        stress_index = [self.vasp_stress_order.index(n) for n in self.mtp_stress_order]
+        datasets = [cfg_pool] if isinstance(cfg_pool, Dataset) \
+            else iter_datasets(cfg_pool, batch_size=1000)
+        species = None
+        with io.open(filename, 'w', buffering=1 << 20) as f:
+            for dataset in datasets:
+                stresses = dataset.stresses[:, stress_index]
+                for i in range(len(dataset)):
+                    frame = dataset[i]
+                    if species is not None:
+                        f.write('\n')
+                    f.write(self._format_cfg(frame.lattice, frame.species, frame.positions,
+                                             frame.forces, frame.energy, stresses[i]))
+                    species = frame.species
+
+        self.specie = Element.from_Z(int(species[0]))
 
         return filename
 
@@ -354,6 +355,56 @@ class MTPotential(Potential):
 
         return filename
 
+    def iter_cfgs(self, filename, symbol):
+        """
+        Lazily read the configuration file line by line, with the numeric
+        sections of each configuration parsed at once.
+
+        Args:
+            filename (str): The configuration file to be read.
+            symbol (str): The element symbol.
+
+        Yields:
+            (Frame) The lattice, species, positions, energy, forces and
+            virial stress (in vasp order) of each configuration.
+        """
+        specie = Element(symbol).Z
+        stress_index = [self.mtp_stress_order.index(n) for n in self.vasp_stress_order]
+        with zopen(filename, 'rt') as f:
+            for line in f:
+                key = line.strip()
+                if key == 'BEGIN_CFG':
+                    size, lattice, atom_data, energy, stress = 0, [], [], 0.0, None
+                elif key.lower() == 'size':
+                    size = int(next(f))
+                elif key.lower() == 'supercell':
+                    lattice = [next(f) for _ in range(3)]
+                elif key.startswith('AtomData'):
+                    atom_data = [next(f) for _ in range(size)]
+                elif key == 'Energy':
+                    energy = float(next(f))
+                elif key.startswith(('Stress', 'PlusStress')):
+                    stress = np.array(next(f).split(), dtype=float)[stress_index]
+                elif key == 'END_CFG':
+                    atom_data = np.array(' '.join(atom_data).split(), dtype=float).reshape(size, -1)
+                    yield Frame(lattice=np.array(' '.join(lattice).split(), dtype=float).reshape(3, 3),
+                                species=np.full(size, specie), positions=atom_data[:, 2:5],
+                                energy=energy, forces=atom_data[:, 5:8],
+                                stress=np.zeros(6) if stress is None else stress)
+
+    def read_dataset(self, filename, symbol):
+        """
+        Read the configuration file into Dataset.
+
+        Args:
+            filename (str): The configuration file to be read.
+            symbol (str): The element symbol.
+
+        Returns:
+            Dataset.
+        """
+        return Dataset.from_frames(self.iter_cfgs(filename, symbol))
+
     def read_cfgs(self, filename, symbol):
         """
         Read the configuration file.
@@ -362,45 +413,9 @@ class MTPotential(Potential):
             filename (str): The configuration file to be read.
             symbol (str): The element symbol.
         """
-        data_pool = []
-        with zopen(filename, 'rt') as f:
-            lines = f.read()
-
-        block_pattern = re.compile('BEGIN_CFG\n(.*?)\nEND_CFG', re.S)
-        size_pattern = re.compile('Size\n(.*?)\n SuperCell', re.S | re.I)
-        lattice_pattern = re.compile('SuperCell\n(.*?)\n AtomData', re.S | re.I)
-        position_pattern = re.compile('fz\n(.*?)\n Energy', re.S)
-        energy_pattern = re.compile('Energy\n(.*?)\n (?=PlusStress|Stress)', re.S)
-        stress_pattern = re.compile('xy\n(.*?)(?=\n|$)', re.S)
-        formatify = lambda string: [float(s) for s in string.split()]
-        for block in block_pattern.findall(lines):
-            d = {'outputs': {}}
-            size_str = size_pattern.findall(block)[0]
-            size = int(size_str.lstrip())
-            lattice_str = lattice_pattern.findall(block)[0]
-            lattice = Lattice(np.array(list(map(formatify, lattice_str.split('\n')))))
-            position_str = position_pattern.findall(block)[0]
-            position = np.array(list(map(formatify, position_str.split('\n'))))
-            forces = position[:, 5:8].tolist()
-            position = position[:, 2:5]
-            energy_str = energy_pattern.findall(block)[0]
-            energy = float(energy_str.lstrip())
-            stress_str = stress_pattern.findall(block)[0]
-            virial_stress = np.array(list(map(formatify, stress_str.split()))).reshape(6, ).tolist()
-            virial_stress = [virial_stress[self.mtp_stress_order.index(n)]
-                             for n in self.vasp_stress_order]
-            struct = Structure(lattice=lattice, species=[symbol] * size, coords=position,
-                               coords_are_cartesian=True)
-            d['structure'] = struct.as_dict()
-            d['outputs']['energy'] = energy
-            assert size == struct.num_sites
-            d['num_atoms'] = size
-            d['outputs']['forces'] = forces
-            d['outputs']['virial_stress'] = virial_stress
-
-            data_pool.append(d)
-        _, df = convert_docs(docs=data_pool)
-        return data_pool, df
+        dataset = self.read_dataset(filename, symbol)
+        _, df = convert_docs(dataset, return_structures=False)
+        return dataset.to_docs(), df
 
     def train(self, train_structures, energies=None, forces=None, stresses=None,
               unfitted_mtp=None, max_dist=5, radial_basis_size=8, max_iter=500,
@@ -490,6 +505,15 @@ class MTPotential(Potential):
             self.param = load_config(save_fitted_mtp)
         return rc
 
+    def param_hash(self):
+        """
+        Content hash of fitted parameters of the potential.
+        """
+        if not self.param:
+            return None
+        return hash_params([self.__class__.__name__, self.name, str(self.specie),
+                            list(self.param.items())])
+
     def write_param(self, fitted_mtp='fitted.mtp', **kwargs):
         """
         Write fitted mtp parameter file to perform lammps calculation.
@@ -509,7 +533,7 @@ class MTPotential(Potential):
         return ff_settings
 
     def evaluate(self, test_structures, ref_energies=None,
-                 ref_forces=None, ref_stresses=None, **kwargs):
+                 ref_forces=None, ref_stresses=None, backend='mlp', **kwargs):
         """
         Evaluate energies, forces and stresses of structures with trained
         interatomic potentials.
@@ -523,8 +547,20 @@ class MTPotential(Potential):
                 with each single structure case.
             ref_stresses (list): List of DFT-calculated (6, ) viriral stresses
                 of each structure in structures list.
+            backend (str): 'mlp' runs mlp on the written configurations,
+                'numpy' uses the native MTPCalculator in process. Default
+                to 'mlp'.
             kwargs: Parameters of write_param method.
         """
+        if backend == 'numpy':
+            _, df_orig = convert_docs(pool_from(test_structures, ref_energies, ref_forces),
+                                      return_structures=False)
+            results = MTPCalculator(self).calculate(test_structures, lammps_frame=False)
+            predict_set = Dataset.from_structures(test_structures, [r[0] for r in results],
+                                                  [r[1] for r in results])
+            _, df_predict = convert_docs(predict_set, return_structures=False)
+            return df_orig, df_predict
+
         if not which('mlp'):
             raise RuntimeError("mlp has not been found.\n",
                                "Please refer to http://gitlab.skoltech.ru/shapeev/mlip ",
@@ -545,7 +581,8 @@ class MTPotential(Potential):
             self.write_param(fitted_mtp=fitted_mtp, Abinitio=0, Driver=1,
                              Write_cfgs=predict_file, Database_filename=original_file, **kwargs)
             original_file = self.write_cfg(original_file, cfg_pool=predict_pool)
-            _, df_orig = self.read_cfgs(original_file, symbol=symbol)
+            _, df_orig = convert_docs(self.read_dataset(original_file, symbol=symbol),
+                                      return_structures=False)
 
             p = subprocess.Popen(['mlp', 'run', 'mlip.ini',
                                   '--filename={}'.format(original_file)],
@@ -564,20 +601,27 @@ class MTPotential(Potential):
                 raise RuntimeError(error_msg)
             if not os.path.exists(predict_file):
                 predict_file = '_'.join([predict_file, '0'])
-            _, df_predict = self.read_cfgs(predict_file, symbol=symbol)
+            _, df_predict = convert_docs(self.read_dataset(predict_file, symbol=symbol),
+                                         return_structures=False)
         return df_orig, df_predict
 
-    def predict(self, structure):
+    def predict(self, structure, backend='subprocess'):
         """
         Predict energy, forces and stresses of the structure.
 
         Args:
             structure (Structure): Pymatgen Structure object.
+            backend (str): 'subprocess' or 'library' runs LAMMPS through
+                EnergyForceStress, 'numpy' uses the native MTPCalculator.
+                Default to 'subprocess'.
 
         Returns:
             energy, forces, stress
         """
-        calculator = EnergyForceStress(self)
+        if backend == 'numpy':
+            calculator = MTPCalculator(self)
+        else:
+            calculator = EnergyForceStress(ff_settings=self, backend=backend)
         energy, forces, stress = calculator.calculate(structures=[structure])[0]
         return energy, forces, stress
 
@@ -623,3 +667,152 @@ class MTPotential(Potential):
 
             param = load_config(filename)
             return MTPotential(param=param)
+
+
+class MTPCalculator(object):
+    """
+    Native NumPy implementation of the Moment Tensor Potential evaluated
+    by MLIP, serving the same outputs as EnergyForceStress with
+    MTPotential without running LAMMPS or mlp.
+
+    Usage:
+        [(energy, forces, stress)] = calculator.calculate([Structure])
+        energy in eV, forces in eV/Å and stress in GPa with the order
+        xx, yy, zz, xy, xz, yz, with the atomic coordinates transformed
+        into the LAMMPS box frame as EnergyForceStress does.
+
+    """
+
+    def __init__(self, potential, max_size=2000000):
+        """
+        Args:
+            potential (MTPotential): Fitted MTP, e.g., loaded by
+                MTPotential.from_config.
+            max_size (int): Max No. of basic moment terms evaluated at
+                once, which bounds the memory usage. Default to 2000000.
+        """
+        if not potential.param:
+            raise RuntimeError("The parameters should be provided.")
+        settings, radial_coeffs, block = {}, {}, None
+        for line in potential.param['safe']:
+            line = line.strip()
+            if ' = ' in line:
+                key, value = line.split(' = ', 1)
+                settings[key] = value
+            elif line.startswith('{'):
+                radial_coeffs[block].append(json.loads(line.replace('{', '[').replace('}', ']')))
+            elif '-' in line and ' ' not in line:
+                block = line
+                radial_coeffs[block] = []
+
+        def get(key):
+            return json.loads(settings[key].replace('{', '[').replace('}', ']'))
+
+        if settings.get('radial_basis_type') != 'RBChebyshev':
+            raise ValueError('Unsupported radial basis %s' % settings.get('radial_basis_type'))
+        if get('species_count') != 1:
+            raise ValueError('Only single species MTP is supported.')
+        self.scaling = get('scaling')
+        self.min_dist, self.max_dist = get('min_dist'), get('max_dist')
+        self.radial_basis_size = get('radial_basis_size')
+        self.radial_coeffs = np.array(radial_coeffs['0-0'], dtype=float)
+        self.alpha_moments_count = get('alpha_moments_count')
+        self.alpha_index_basic = np.array(get('alpha_index_basic'), dtype=int).reshape(-1, 4)
+        self.alpha_index_times = np.array(get('alpha_index_times'), dtype=int).reshape(-1, 4)
+        self.alpha_moment_mapping = np.array(get('alpha_moment_mapping'), dtype=int)
+        self.species_coeff = potential.param['species_coeffs'][0]
+        self.moment_coeffs = np.array(potential.param['moment_coeffs'], dtype=float)
+        self.max_size = max_size
+
+    def _radial(self, r):
+        """
+        Radial functions of the Chebyshev basis times scaling * (r - max_dist)^2,
+        which vanishes smoothly at max_dist.
+
+        Returns:
+            Values and derivatives with shape (P, radial_funcs_count).
+        """
+        mult = 2.0 / (self.max_dist - self.min_dist)
+        ksi = (2 * r - (self.min_dist + self.max_dist)) / (self.max_dist - self.min_dist)
+        values = np.zeros((len(r), self.radial_basis_size))
+        grads = np.zeros_like(values)
+        values[:, 0] = self.scaling * (r - self.max_dist) ** 2
+        grads[:, 0] = self.scaling * 2 * (r - self.max_dist)
+        if self.radial_basis_size > 1:
+            values[:, 1] = ksi * values[:, 0]
+            grads[:, 1] = mult * values[:, 0] + ksi * grads[:, 0]
+        for i in range(2, self.radial_basis_size):
+            values[:, i] = 2 * ksi * values[:, i - 1] - values[:, i - 2]
+            grads[:, i] = 2 * (mult * values[:, i - 1] + ksi * grads[:, i - 1]) - grads[:, i - 2]
+        return np.dot(values, self.radial_coeffs.T), np.dot(grads, self.radial_coeffs.T)
+
+    def _calculate(self, structure, lammps_frame=True):
+        matrix = structure.lattice.matrix
+        if lammps_frame:
+            _, symmop = lattice_2_lmpbox(structure.lattice)
+            matrix = np.dot(matrix, symmop.rotation_matrix.T)
+        coords = np.dot(structure.frac_coords % 1.0, matrix)
+        n_atoms = len(structure)
+        mu, powers = self.alpha_index_basic[:, 0], self.alpha_index_basic[:, 1:]
+        n_basic, degrees = len(mu), powers.sum(axis=1)
+
+        centers, neighbors, _, vectors, bounds = find_neighbors(coords, matrix, self.max_dist)
+        n_neighbors = len(centers) / max(1, n_atoms)
+        chunk = max(1, int(self.max_size // max(1.0, 4 * n_neighbors * n_basic)))
+        energy = n_atoms * self.species_coeff
+        grads = np.zeros((len(centers), 3))
+        for start in range(0, n_atoms, chunk):
+            stop = min(start + chunk, n_atoms)
+            pairs = slice(bounds[start], bounds[stop])
+            local = centers[pairs] - start
+            distances = np.linalg.norm(vectors[pairs], axis=1)
+            units = vectors[pairs] / distances[:, None]
+            f, df = self._radial(distances)
+            f, df = f[:, mu], df[:, mu]
+
+            # monomials of the unit vector components and their gradients
+            xyz = np.arange(3)
+            unit_powers = units[:, None, :] ** np.arange(powers.max() + 1)[None, :, None]
+            monomials = np.prod(unit_powers[:, powers, xyz], axis=-1)
+            dmonomials = np.stack([powers[:, d] * np.prod(unit_powers[:, powers - (xyz == d) * (powers > 0), xyz],
+                                                          axis=-1) for d in range(3)], axis=-1)
+
+            moments = np.zeros((stop - start, self.alpha_moments_count))
+            np.add.at(moments, (local, slice(0, n_basic)), f * monomials)
+            for i1, i2, mult, i3 in self.alpha_index_times:
+                moments[:, i3] += mult * moments[:, i1] * moments[:, i2]
+            energy += np.sum(np.dot(moments[:, self.alpha_moment_mapping], self.moment_coeffs))
+
+            # derivatives with respect to the moments in the reverse order
+            dmoments = np.zeros_like(moments)
+            dmoments[:, self.alpha_moment_mapping] = self.moment_coeffs
+            for i1, i2, mult, i3 in self.alpha_index_times[::-1]:
+                dmoments[:, i1] += mult * dmoments[:, i3] * moments[:, i2]
+                dmoments[:, i2] += mult * dmoments[:, i3] * moments[:, i1]
+            weights = dmoments[local, :n_basic]
+            radial = np.sum(weights * (df - degrees * f / distances[:, None]) * monomials, axis=1)
+            grads[pairs] = radial[:, None] * units \
+                + np.einsum('pi,pid->pd', weights * f, dmonomials) / distances[:, None]
+
+        forces = np.zeros((n_atoms, 3))
+        np.add.at(forces, centers, grads)
+        np.subtract.at(forces, neighbors, grads)
+        virial = -np.dot(vectors.T, grads) / abs(np.linalg.det(matrix))
+        stress = virial[[0, 1, 2, 0, 0, 1], [0, 1, 2, 1, 2, 2]] * 160.21766208  # from eV/Å^3 to GPa
+        return energy, forces, stress
+
+    def calculate(self, structures, lammps_frame=True):
+        """
+        Calculate the energy, forces and stresses of structures.
+
+        Args:
+            structures ([Structure]): Input structures.
+            lammps_frame (bool): Whether to transform the structures into
+                the LAMMPS box frame as EnergyForceStress does. Default to
+                True, otherwise forces and stresses are in the Cartesian
+                frame of the structures.
+
+        Returns:
+            List of (energy, forces, stress) of each structure.
+        """
+        return [self._calculate(structure, lammps_frame) for structure in structures]
@@ -19,14 +19,26 @@ from monty.tempfile import ScratchDir
 from monty.serialization import loadfn
 from pymatgen import Structure, Lattice, Element
 from pymatgen.core import units
+from pymatgen.io.lammps.data import lattice_2_lmpbox
 
-from mlearn.potentials import Potential
-from mlearn.data import pool_from, convert_docs
+from mlearn.potentials import Potential, hash_params
+from mlearn.data import pool_from, convert_docs, Dataset
+from mlearn.neighbors import find_neighbors
 from mlearn.potentials.lammps.calcs import EnergyForceStress
 
 module_dir = os.path.dirname(__file__)
 NNinput_params = loadfn(os.path.join(module_dir, 'params', 'NNinput.json'))
 
+# records of weights file, bias rows only have the first five fields
+_WEIGHT_DTYPE = np.dtype([('value', np.float64), ('type', 'U1'), ('index', int),
+                          ('start_layer', int), ('start_neuron', int),
+                          ('end_layer', int), ('end_neuron', int)])
+_WEIGHT_FORMAT = {'a': '%.16E%2s%10d%6d%6d%6d%6d', 'b': '%.16E%2s%10d%6d%6d'}
+_SCALING_DTYPE = np.dtype([('e_index', int), ('sf_index', int), ('sf_min', np.float64),
+                           ('sf_max', np.float64), ('sf_mean', np.float64),
+                           ('sf_sigma', np.float64)])
+_SCALING_FORMAT = '%4d%5d  %.16E %.16E %.16E %.16E'
+
 
 class NNPotential(Potential):
     """
@@ -109,29 +121,29 @@ class NNPotential(Potential):
         Args:
             filename (str): The filename to be written.
             cfg_pool (list): The configuration pool contains
-                structure and energy/forces properties.
+                structure and energy/forces properties, which can also
+                be a generator of docs, e.g., from iter_docs.
         """
-        lines = []
-        for dataset in cfg_pool:
-            if isinstance(dataset['structure'], dict):
-                structure = Structure.from_dict(dataset['structure'])
-            else:
-                structure = dataset['structure']
-            energy = dataset['outputs']['energy']
-            forces = dataset['outputs']['forces']
-            virial_stress = dataset['outputs']['virial_stress']
+        with open(filename, 'w') as f:
+            for i, dataset in enumerate(cfg_pool):
+                if isinstance(dataset['structure'], dict):
+                    structure = Structure.from_dict(dataset['structure'])
+                else:
+                    structure = dataset['structure']
+                energy = dataset['outputs']['energy']
+                forces = dataset['outputs']['forces']
+                virial_stress = dataset['outputs']['virial_stress']
 
-            lines.append(self._line_up(structure, energy, forces, virial_stress))
+                if i:
+                    f.write('\n')
+                f.write(self._line_up(structure, energy, forces, virial_stress))
 
-            # dist = np.unique(structure.distance_matrix.ravel())[1]
-            # if self.shortest_distance > dist:
-            #     self.shortest_distance = dist
+                # dist = np.unique(structure.distance_matrix.ravel())[1]
+                # if self.shortest_distance > dist:
+                #     self.shortest_distance = dist
 
         self.specie = Element(structure.symbol_set[0])
 
-        with open(filename, 'w') as f:
-            f.write('\n'.join(lines))
-
         return filename
 
     def write_input(self, **kwargs):
@@ -472,27 +484,19 @@ class NNPotential(Potential):
             weights_filename (str): The weights file.
         """
         with open(weights_filename) as f:
-            weights_lines = f.readlines()
-
-        weight_param = pd.DataFrame([line.split() for line in weights_lines
-                                     if "#" not in line])
-        weight_param.columns = ['value', 'type', 'index', 'start_layer',
-                                'start_neuron', 'end_layer', 'end_neuron']
-
-        for layer_index in range(1, len(self.layer_sizes)):
-            weights_group = weight_param[(weight_param['start_layer'] == str(layer_index - 1))
-                                         & (weight_param['end_layer'] == str(layer_index))]
-
-            weights = np.reshape(np.array(weights_group['value'], dtype=np.float),
-                                 (self.layer_sizes[layer_index - 1],
-                                  self.layer_sizes[layer_index]))
-            self.weights.append(weights)
-
-            bs_group = weight_param[(weight_param['type'] == 'b') &
-                                    (weight_param['start_layer'] == str(layer_index))]
-            bs = np.array(bs_group['value'], dtype=np.float)
-            self.bs.append(bs)
-
+            lines = [line for line in f if '#' not in line and line.strip()]
+        is_weight = np.array([line.split(None, 2)[1] == 'a' for line in lines], dtype=bool)
+        lines = np.array(lines, dtype=object)
+
+        weight_param = np.zeros(len(lines), dtype=_WEIGHT_DTYPE)
+        weight_param[is_weight] = np.loadtxt(lines[is_weight].tolist(), dtype=_WEIGHT_DTYPE,
+                                             ndmin=1)
+        biases = np.loadtxt(lines[~is_weight].tolist(), ndmin=1,
+                            dtype=np.dtype(_WEIGHT_DTYPE.descr[:5]))
+        for name in biases.dtype.names:
+            weight_param[name][~is_weight] = biases[name]
+
+        self.weights, self.bs = _layer_params(weight_param)
         self.weight_param = weight_param
 
     def load_scaler(self, scaling_filename):
@@ -502,13 +506,8 @@ class NNPotential(Potential):
         Args:
             scaling_filename (str): The scaling file.
         """
-        with open(scaling_filename) as f:
-            scaling_lines = f.readlines()
-        scaling_param = pd.DataFrame([line.split() for line in scaling_lines
-                                      if '#' not in line])
-        # scaling_param.column = ['e_index', 'sf_index', 'sf_min', 'sf_max', \
-        #                         'sf_mean', 'sf_sigma']
-        self.scaling_param = scaling_param
+        self.scaling_param = np.loadtxt(scaling_filename, dtype=_SCALING_DTYPE,
+                                        comments='#', ndmin=1)
 
     def read_cfgs(self, filename='output.data'):
         """
@@ -550,9 +549,20 @@ class NNPotential(Potential):
             d['num_atoms'] = len(struct)
 
             data_pool.append(d)
-        _, df = convert_docs(docs=data_pool)
+        _, df = convert_docs(docs=data_pool, return_structures=False)
         return data_pool, df
 
+    def param_hash(self):
+        """
+        Content hash of network settings, weights and scaling data of the
+        potential.
+        """
+        if self.weight_param is None or self.scaling_param is None:
+            return None
+        return hash_params([self.__class__.__name__, self.name, str(self.specie),
+                            getattr(self, 'suffix', None), self.param],
+                           self.weight_param, self.scaling_param)
+
     def write_param(self):
         """
         Write optimized weights file to perform energy and force prediction.
@@ -560,25 +570,23 @@ class NNPotential(Potential):
         if self.weight_param is None or self.scaling_param is None:
             raise RuntimeError("The parameters should be provided.")
         weights_filename = '.'.join(['weights', self.suffix, 'data'])
-        weight_formatter = '{:>18s}{:>2s}{:>10s}{:>6s}{:>6s}{:>6s}{:>6s}'
-        bias_formatter = '{:>18s}{:>2s}{:>10s}{:>6s}{:>6}'
-        lines = []
-        for i in range(self.weight_param.shape[0]):
-            if self.weight_param.iloc[i]['type'] == 'a':
-                lines.append(weight_formatter.format(*self.weight_param.iloc[i]))
-            else:
-                lines.append(bias_formatter.format(*self.weight_param.iloc[i]))
-
+        weight_param = self.weight_param
+        is_weight = weight_param['type'] == 'a'
+        table = np.empty((len(weight_param), len(_WEIGHT_DTYPE.names)), dtype=object)
+        for i, name in enumerate(_WEIGHT_DTYPE.names):
+            table[:, i] = weight_param[name].tolist()
+        fields = np.ones(table.shape, dtype=bool)
+        fields[~is_weight, 5:] = False
+        template = '\n'.join(np.where(is_weight, _WEIGHT_FORMAT['a'], _WEIGHT_FORMAT['b']))
         with open(weights_filename, 'w') as f:
-            f.writelines('\n'.join(lines))
+            f.write(template % tuple(table[fields]))
 
         scaling_filename = 'scaling.data'
-        scaling_formatter = '{:>4s}{:>5s}  {:>22s} {:>22s} {:>22s} {:.>22s}'
-        scaling_lines = []
-        for i in range(self.num_symm_functions):
-            scaling_lines.append(scaling_formatter.format(*self.scaling_param.iloc[i]))
+        table = np.empty((len(self.scaling_param), len(_SCALING_DTYPE.names)), dtype=object)
+        for i, name in enumerate(_SCALING_DTYPE.names):
+            table[:, i] = self.scaling_param[name].tolist()
         with open(scaling_filename, 'w') as f:
-            f.writelines('\n'.join(scaling_lines))
+            f.write('\n'.join([_SCALING_FORMAT] * len(table)) % tuple(table.ravel()))
 
         self.write_input()
 
@@ -656,7 +664,8 @@ class NNPotential(Potential):
 
         return rc
 
-    def evaluate(self, test_structures, ref_energies, ref_forces, ref_stresses):
+    def evaluate(self, test_structures, ref_energies, ref_forces, ref_stresses,
+                 backend='n2p2'):
         """
         Evaluate energies, forces and stresses of structures with trained
         interatomic potentials.
@@ -670,8 +679,19 @@ class NNPotential(Potential):
                 with each single structure case.
             ref_stresses (list): List of DFT-calculated (6, ) viriral stresses
                 of each structure in structures list.
+            backend (str): 'n2p2' runs the n2p2 predictor, 'numpy' uses
+                the native NNPCalculator in process. Default to 'n2p2'.
         """
-        if not which('nnp-predict'):
+        if backend == 'numpy':
+            _, df_orig = convert_docs(pool_from(test_structures, ref_energies, ref_forces),
+                                      return_structures=False)
+            results = NNPCalculator(self).calculate(test_structures, lammps_frame=False)
+            predict_set = Dataset.from_structures(test_structures, [r[0] for r in results],
+                                                  [r[1] for r in results])
+            _, df_predict = convert_docs(predict_set, return_structures=False)
+            return df_orig, df_predict
+
+        if not which('nnp-dataset') and not which('nnp-predict'):
             raise RuntimeError("NNP Predictor has not been found.")
 
         original_file = 'input.data'
@@ -686,41 +706,63 @@ class NNPotential(Potential):
 
             input_filename = self.write_input()
 
-            dfs = []
-            for data in predict_pool:
-                _ = self.write_cfgs(original_file, cfg_pool=[data])
-                p = subprocess.Popen(['nnp-predict', input_filename], stdout=subprocess.PIPE)
-                stdout = p.communicate()[0]
-
-                rc = p.returncode
-                if rc != 0:
-                    error_msg = 'RuNNer exited with return code %d' % rc
-                    msg = stdout.decode("utf-8").split('\n')[:-1]
-                    try:
-                        error_line = [i for i, m in enumerate(msg)
-                                      if m.startswith('ERROR')][0]
-                        error_msg += ', '.join([e for e in msg[error_line:]])
-                    except Exception:
-                        error_msg += msg[-1]
-                    raise RuntimeError(error_msg)
-
-                _, df = self.read_cfgs(predict_file)
-                dfs.append(df)
-            df_predict = pd.concat(dfs, ignore_index=True)
+            if which('nnp-dataset'):
+                # predict all structures in input.data at once, loading the network only once.
+                # nnp-dataset <nbins> writes the predictions to output.data in the input.data
+                # layout, structures in input order, as nnp-predict does for one structure.
+                self._run_predictor(['nnp-dataset', '0'])
+                _, df_predict = self.read_cfgs(predict_file)
+            else:
+                dfs = []
+                for data in predict_pool:
+                    _ = self.write_cfgs(original_file, cfg_pool=[data])
+                    self._run_predictor(['nnp-predict', input_filename])
+                    _, df = self.read_cfgs(predict_file)
+                    dfs.append(df)
+                df_predict = pd.concat(dfs, ignore_index=True)
 
         return df_orig, df_predict
 
-    def predict(self, structure):
+    @staticmethod
+    def _run_predictor(cmd):
+        """
+        Run the n2p2 predictor in current directory.
+
+        Args:
+            cmd ([str]): The command to be run.
+        """
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        stdout = p.communicate()[0]
+
+        rc = p.returncode
+        if rc != 0:
+            error_msg = 'RuNNer exited with return code %d' % rc
+            msg = stdout.decode("utf-8").split('\n')[:-1]
+            try:
+                error_line = [i for i, m in enumerate(msg)
+                              if m.startswith('ERROR')][0]
+                error_msg += ', '.join([e for e in msg[error_line:]])
+            except Exception:
+                error_msg += msg[-1]
+            raise RuntimeError(error_msg)
+
+    def predict(self, structure, backend='subprocess'):
         """
         Predict energy, forces and stresses of the structure.
 
         Args:
             structure (Structure): Pymatgen Structure object.
+            backend (str): 'subprocess' or 'library' runs LAMMPS through
+                EnergyForceStress, 'numpy' uses the native NNPCalculator.
+                Default to 'subprocess'.
 
         Returns:
             energy, forces, stress
         """
-        calculator = EnergyForceStress(self)
+        if backend == 'numpy':
+            calculator = NNPCalculator(self)
+        else:
+            calculator = EnergyForceStress(self, backend=backend)
         energy, forces, stress = calculator.calculate(structures=[structure])[0]
         return energy, forces, stress
 
@@ -744,3 +786,275 @@ class NNPotential(Potential):
         nnp.fitted = True
 
         return nnp
+
+
+def _layer_params(weight_param):
+    """
+    Group the weights records of n2p2 by layer.
+
+    Args:
+        weight_param (np.ndarray): Records of weights file.
+
+    Returns:
+        Lists of weights matrices with shape (n_in, n_out) and bias vectors
+        of each layer, including the output layer.
+    """
+    connections = weight_param[weight_param['type'] == 'a']
+    biases = weight_param[weight_param['type'] == 'b']
+    weights, bs = [], []
+    for layer in range(1, connections['end_layer'].max() + 1):
+        group = connections[connections['end_layer'] == layer]
+        layer_weights = np.zeros((group['start_neuron'].max(), group['end_neuron'].max()))
+        layer_weights[group['start_neuron'] - 1, group['end_neuron'] - 1] = group['value']
+        group = biases[biases['start_layer'] == layer]
+        layer_bs = np.zeros(layer_weights.shape[1])
+        layer_bs[group['start_neuron'] - 1] = group['value']
+        weights.append(layer_weights)
+        bs.append(layer_bs)
+    return weights, bs
+
+
+def _activation(kind, x):
+    """
+    Activation function of n2p2 and its derivative.
+
+    Args:
+        kind (str): Activation type, 'l' (linear), 't' (tanh),
+            's' (logistic), 'p' (softplus) or 'r' (relu).
+        x (np.ndarray): Input of the activation.
+
+    Returns:
+        Activation values and derivatives.
+    """
+    if kind == 'l':
+        return x, np.ones_like(x)
+    if kind == 't':
+        y = np.tanh(x)
+        return y, 1.0 - y ** 2
+    if kind == 's':
+        y = 0.5 * (np.tanh(0.5 * x) + 1.0)
+        return y, y * (1.0 - y)
+    if kind == 'p':
+        return np.logaddexp(0.0, x), 0.5 * (np.tanh(0.5 * x) + 1.0)
+    if kind == 'r':
+        return np.maximum(x, 0.0), (x > 0).astype(float)
+    raise ValueError('Unsupported activation type %s' % kind)
+
+
+class NNPCalculator(object):
+    """
+    Native NumPy implementation of the Behler-Parrinello Neural Network
+    Potential evaluated by n2p2, serving the same outputs as
+    EnergyForceStress with NNPotential without running LAMMPS or n2p2.
+
+    Usage:
+        [(energy, forces, stress)] = calculator.calculate([Structure])
+        energy in eV, forces in eV/Å and stress in GPa with the order
+        xx, yy, zz, xy, xz, yz, with the atomic coordinates transformed
+        into the LAMMPS box frame as EnergyForceStress does.
+
+    """
+
+    def __init__(self, potential, max_size=2000000):
+        """
+        Args:
+            potential (NNPotential): Trained Neural Network Potential with
+                symmetry function parameters, weights and scaling data.
+            max_size (int): Max No. of triplet terms evaluated at once,
+                which bounds the memory usage. Default to 2000000.
+        """
+        if potential.weight_param is None or potential.scaling_param is None:
+            raise RuntimeError("The parameters should be provided.")
+        param = potential.param
+        self.bohr_to_angstrom = potential.bohr_to_angstrom
+        self.eV_to_Ha = potential.eV_to_Ha
+        self.max_size = max_size
+
+        self.cutoff_type = int(param.get('cutoff_type', 1))
+        if self.cutoff_type not in (0, 1, 2):
+            raise ValueError('Unsupported cutoff type %d' % self.cutoff_type)
+        # symmetry function parameters in bohr as written in input.nn,
+        # sorted by n2p2 in the order of eta, rs for radial functions and
+        # eta, zeta, lambda for angular functions
+        self.r_cut = float('%.7f' % (param['r_cut'] / self.bohr_to_angstrom))
+        self.r_params = np.array(sorted((float('%.7f' % eta), float('%.7f' % (rs / self.bohr_to_angstrom)))
+                                        for eta, rs in itertools.product(param['r_etas'], param['r_shift'])))
+        self.a_params = np.array(sorted((float('%.7f' % eta), float('%.7f' % zeta), int(lambd))
+                                        for eta, lambd, zeta in itertools.product(param['a_etas'],
+                                                                                  param['lambdas'],
+                                                                                  param['zetas'])))
+
+        scaling = potential.scaling_param
+        g_min, g_max, g_mean, g_sigma = [scaling[name] for name in
+                                         ('sf_min', 'sf_max', 'sf_mean', 'sf_sigma')]
+        s_min = float(param.get('scale_min_short', 0.0))
+        s_max = float(param.get('scale_max_short', 1.0))
+        scale_features = str(param.get('scale_features', 0))
+        if scale_features == '1':
+            self.shift, self.factor, self.offset = g_min, (s_max - s_min) / (g_max - g_min), s_min
+        elif scale_features == '2':
+            self.shift, self.factor, self.offset = g_mean, np.ones_like(g_mean), 0.0
+        elif scale_features == '3':
+            self.shift, self.factor, self.offset = g_mean, (s_max - s_min) / g_sigma, s_min
+        else:
+            self.shift, self.factor, self.offset = np.zeros_like(g_mean), np.ones_like(g_mean), 0.0
+        if len(self.factor) != len(self.r_params) + len(self.a_params):
+            raise ValueError('Scaling data do not match the symmetry functions.')
+
+        self.weights, self.bs = _layer_params(potential.weight_param)
+        self.activations = [param.get('activations', 't')] * (len(self.weights) - 1) + ['l']
+        self.normalize_nodes = bool(param.get('normalize_nodes') or potential.normalized_nodes)
+        self.atom_energy = float(param.get('atom_energy') or 0.0)
+
+    def _cutoff(self, r):
+        """
+        Cutoff function and its derivative.
+        """
+        if self.cutoff_type == 0:
+            return np.ones_like(r), np.zeros_like(r)
+        x = r / self.r_cut
+        if self.cutoff_type == 1:
+            return 0.5 * (np.cos(np.pi * x) + 1.0), -0.5 * np.pi / self.r_cut * np.sin(np.pi * x)
+        t = np.tanh(1.0 - x)
+        return t ** 3, -3.0 * t ** 2 * (1.0 - t ** 2) / self.r_cut
+
+    def _radial(self, r):
+        """
+        Radial symmetry functions G2 of pairs and their derivatives with
+        respect to the distances, with shape (n_pairs, n_radial).
+        """
+        etas, shifts = self.r_params.T
+        fc, dfc = self._cutoff(r)
+        dr = r[:, None] - shifts
+        gauss = np.exp(-etas * dr ** 2)
+        return gauss * fc[:, None], gauss * (dfc[:, None] - 2.0 * etas * dr * fc[:, None])
+
+    def _angular(self, r1, r2, r3, cos):
+        """
+        Terms of angular symmetry functions G3 of triplets, with shape
+        (n_triplets, n_angular).
+        """
+        etas, zetas, lambdas = self.a_params.T
+        base = 1.0 + lambdas * cos[:, None]
+        power = base ** (zetas - 1.0)
+        gauss = 2.0 ** (1.0 - zetas) * np.exp(-etas * (r1 ** 2 + r2 ** 2 + r3 ** 2)[:, None])
+        return power * base * gauss, zetas * lambdas * power * gauss
+
+    def _network(self, x):
+        """
+        Forward pass of the atomic neural network over all atoms at once.
+
+        Args:
+            x (np.ndarray): Scaled symmetry functions with shape
+                (n_atoms, n_symmetry_functions).
+
+        Returns:
+            Atomic energies and their derivatives with respect to x.
+        """
+        h, derivatives = x, []
+        for weights, bs, kind in zip(self.weights, self.bs, self.activations):
+            z = np.dot(h, weights) + bs
+            if self.normalize_nodes:
+                z /= weights.shape[0]
+            h, dh = _activation(kind, z)
+            derivatives.append(dh)
+        delta = np.ones_like(h)
+        for weights, dh in zip(self.weights[::-1], derivatives[::-1]):
+            delta = delta * dh
+            if self.normalize_nodes:
+                delta /= weights.shape[0]
+            delta = np.dot(delta, weights.T)
+        return h[:, 0], delta
+
+    def _triplets(self, centers, bounds, distances, vectors):
+        """
+        Yield chunks of neighbor pair indices (p, q), p < q, sharing the
+        same center with the distance between both neighbors within cutoff.
+        """
+        n_atoms = len(bounds) - 1
+        n_neighbors = len(centers) / max(1, n_atoms)
+        chunk = max(1, int(self.max_size // max(1.0, n_neighbors ** 2 * len(self.a_params))))
+        for start in range(0, n_atoms, chunk):
+            pairs = np.arange(bounds[start], bounds[min(start + chunk, n_atoms)])
+            counts = bounds[centers[pairs] + 1] - pairs - 1
+            p = np.repeat(pairs, counts)
+            q = p + 1 + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            r3 = np.linalg.norm(vectors[q] - vectors[p], axis=1)
+            inside = r3 < self.r_cut
+            yield p[inside], q[inside], r3[inside]
+
+    def _calculate(self, structure, lammps_frame=True):
+        matrix = structure.lattice.matrix / self.bohr_to_angstrom
+        if lammps_frame:
+            _, symmop = lattice_2_lmpbox(structure.lattice)
+            matrix = np.dot(matrix, symmop.rotation_matrix.T)
+        coords = np.dot(structure.frac_coords % 1.0, matrix)
+        n_atoms, n_radial = len(structure), len(self.r_params)
+
+        centers, neighbors, _, vectors, bounds = find_neighbors(coords, matrix, self.r_cut)
+        distances = np.linalg.norm(vectors, axis=1)
+
+        def angles(p, q, r3):
+            r1, r2 = distances[p], distances[q]
+            cos = np.clip(np.sum(vectors[p] * vectors[q], axis=1) / (r1 * r2), -1.0, 1.0)
+            return r1, r2, r3, cos
+
+        g = np.zeros((n_atoms, n_radial + len(self.a_params)))
+        g_radial, dg_radial = self._radial(distances)
+        np.add.at(g, (centers, slice(0, n_radial)), g_radial)
+        for p, q, r3 in self._triplets(centers, bounds, distances, vectors):
+            r1, r2, r3, cos = angles(p, q, r3)
+            fc = np.prod([self._cutoff(r)[0] for r in (r1, r2, r3)], axis=0)
+            values, _ = self._angular(r1, r2, r3, cos)
+            np.add.at(g, (centers[p], slice(n_radial, None)), values * fc[:, None])
+
+        atomic_energies, dx = self._network((g - self.shift) * self.factor + self.offset)
+        dg = dx * self.factor
+
+        # derivatives of the energy with respect to the pair vectors
+        grads = np.sum(dg[centers, :n_radial] * dg_radial, axis=1)[:, None] * vectors / distances[:, None]
+        # the triplets are searched again rather than kept to bound the memory by max_size
+        for p, q, r3 in self._triplets(centers, bounds, distances, vectors):
+            r1, r2, r3, cos = angles(p, q, r3)
+            a, c = vectors[p], vectors[q]
+            (f1, df1), (f2, df2), (f3, df3) = [self._cutoff(r) for r in (r1, r2, r3)]
+            fc = f1 * f2 * f3
+            values, dvalues = self._angular(r1, r2, r3, cos)
+            weights = dg[centers[p], n_radial:]
+            s_cos = np.sum(weights * dvalues, axis=1) * fc
+            s_val = np.sum(weights * values, axis=1)
+            s_eta = -2.0 * np.sum(weights * values * self.a_params[:, 0], axis=1) * fc
+            s1 = s_eta * r1 + s_val * df1 * f2 * f3
+            s2 = s_eta * r2 + s_val * f1 * df2 * f3
+            s3 = (s_eta * r3 + s_val * f1 * f2 * df3) / r3
+            d = c - a
+            np.add.at(grads, p, s_cos[:, None] * (c / (r1 * r2)[:, None] - cos[:, None] * a / (r1 ** 2)[:, None])
+                      + (s1 / r1)[:, None] * a - s3[:, None] * d)
+            np.add.at(grads, q, s_cos[:, None] * (a / (r1 * r2)[:, None] - cos[:, None] * c / (r2 ** 2)[:, None])
+                      + (s2 / r2)[:, None] * c + s3[:, None] * d)
+
+        energy = (np.sum(atomic_energies) + n_atoms * self.atom_energy) / self.eV_to_Ha
+        forces = np.zeros((n_atoms, 3))
+        np.add.at(forces, centers, grads)
+        np.subtract.at(forces, neighbors, grads)
+        forces /= self.eV_to_Ha * self.bohr_to_angstrom
+        virial = -np.dot(vectors.T, grads) / abs(np.linalg.det(matrix))
+        stress = virial[[0, 1, 2, 0, 0, 1], [0, 1, 2, 1, 2, 2]] * 160.21766208 \
+            / (self.eV_to_Ha * self.bohr_to_angstrom ** 3)
+        return energy, forces, stress
+
+    def calculate(self, structures, lammps_frame=True):
+        """
+        Calculate the energy, forces and stresses of structures.
+
+        Args:
+            structures ([Structure]): Input structures.
+            lammps_frame (bool): Whether to transform the structures into
+                the LAMMPS box frame as EnergyForceStress does. Default to
+                True, otherwise forces and stresses are in the Cartesian
+                frame of the structures.
+
+        Returns:
+            List of (energy, forces, stress) of each structure.
+        """
+        return [self._calculate(structure, lammps_frame) for structure in structures]
@@ -5,14 +5,16 @@
 """This module provides SNAP interatomic potential class."""
 
 import re
+import itertools
 import numpy as np
 from monty.io import zopen
 from pymatgen import Element
-from mlearn.potentials import Potential
+from mlearn.potentials import Potential, hash_params
 from mlearn.models import LinearModel
 from mlearn.data import pool_from, convert_docs
 from mlearn.potentials.lammps.calcs import EnergyForceStress
-from mlearn.describers import BispectrumCoefficients
+from mlearn.describers import BispectrumCoefficients, NativeSpectralNeighborAnalysis, \
+    get_bs_index, _wigner_u
 
 
 class SNAPotential(Potential):
@@ -55,7 +57,7 @@ class SNAPotential(Potential):
                 structure in structures list.
         """
         train_pool = pool_from(train_structures, energies, forces, stresses)
-        _, df = convert_docs(train_pool)
+        _, df = convert_docs(train_pool, return_structures=False)
         ytrain = df['y_orig'] / df['n']
         self.model.fit(inputs=train_structures, outputs=ytrain, **kwargs)
         self.specie = Element(train_structures[0].symbol_set[0])
@@ -77,28 +79,45 @@ class SNAPotential(Potential):
         """
         predict_pool = pool_from(test_structures, ref_energies,
                                  ref_forces, ref_stresses)
-        _, df_orig = convert_docs(predict_pool)
+        _, df_orig = convert_docs(predict_pool, return_structures=False)
 
-        _, df_predict = convert_docs(pool_from(test_structures))
+        _, df_predict = convert_docs(pool_from(test_structures), return_structures=False)
         outputs = self.model.predict(inputs=test_structures, override=True)
         df_predict['y_orig'] = df_predict['n'] * outputs
 
         return df_orig, df_predict
 
-    def predict(self, structure):
+    def predict(self, structure, backend='subprocess'):
         """
         Predict energy, forces and stresses of the structure.
 
         Args:
             structure (Structure): Pymatgen Structure object.
+            backend (str): 'subprocess' or 'library' runs LAMMPS through
+                EnergyForceStress, 'numpy' uses the native SNAPCalculator.
+                Default to 'subprocess'.
 
         Returns:
             energy, forces, stress
         """
-        calculator = EnergyForceStress(ff_settings=self)
+        if backend == 'numpy':
+            calculator = SNAPCalculator(self)
+        else:
+            calculator = EnergyForceStress(ff_settings=self, backend=backend)
         energy, forces, stress = calculator.calculate(structures=[structure])[0]
         return energy, forces, stress
 
+    def param_hash(self):
+        """
+        Content hash of coefficients and describer settings of the potential.
+        """
+        describer = self.model.describer
+        settings = [self.__class__.__name__, self.name, str(self.specie),
+                    describer.element_profile]
+        settings += [getattr(describer, k) for k in
+                     ['rcutfac', 'twojmax', 'rfac0', 'rmin0', 'diagonalstyle', 'quadratic']]
+        return hash_params(settings, np.asarray(self.model.coef, dtype=float))
+
     def write_param(self):
         """
         Write parameter and coefficient file to perform lammps calculation.
@@ -207,3 +226,162 @@ class SNAPotential(Potential):
         snap = SNAPotential(model=model)
         snap.specie = Element(specie)
         return snap
+
+
+_VOIGT_LAMMPS = [(0, 0), (1, 1), (2, 2), (0, 1), (0, 2), (1, 2)]
+
+
+class SNAPCalculator(object):
+    """
+    Native NumPy predictor of SNAP and quadratic SNAP, evaluating the same
+    energies, forces and stresses as pair_style snap in LAMMPS directly
+    from the coefficients, with the bispectrum components computed by
+    NativeSpectralNeighborAnalysis, without running LAMMPS or writing
+    any file.
+
+    Usage:
+        [(energy, forces, stress)] = calculator.calculate([Structure])
+        energy in eV, forces in eV/Å and stress in GPa with the order
+        xx, yy, zz, xy, xz, yz, with the atomic coordinates transformed
+        into the LAMMPS box frame as EnergyForceStress does.
+        energies = calculator.calculate_energies(structures) only
+        computes the energies, skipping all derivatives.
+
+    """
+
+    def __init__(self, potential, max_size=4000000):
+        """
+        Args:
+            potential (SNAPotential): SNAP with trained coefficients, e.g.,
+                loaded by SNAPotential.from_config.
+            max_size (int): Max No. of complex numbers held for a chunk of
+                atoms, which bounds the memory usage. Default to 4000000.
+        """
+        describer = potential.model.describer
+        self.sna = NativeSpectralNeighborAnalysis(describer.rcutfac, describer.twojmax,
+                                                  describer.element_profile,
+                                                  describer.rfac0, describer.rmin0,
+                                                  describer.diagonalstyle,
+                                                  describer.quadratic, max_size=max_size)
+        index = get_bs_index(describer.twojmax, describer.diagonalstyle, describer.quadratic)
+        n_bs = len(index.subscripts)
+        coef = np.reshape(np.asarray(potential.model.coef, dtype=float), (len(self.sna.elements), -1))
+        self.beta0 = coef[:, 0]
+        self.beta = coef[:, 1:1 + n_bs]
+        # quadratic coefficients as symmetric matrices, i.e.,
+        # E_i = beta0 + beta . B_i + 1/2 B_i . alpha . B_i
+        self.alpha = np.zeros((len(coef), n_bs, n_bs))
+        if describer.quadratic:
+            ia, ib = index.quadratic_pairs.T
+            self.alpha[:, ia, ib] = coef[:, 1 + n_bs:]
+            self.alpha[:, ib, ia] = coef[:, 1 + n_bs:]
+        self.quadratic = describer.quadratic
+        self.weights = np.array([describer.element_profile[e]['w'] for e in self.sna.elements])
+        self.max_size = max_size
+
+    def _evaluate(self, structures, derivatives=True):
+        """
+        Evaluate a batch of structures at once, with the neighbor pairs of
+        all structures concatenated.
+
+        Returns:
+            Energies, forces of all atoms and virial sums (in eV) of each
+            structure, the latter two are None if derivatives is False.
+        """
+        twojmax, rfac0, rmin0 = self.sna.twojmax, self.sna.rfac0, self.sna.rmin0
+        data = [self.sna._neighbors(s) for s in structures]
+        n_atoms = np.array([len(d[0]) for d in data], dtype=int)
+        n_pairs = np.array([len(d[2]) for d in data], dtype=int)
+        offsets = np.cumsum(n_atoms) - n_atoms
+        types = np.concatenate([d[0] for d in data] + [np.zeros(0, dtype=int)])
+        centers = np.concatenate([d[2] + o for d, o in zip(data, offsets)] + [np.zeros(0, dtype=int)])
+        neighbors = np.concatenate([d[3] + o for d, o in zip(data, offsets)] + [np.zeros(0, dtype=int)])
+        vectors = np.concatenate([d[4] for d in data] + [np.zeros((0, 3))])
+        rcuts = np.concatenate([d[5] for d in data] + [np.zeros(0)])
+        pair_owners = np.repeat(np.arange(len(data)), n_pairs)
+
+        total = n_atoms.sum()
+        n_u = sum((j + 1) ** 2 for j in range(twojmax + 1))
+        n_bs = self.beta.shape[1]
+        diagonal = np.concatenate([np.arange(j + 1) * (j + 2) + sum((k + 1) ** 2 for k in range(j))
+                                   for j in range(twojmax + 1)])
+        atomic_energies = np.zeros(total)
+        forces = np.zeros((total, 3)) if derivatives else None
+        virials = np.zeros((len(data), 6)) if derivatives else None
+        bounds = np.searchsorted(centers, np.arange(total + 1))
+        n_neighbors = len(centers) / max(1, total)
+        chunk = max(1, int(self.max_size // (((3 if derivatives else 1) * n_neighbors + n_bs) * n_u)))
+        for start in range(0, total, chunk):
+            stop = min(start + chunk, total)
+            pairs = slice(bounds[start], bounds[stop])
+            local = centers[pairs] - start
+            u, du = _wigner_u(vectors[pairs], rcuts[pairs], twojmax, rfac0, rmin0, derivatives)
+            weight = self.weights[types[neighbors[pairs]]]
+            u_tot = np.zeros((stop - start, n_u), dtype=complex)
+            u_tot[:, diagonal] = 1.0
+            np.add.at(u_tot, local, weight[:, None] * u)
+            b, y = self.sna._bispectrum(u_tot, derivatives)
+            t = types[start:stop]
+            grad = self.beta[t]
+            if self.quadratic:
+                grad = grad + 0.5 * np.einsum('ikl,il->ik', self.alpha[t], b)
+            atomic_energies[start:stop] = self.beta0[t] + np.sum(grad * b, axis=1)
+            if not derivatives:
+                continue
+            if self.quadratic:
+                grad = self.beta[t] + np.einsum('ikl,il->ik', self.alpha[t], b)
+            # dE_i / dr_j of each pair contracted with Y weighted by dE_i / dB_i
+            y = np.einsum('ik,iku->iu', grad, y)
+            g = np.einsum('pdu,pu->pd', du, y[local]).real * weight[:, None]
+            np.add.at(forces, centers[pairs], g)
+            np.subtract.at(forces, neighbors[pairs], g)
+            d = vectors[pairs]
+            np.add.at(virials, pair_owners[pairs],
+                      -np.stack([g[:, i] * d[:, j] for i, j in _VOIGT_LAMMPS], axis=1))
+        energies = np.bincount(np.repeat(np.arange(len(data)), n_atoms), atomic_energies,
+                               minlength=len(data))
+        return energies, forces, virials
+
+    def _batches(self, structures, batch_size):
+        structures = iter(structures)
+        return iter(lambda: list(itertools.islice(structures, batch_size)), [])
+
+    def calculate(self, structures, batch_size=100):
+        """
+        Calculate the energy, forces and stresses of structures.
+
+        Args:
+            structures ([Structure]): Input structures, as a list or an
+                iterable consumed in batches.
+            batch_size (int): No. of structures evaluated at a time.
+                Default to 100.
+
+        Returns:
+            List of (energy, forces, stress) of each structure.
+        """
+        results = []
+        for batch in self._batches(structures, batch_size):
+            energies, forces, virials = self._evaluate(batch)
+            n_atoms = [len(s) for s in batch]
+            volumes = np.array([s.volume for s in batch])
+            stresses = virials / volumes[:, None] * 160.21766208  # from eV/Å^3 to GPa
+            results.extend(zip(energies, np.split(forces, np.cumsum(n_atoms)[:-1]), stresses))
+        return results
+
+    def calculate_energies(self, structures, batch_size=1000):
+        """
+        Calculate the energies of structures only, e.g., for screening a
+        large number of candidates.
+
+        Args:
+            structures ([Structure]): Input structures, as a list or an
+                iterable consumed in batches.
+            batch_size (int): No. of structures evaluated at a time.
+                Default to 1000.
+
+        Returns:
+            Energies as np.ndarray.
+        """
+        energies = [self._evaluate(batch, derivatives=False)[0]
+                    for batch in self._batches(structures, batch_size)]
+        return np.concatenate(energies + [np.zeros(0)])
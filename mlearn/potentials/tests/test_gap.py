@@ -11,10 +11,12 @@ import numpy as np
 from pymatgen import Structure
 from monty.os.path import which
 from monty.serialization import loadfn
-from mlearn.potentials.gap import GAPotential
+from mlearn.data import Dataset
+from mlearn.potentials.gap import GAPotential, GAPCalculator
 
 CWD = os.getcwd()
 test_datapool = loadfn(os.path.join(os.path.dirname(__file__), 'datapool.json'))
+xml_file = os.path.join(os.path.dirname(__file__), 'GAP', 'gap.xml')
 
 
 class GAPotentialTest(unittest.TestCase):
@@ -62,6 +64,27 @@ class GAPotentialTest(unittest.TestCase):
             stress2 = data2['outputs']['virial_stress']
             np.testing.assert_array_almost_equal(stress1, stress2)
 
+        self.potential.write_cfgs('dataset.xyz', cfg_pool=Dataset.from_docs(self.test_pool))
+        with open('test.xyz') as f1, open('dataset.xyz') as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+    def test_read_predict_cfgs(self):
+        lines = ['libAtoms::Hello World: random seed = 1', 'AT 2',
+                 'AT dft_energy=-1.5 dft_virial={1 4 6 4 2 5 6 5 3} Lattice="3 0 0 0 3 0 0 0 3" '
+                 'Properties=species:S:1:pos:R:3:Z:I:1:dft_force:R:3:force:R:3 energy=-2.5 virial="0 0 0 0 0 0 0 0 0"',
+                 'AT Mo 0.0 0.0 0.0 42 0.1 0.2 0.3 0.4 0.5 0.6',
+                 'AT Mo 1.5 1.5 1.5 42 -0.1 -0.2 -0.3 -0.4 -0.5 -0.6']
+        with open('predict.xyz', 'w') as f:
+            f.write('\n'.join(lines))
+        frame = next(self.potential.iter_cfgs('predict.xyz', predict=True))
+        self.assertEqual(frame.energy, -2.5)
+        np.testing.assert_array_equal(frame.species, [42, 42])
+        np.testing.assert_array_almost_equal(frame.forces[1], [-0.4, -0.5, -0.6])
+        np.testing.assert_array_equal(frame.stress, [1, 2, 3, 4, 5, 6])
+        dataset = self.potential.read_dataset('predict.xyz')
+        np.testing.assert_array_almost_equal(dataset.forces[0], [0.1, 0.2, 0.3])
+        np.testing.assert_array_equal(dataset.positions[1], [1.5, 1.5, 1.5])
+
     @unittest.skipIf(not which('teach_sparse'), 'No QUIP cmd found.')
     def test_train(self):
         self.potential.train(train_structures=self.test_structures,
@@ -94,5 +117,42 @@ class GAPotentialTest(unittest.TestCase):
         self.assertEqual(len(stress), 6)
 
 
+class GAPCalculatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.potential = GAPotential.from_config(xml_file)
+        self.test_struct = test_datapool[-1]['structure']
+
+    def test_calculate(self):
+        calculator = GAPCalculator(self.potential)
+        energy, forces, stress = calculator.calculate([self.test_struct], lammps_frame=False)[0]
+        # reference values evaluated by quip with the same gap.xml
+        self.assertAlmostEqual(energy, 87.07202556952183, 8)
+        np.testing.assert_array_almost_equal(forces[:2], [[-1.8227139071, 0.5742673832, -3.4523409878],
+                                                          [-0.6155919275, 0.452710542, 1.5335194391]], 8)
+        np.testing.assert_array_almost_equal(stress, [172.77736932, 35.370027355, 158.25450726,
+                                                      -0.4639741934, 194.38147774, -0.18372282264], 6)
+        chunked = GAPCalculator(self.potential, max_size=10000)
+        _, chunked_forces, _ = chunked.calculate([self.test_struct], lammps_frame=False)[0]
+        np.testing.assert_array_almost_equal(chunked_forces, forces)
+
+        # forces against finite differences of the energy
+        delta = 1e-5
+        for i in range(3):
+            displaced = [self.test_struct.copy(), self.test_struct.copy()]
+            for sign, d in zip([1, -1], displaced):
+                d.translate_sites([1], sign * delta * np.eye(3)[i], frac_coords=False)
+            e1, e2 = [r[0] for r in calculator.calculate(displaced)]
+            self.assertAlmostEqual(forces[1][i], -(e1 - e2) / (2 * delta), 4)
+
+    def test_predict(self):
+        _, ref_forces, ref_stress = GAPCalculator(self.potential).calculate([self.test_struct])[0]
+        energy, forces, stress = self.potential.predict(self.test_struct, backend='numpy')
+        self.assertAlmostEqual(energy, 87.07202556952183, 8)
+        np.testing.assert_array_almost_equal(forces, ref_forces)
+        np.testing.assert_array_almost_equal(stress, ref_stress)
+        self.assertAlmostEqual(sum(stress[:3]), 172.77736932 + 35.370027355 + 158.25450726, 6)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -6,12 +6,14 @@ import os
 import unittest
 import tempfile
 import shutil
+import subprocess
 
 import numpy as np
 from monty.os.path import which
 from monty.serialization import loadfn
 from pymatgen import Structure
-from mlearn.potentials.mtp import MTPotential
+from mlearn.data import Dataset
+from mlearn.potentials.mtp import MTPotential, MTPCalculator
 
 CWD = os.getcwd()
 test_datapool = loadfn(os.path.join(os.path.dirname(__file__), 'datapool.json'))
@@ -60,6 +62,20 @@ class MTPotentialTest(unittest.TestCase):
             forces2 = data2['outputs']['forces']
             np.testing.assert_array_almost_equal(forces1, forces2)
 
+        dataset = self.potential.read_dataset('test.cfgs', symbol='Mo')
+        self.assertEqual(len(dataset), len(self.test_pool))
+        frame = next(self.potential.iter_cfgs('test.cfgs', symbol='Mo'))
+        np.testing.assert_array_equal(frame.positions, dataset[0].positions)
+        np.testing.assert_array_almost_equal(frame.stress, self.test_pool[0]['outputs']['virial_stress']
+                                             / np.array(1.898), decimal=5)
+        self.potential.write_cfg('dataset.cfgs', cfg_pool=Dataset.from_docs(self.test_pool))
+        with open('test.cfgs') as f1, open('dataset.cfgs') as f2:
+            self.assertEqual(f1.read(), f2.read())
+        self.assertEqual(self.potential._line_up(self.test_pool[0]['structure'], 0.0,
+                                                 np.zeros((len(self.test_pool[0]['structure']), 3)),
+                                                 np.zeros(6)).count('\n'),
+                         len(self.test_pool[0]['structure']) + 12)
+
     @unittest.skipIf(not which('mlp'), 'No MLIP cmd found.')
     def test_train(self):
         self.potential.train(train_structures=self.test_structures,
@@ -99,5 +115,75 @@ class MTPotentialTest(unittest.TestCase):
         self.assertIsNotNone(mtp.param)
 
 
+class MTPCalculatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.potential = MTPotential.from_config(config_file)
+        self.test_structures = [d['structure'] for d in test_datapool]
+        self.test_struct = self.test_structures[9]
+
+    def test_calculate(self):
+        calculator = MTPCalculator(self.potential)
+        energy, forces, stress = calculator.calculate([self.test_struct], lammps_frame=False)[0]
+        # reference values of fitted.mtp for test_datapool[9] evaluated by motep 0.2.0
+        # (https://github.com/imw-md/motep), a Python implementation of MLIP, with
+        # read_mtp(config_file), species [42] and make_calculator(mtp, engine='numpy')
+        # on the ase.Atoms of the structure, the stress being
+        # -atoms.get_stress() * 160.21766208 in the order xx, yy, zz, xy, xz, yz.
+        # test_mlp_calc_efs compares with MLIP itself when mlp is installed.
+        self.assertAlmostEqual(energy, -587.522875668488, 8)
+        np.testing.assert_array_almost_equal(forces[:2], [[-0.0814024636, 0.0716844934, -0.2792617366],
+                                                          [-0.1259558601, 0.0629296712, 0.1357303699]], 8)
+        np.testing.assert_array_almost_equal(stress, [33.320429389, 32.485379816, 32.890890141,
+                                                      6.2308489604e-04, 7.3570294425, -3.7557572212e-03], 6)
+        chunked = MTPCalculator(self.potential, max_size=5000)
+        chunked_energy, chunked_forces, _ = chunked.calculate([self.test_struct], lammps_frame=False)[0]
+        self.assertAlmostEqual(chunked_energy, energy)
+        np.testing.assert_array_almost_equal(chunked_forces, forces)
+
+        # forces against finite differences of the energy
+        delta = 1e-5
+        for i in range(3):
+            displaced = [self.test_struct.copy(), self.test_struct.copy()]
+            for sign, d in zip([1, -1], displaced):
+                d.translate_sites([1], sign * delta * np.eye(3)[i], frac_coords=False)
+            e1, e2 = [r[0] for r in calculator.calculate(displaced)]
+            self.assertAlmostEqual(forces[1][i], -(e1 - e2) / (2 * delta), 5)
+
+    @unittest.skipIf(not which('mlp'), 'No MLIP cmd found.')
+    def test_mlp_calc_efs(self):
+        test_dir = tempfile.mkdtemp()
+        input_file = os.path.join(test_dir, 'input.cfg')
+        output_file = os.path.join(test_dir, 'output.cfg')
+        self.potential.write_cfg(input_file, cfg_pool=test_datapool)
+        subprocess.check_call(['mlp', 'calc-efs', config_file, input_file, output_file])
+        # structures with the coordinates as written in the cfg file
+        inputs = self.potential.read_dataset(input_file, symbol='Mo')
+        outputs = self.potential.read_dataset(output_file, symbol='Mo')
+        results = MTPCalculator(self.potential).calculate(
+            [inputs.get_structure(i) for i in range(len(inputs))], lammps_frame=False)
+        for frame, (energy, forces, _) in zip(outputs, results):
+            self.assertAlmostEqual(frame.energy, energy, 5)
+            np.testing.assert_array_almost_equal(frame.forces, forces, 5)
+        shutil.rmtree(test_dir)
+
+    def test_predict(self):
+        _, ref_forces, ref_stress = MTPCalculator(self.potential).calculate([self.test_struct])[0]
+        energy, forces, stress = self.potential.predict(self.test_struct, backend='numpy')
+        self.assertAlmostEqual(energy, -587.522875668488, 8)
+        np.testing.assert_array_almost_equal(forces, ref_forces)
+        np.testing.assert_array_almost_equal(stress, ref_stress)
+
+    def test_evaluate(self):
+        energies = [d['outputs']['energy'] for d in test_datapool]
+        forces = [d['outputs']['forces'] for d in test_datapool]
+        df_orig, df_predict = self.potential.evaluate(test_structures=self.test_structures,
+                                                      ref_energies=energies, ref_forces=forces,
+                                                      backend='numpy')
+        self.assertEqual(df_orig.shape[0], df_predict.shape[0])
+        predicted = df_predict[df_predict['dtype'] == 'energy']['y_orig']
+        self.assertAlmostEqual(predicted.iloc[9], -587.522875668488, 8)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -6,12 +6,14 @@ import os
 import shutil
 import unittest
 import tempfile
+from unittest import mock
 
 import numpy as np
 from monty.os.path import which
+from monty.tempfile import ScratchDir
 from monty.serialization import loadfn
 from pymatgen import Structure
-from mlearn.potentials.nnp import NNPotential
+from mlearn.potentials.nnp import NNPotential, NNPCalculator
 
 CWD = os.getcwd()
 test_datapool = loadfn(os.path.join(os.path.dirname(__file__), 'datapool.json'))
@@ -112,6 +114,104 @@ class NNPitentialTest(unittest.TestCase):
         nnp = NNPotential.from_config(input_file, scaling_file, weights_file)
         self.assertTrue(nnp.fitted)
 
+    def test_load_weights_scaler(self):
+        self.potential.load_weights(weights_file)
+        self.potential.load_scaler(scaling_file)
+        self.assertEqual([w.shape for w in self.potential.weights], [(21, 8), (8, 8), (8, 1)])
+        self.assertEqual([len(b) for b in self.potential.bs], [8, 8, 1])
+        self.assertEqual(self.potential.weights[0][0][1], float('-2.0039629452873123E-01'))
+        self.assertEqual(len(self.potential.scaling_param), 21)
+        self.assertEqual(self.potential.scaling_param['sf_max'][0],
+                         float('1.5124915389912526E-05'))
+
+    def test_write_param(self):
+        nnp = NNPotential.from_config(input_file, scaling_file, weights_file)
+        with ScratchDir('.'):
+            nnp.write_param()
+            for filename, ref_filename in [('weights.042.data', weights_file),
+                                           ('scaling.data', scaling_file)]:
+                with open(filename) as f1, open(ref_filename) as f2:
+                    self.assertEqual(f1.read().split('\n'), f2.read().rstrip('\n').split('\n'))
+
+    def test_predict_native(self):
+        nnp = NNPotential.from_config(input_file, scaling_file, weights_file)
+        struct = self.test_struct.copy()
+        struct.perturb(0.1)
+        energy, forces, stress = nnp.predict(struct, backend='numpy')
+        self.assertEqual(forces.shape, (len(struct), 3))
+        self.assertEqual(len(stress), 6)
+        calculator = NNPCalculator(nnp)
+        _, forces, _ = calculator.calculate([struct], lammps_frame=False)[0]
+        delta = 1e-5
+        for i in range(3):
+            displaced = [struct.copy(), struct.copy()]
+            for sign, s in zip([1, -1], displaced):
+                s.translate_sites([0], sign * delta * np.eye(3)[i], frac_coords=False)
+            (e1, _, _), (e2, _, _) = calculator.calculate(displaced, lammps_frame=False)
+            self.assertAlmostEqual(forces[0][i], -(e1 - e2) / (2 * delta), 4)
+
+        df_orig, df_tar = nnp.evaluate(test_structures=self.test_structures,
+                                       ref_energies=self.test_energies,
+                                       ref_forces=self.test_forces,
+                                       ref_stresses=self.test_stresses,
+                                       backend='numpy')
+        self.assertEqual(df_orig.shape[0], df_tar.shape[0])
+        self.assertAlmostEqual(df_tar['y_orig'][df_tar['dtype'] == 'energy'].iloc[-1],
+                               nnp.predict(self.test_struct, backend='numpy')[0], 6)
+
+    def test_evaluate_dataset(self):
+        nnp = NNPotential.from_config(input_file, scaling_file, weights_file)
+        structures = [self.test_structures[0].copy(), self.test_structures[1] * [1, 1, 2],
+                      self.test_structures[2].copy()]
+        structures[0].remove_sites([0, 1])
+        ref_energies = [-500.0, -1000.0, -520.0]
+        ref_forces = [np.zeros((len(s), 3)).tolist() for s in structures]
+        ref_stresses = [np.zeros(6).tolist()] * len(structures)
+        energies = [-510.5, -1021.25, -530.75]
+        forces = [np.random.uniform(-1, 1, (len(s), 3)) for s in structures]
+
+        def output_block(structure, energy, force):
+            # output.data as written by n2p2 Structure::writeToFile
+            lines = ['begin', 'comment predicted by nnp-dataset']
+            lines += ['lattice %24.16E %24.16E %24.16E' % tuple(v / nnp.bohr_to_angstrom)
+                      for v in structure.lattice.matrix]
+            for site, f in zip(structure, force * nnp.eV_to_Ha * nnp.bohr_to_angstrom):
+                lines.append('atom %24.16E %24.16E %24.16E %2s %24.16E %24.16E %24.16E %24.16E %24.16E'
+                             % (tuple(site.coords / nnp.bohr_to_angstrom) + (site.specie.symbol, 0, 0)
+                                + tuple(f)))
+            lines += ['energy %24.16E' % (energy * nnp.eV_to_Ha), 'charge %24.16E' % 0, 'end']
+            return '\n'.join(lines) + '\n'
+
+        calls = []
+
+        def run_predictor(cmd):
+            calls.append(cmd)
+            with open('input.data') as f:
+                n_structures = f.read().count('begin')
+            # all structures in one nnp-dataset run, one structure per nnp-predict run
+            indices = range(len(structures)) if cmd[0] == 'nnp-dataset' else [len(calls) - 1]
+            self.assertEqual(n_structures, len(indices))
+            with open('output.data', 'w') as f:
+                f.write(''.join(output_block(structures[i], energies[i], forces[i]) for i in indices))
+
+        for predictor, expected_calls in [('nnp-dataset', [['nnp-dataset', '0']]),
+                                          ('nnp-predict', [['nnp-predict', 'input.nn']] * 3)]:
+            calls[:] = []
+            with mock.patch('mlearn.potentials.nnp.which', lambda cmd: cmd if cmd == predictor else None), \
+                    mock.patch.object(NNPotential, '_run_predictor', staticmethod(run_predictor)):
+                df_orig, df_predict = nnp.evaluate(test_structures=structures, ref_energies=ref_energies,
+                                                   ref_forces=ref_forces, ref_stresses=ref_stresses)
+            self.assertEqual(calls, expected_calls)
+            self.assertEqual(df_orig.shape[0], df_predict.shape[0])
+            np.testing.assert_array_equal(df_orig['dtype'], df_predict['dtype'])
+            np.testing.assert_array_equal(df_orig['n'], df_predict['n'])
+            np.testing.assert_array_almost_equal(df_orig['y_orig'][df_orig['dtype'] == 'energy'],
+                                                 ref_energies, 4)
+            np.testing.assert_array_almost_equal(df_predict['y_orig'][df_predict['dtype'] == 'energy'],
+                                                 energies, 4)
+            np.testing.assert_array_almost_equal(df_predict['y_orig'][df_predict['dtype'] == 'force'],
+                                                 np.concatenate(forces).ravel(), 6)
+
 
 if __name__ == '__main__':
     unittest.main()
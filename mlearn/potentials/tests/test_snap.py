@@ -10,9 +10,11 @@ import shutil
 import unittest
 import tempfile
 
+import numpy as np
 from monty.os.path import which
 from monty.serialization import loadfn
-from mlearn.potentials.snap import SNAPotential
+from pymatgen import Element
+from mlearn.potentials.snap import SNAPotential, SNAPCalculator
 from mlearn.models import LinearModel
 from mlearn.describers import BispectrumCoefficients
 
@@ -119,5 +121,60 @@ class SNAPotentialTest(unittest.TestCase):
         self.assertTrue(getattr(snap.model.model, 'coef_') is not None)
 
 
+class SNAPCalculatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.linear = SNAPotential.from_config(param_file, coeff_file)
+        profile = {'Mo': {'r': 0.5, 'w': 1.}}
+        describer = BispectrumCoefficients(rcutfac=5.0, twojmax=4, element_profile=profile,
+                                           quadratic=True, pot_fit=True, backend='numpy')
+        model = LinearModel(describer=describer)
+        model.model.coef_ = np.random.RandomState(0).uniform(-1e-3, 1e-3, 1 + 14 + 105)
+        model.model.intercept_ = 0
+        self.quadratic = SNAPotential(model=model, name='test')
+        self.test_structures = [d['structure'].copy() for d in test_datapool[:3]]
+        for s in self.test_structures:
+            s.perturb(0.05)
+
+    def test_calculate(self):
+        for potential in [self.linear, self.quadratic]:
+            calculator = SNAPCalculator(potential)
+            results = calculator.calculate(self.test_structures, batch_size=2)
+            energies = calculator.calculate_energies(iter(self.test_structures))
+            np.testing.assert_array_almost_equal(energies, [r[0] for r in results])
+            sna = calculator.sna
+            coef = potential.model.coef
+            for s, (energy, forces, stress) in zip(self.test_structures, results):
+                b = sna.calculate([s])[0][0]
+                self.assertAlmostEqual(energy, len(s) * coef[0] + np.dot(b.sum(axis=0), coef[1:]), 6)
+                self.assertEqual(forces.shape, (len(s), 3))
+                self.assertEqual(len(stress), 6)
+
+            # forces against finite differences of the energy
+            s = self.test_structures[0]
+            _, forces, _ = calculator.calculate([s])[0]
+            delta = 1e-5
+            for i in range(3):
+                displaced = [s.copy(), s.copy()]
+                for sign, d in zip([1, -1], displaced):
+                    d.translate_sites([1], sign * delta * np.eye(3)[i], frac_coords=False)
+                e1, e2 = calculator.calculate_energies(displaced)
+                self.assertAlmostEqual(forces[1][i], -(e1 - e2) / (2 * delta), 4)
+
+    @unittest.skipIf(not which('lmp_serial'), 'No LAMMPS cmd found.')
+    def test_predict(self):
+        test_dir = tempfile.mkdtemp()
+        os.chdir(test_dir)
+        for potential in [self.linear, self.quadratic]:
+            potential.specie = Element('Mo')
+            energy, forces, stress = potential.predict(self.test_structures[0], backend='numpy')
+            ref_energy, ref_forces, ref_stress = potential.predict(self.test_structures[0])
+            np.testing.assert_allclose(energy, ref_energy, rtol=1e-6)
+            np.testing.assert_allclose(forces, ref_forces, rtol=1e-4, atol=1e-3)
+            np.testing.assert_allclose(stress, ref_stress, rtol=1e-4, atol=1e-3)
+        os.chdir(CWD)
+        shutil.rmtree(test_dir)
+
+
 if __name__ == '__main__':
     unittest.main()
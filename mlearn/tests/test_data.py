@@ -3,13 +3,14 @@
 # Distributed under the terms of the BSD License.
 
 import os
+import json
 import shutil
 import tempfile
 
 import unittest
 import numpy as np
 from monty.serialization import loadfn
-from mlearn.data import pool_from, convert_docs
+from mlearn.data import pool_from, convert_docs, Dataset, iter_docs, iter_datasets
 
 CWD = os.getcwd()
 test_datapool = loadfn(os.path.join(os.path.dirname(__file__), 'datapool.json'))
@@ -67,6 +68,119 @@ class PorcessingTest(unittest.TestCase):
         for stress1, stress2 in zip(test_stresses, np.array(self.test_stresses).ravel()):
             self.assertEqual(stress1, stress2)
 
+        structures, df2 = convert_docs(self.test_pool, include_stress=True,
+                                       return_structures=False)
+        self.assertIsNone(structures)
+        self.assertTrue(df.equals(df2))
+        _, df3 = convert_docs(Dataset.from_docs(self.test_pool),
+                              include_stress=True, return_structures=False)
+        self.assertTrue(df.equals(df3))
+        self.assertEqual(df['n'].sum(), sum(len(s) for s in self.test_structures)
+                         * 4 + len(self.test_structures) * 6)
+
+
+class DatasetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.test_pool = test_datapool
+        self.structures = [d['structure'] for d in self.test_pool]
+        self.dataset = Dataset.from_docs(self.test_pool)
+
+    def test_from_docs(self):
+        self.assertEqual(len(self.dataset), len(self.test_pool))
+        docs = [dict(d, structure=d['structure'].as_dict()) for d in self.test_pool]
+        dataset = Dataset.from_docs(docs)
+        for d, frame in zip(self.test_pool, dataset):
+            np.testing.assert_array_almost_equal(frame.positions, d['structure'].cart_coords)
+            np.testing.assert_array_equal(frame.species, d['structure'].atomic_numbers)
+            self.assertEqual(frame.energy, d['outputs']['energy'])
+            np.testing.assert_array_equal(frame.forces, d['outputs']['forces'])
+            np.testing.assert_array_equal(frame.stress, d['outputs']['virial_stress'])
+        np.testing.assert_array_equal(dataset.num_atoms, [d['num_atoms'] for d in self.test_pool])
+
+    def test_from_structures(self):
+        dataset = Dataset.from_structures(self.structures,
+                                          [d['outputs']['energy'] for d in self.test_pool],
+                                          [d['outputs']['forces'] for d in self.test_pool],
+                                          [d['outputs']['virial_stress'] for d in self.test_pool])
+        for name in ['lattices', 'species', 'positions', 'offsets', 'energies',
+                     'forces', 'stresses']:
+            np.testing.assert_array_almost_equal(getattr(dataset, name),
+                                                 getattr(self.dataset, name))
+        dataset = Dataset.from_structures(self.structures)
+        self.assertFalse(np.any(dataset.forces))
+        self.assertEqual(dataset.forces.shape, (sum(len(s) for s in self.structures), 3))
+
+    def test_slicing(self):
+        frame = self.dataset[2]
+        self.assertTrue(np.shares_memory(frame.positions, self.dataset.positions))
+        subset = self.dataset[1:4]
+        self.assertEqual(len(subset), 3)
+        self.assertTrue(np.shares_memory(subset.forces, self.dataset.forces))
+        np.testing.assert_array_equal(subset[1].forces, frame.forces)
+        taken = self.dataset.take([4, 2])
+        np.testing.assert_array_equal(taken[1].positions, frame.positions)
+        np.testing.assert_array_equal(self.dataset[::2][1].species, frame.species)
+        self.assertEqual(self.dataset.get_structure(2), self.structures[2])
+        self.assertRaises(IndexError, self.dataset.__getitem__, len(self.dataset))
+
+    def test_to_docs(self):
+        docs = self.dataset.to_docs()
+        _, df1 = convert_docs(docs, include_stress=True)
+        _, df2 = convert_docs(self.test_pool, include_stress=True)
+        self.assertTrue(df1.equals(df2))
+        dataset = Dataset.from_dict(self.dataset.as_dict())
+        np.testing.assert_array_equal(dataset.positions, self.dataset.positions)
+
+    def test_to_file(self):
+        test_dir = tempfile.mkdtemp()
+        filename = os.path.join(test_dir, 'dataset.npz')
+        self.dataset.to_file(filename)
+        for mmap in [True, False]:
+            dataset = Dataset.from_file(filename, mmap=mmap)
+            for name in ['lattices', 'species', 'positions', 'offsets', 'energies',
+                         'forces', 'stresses']:
+                np.testing.assert_array_equal(getattr(dataset, name),
+                                              getattr(self.dataset, name))
+        self.assertEqual(dataset[1:3].get_structure(1), self.structures[2])
+        # file name without the npz extension
+        filename = os.path.join(test_dir, 'train')
+        self.dataset[:2].to_file(filename)
+        self.assertFalse(os.path.exists(filename + '.npz'))
+        for mmap in [True, False]:
+            dataset = Dataset.from_file(filename, mmap=mmap)
+            np.testing.assert_array_equal(dataset.forces, self.dataset[:2].forces)
+            self.assertEqual(dataset.get_structure(1), self.structures[1])
+        self.dataset[:0].to_file(filename)
+        self.assertEqual(len(Dataset.from_file(filename)), 0)
+        shutil.rmtree(test_dir)
+
+
+class IterDocsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.docs = json.loads(json.dumps(Dataset.from_docs(test_datapool).to_docs()))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_iter_docs(self):
+        array_file = os.path.join(self.test_dir, 'training.json')
+        with open(array_file, 'w') as f:
+            json.dump(self.docs, f, indent=1)
+        lines_file = os.path.join(self.test_dir, 'training.jsonl')
+        with open(lines_file, 'w') as f:
+            f.write('\n'.join(json.dumps(d) for d in self.docs))
+        for filename in [array_file, lines_file]:
+            self.assertEqual(list(iter_docs(filename, chunk_size=100)), self.docs)
+
+        datasets = list(iter_datasets(array_file, batch_size=2))
+        self.assertEqual([len(d) for d in datasets], [2] * (len(self.docs) // 2)
+                         + [len(self.docs) % 2] * (len(self.docs) % 2))
+        np.testing.assert_array_equal(np.concatenate([d.positions for d in datasets]),
+                                      Dataset.from_docs(self.docs).positions)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -2,12 +2,16 @@
 # Copyright (c) Materials Virtual Lab
 # Distributed under the terms of the BSD License.
 
+import os
+import shutil
+import tempfile
 import unittest
 import numpy as np
 from monty.os.path import which
 from pymatgen import Lattice, Structure
 
-from mlearn.describers import BispectrumCoefficients
+from mlearn.describers import BispectrumCoefficients, NativeSpectralNeighborAnalysis, \
+    FeatureCache, get_bs_index
 
 
 class BispectrumCoefficientsTest(unittest.TestCase):
@@ -43,6 +47,18 @@ class BispectrumCoefficientsTest(unittest.TestCase):
                                             diagonalstyle=d)
                 np.testing.assert_equal(bc.subscripts, from_lmp_doc(tjm, d))
 
+    def test_bs_index(self):
+        index = get_bs_index(3, 3, True)
+        self.assertIs(index, get_bs_index(3, 3, True))
+        n_bs = len(index.subscripts)
+        self.assertEqual(len(index.columns), n_bs * (n_bs + 3) // 2)
+        self.assertEqual(index.columns[0], '0-0-0')
+        self.assertEqual(index.columns[n_bs], '000-000')
+        np.testing.assert_array_equal(index.quadratic_pairs[:2], [[0, 0], [0, 1]])
+        self.assertEqual(get_bs_index(3, 3).columns.tolist(),
+                         index.columns[:n_bs].tolist())
+        self.assertRaises(ValueError, index.subscripts.__setitem__, 0, 1)
+
     @unittest.skipIf(not which("lmp_serial"), "No LAMMPS cmd found")
     def test_describe(self):
         s = Structure.from_spacegroup(225, Lattice.cubic(5.69169),
@@ -80,6 +96,163 @@ class BispectrumCoefficientsTest(unittest.TestCase):
                 np.testing.assert_array_equal(df_s[specie, 'n'][1:],
                                               np.zeros(len(s) * 3 + 6))
 
+    def test_describe_numpy(self):
+        s = Structure.from_spacegroup(225, Lattice.cubic(5.69169),
+                                      ['Na', 'Cl'],
+                                      [[0, 0, 0], [0, 0, 0.5]])
+        profile = dict(Na=dict(r=0.3, w=0.9),
+                       Cl=dict(r=0.7, w=3.0))
+        s.remove_sites([0, 5])
+        bc_atom = BispectrumCoefficients(5, 3, profile, diagonalstyle=2,
+                                         pot_fit=False, backend='numpy')
+        self.assertIsInstance(bc_atom.calculator, NativeSpectralNeighborAnalysis)
+        df_atom = bc_atom.describe(s)
+        self.assertEqual(df_atom.shape, (len(s), 4))
+        bc_pot = BispectrumCoefficients(5, 3, profile, diagonalstyle=2,
+                                        pot_fit=True, backend='numpy')
+        df_pot = bc_pot.describe(s, include_stress=True)
+        self.assertEqual(df_pot.shape, (1 + len(s) * 3 + 6, 10))
+        for specie in ['Na', 'Cl']:
+            self.assertAlmostEqual(df_pot.iloc[0][specie, 'n'],
+                                   s.composition.fractional_composition[specie])
+
+        x, row_index = bc_pot.describe_all([s, s], include_stress=True, raw=True)
+        self.assertEqual(x.shape, (2 * df_pot.shape[0], df_pot.shape[1]))
+        np.testing.assert_array_equal(row_index, np.repeat([0, 1], df_pot.shape[0]))
+        np.testing.assert_array_equal(x[row_index == 1], df_pot.values)
+        x, row_index = bc_atom.describe_all([s], raw=True)
+        np.testing.assert_array_equal(x, df_atom.values)
+
+        structures = [s, s.copy(), s]
+        df = bc_pot.describe_all(structures, include_stress=True)
+        df_gen = bc_pot.describe_all((t for t in structures), include_stress=True,
+                                     batch_size=2)
+        self.assertTrue(df.equals(df_gen))
+        self.assertEqual(bc_atom.describe_all(iter([])).shape, (0, 4))
+
+    @unittest.skipIf(not which("lmp_serial"), "No LAMMPS cmd found")
+    def test_numpy_vs_lammps(self):
+        s = Structure(Lattice.from_parameters(3.2, 3.4, 3.6, 80, 95, 105),
+                      ['Na', 'Cl', 'Na'],
+                      [[0, 0, 0], [0.4, 0.5, 0.55], [0.7, 0.2, 0.9]])
+        profile = dict(Na=dict(r=0.3, w=0.9),
+                       Cl=dict(r=0.7, w=3.0))
+        for quadratic in [False, True]:
+            bc = BispectrumCoefficients(5, 4, profile, quadratic=quadratic)
+            bc_numpy = BispectrumCoefficients(5, 4, profile, quadratic=quadratic,
+                                              backend='numpy')
+            outputs = bc.calculator.calculate([s])[0]
+            outputs_numpy = bc_numpy.calculator.calculate([s])[0]
+            for x, y in zip(outputs[:3], outputs_numpy[:3]):
+                np.testing.assert_allclose(y, x, rtol=1e-4, atol=1e-4 * np.abs(x).max())
+            np.testing.assert_array_equal(outputs[3], outputs_numpy[3])
+
+
+class NativeSpectralNeighborAnalysisTest(unittest.TestCase):
+
+    def test_derivatives(self):
+        s = Structure(Lattice.cubic(3.3), ['Mo', 'Mo', 'Ni'],
+                      [[0, 0, 0], [0.45, 0.55, 0.5], [0.1, 0.6, 0.2]])
+        profile = dict(Mo=dict(r=0.5, w=1.0), Ni=dict(r=0.4, w=0.6))
+        sna = NativeSpectralNeighborAnalysis(4.5, 4, profile, quadratic=True)
+        b, db, vb, e = sna.calculate([s])[0]
+        self.assertEqual(b.shape, (3, sna.n_bs * (sna.n_bs + 3) // 2))
+        self.assertEqual(db.shape, (3, 3 * b.shape[1] * 2))
+        self.assertEqual(vb.shape, (3, 6 * b.shape[1] * 2))
+        np.testing.assert_array_equal(e, ['Mo', 'Mo', 'Ni'])
+
+        types = np.array([sna.elements.index(el) for el in e])
+        db = db.reshape(3, 2, 3, -1)
+        delta = 1e-5
+        for i in range(len(s)):
+            for d in range(3):
+                bs = []
+                for sign in [1, -1]:
+                    moved = s.copy()
+                    vector = np.zeros(3)
+                    vector[d] = sign * delta
+                    moved.translate_sites([i], vector, frac_coords=False)
+                    bs.append(sna.calculate([moved])[0][0])
+                numerical = (bs[0] - bs[1]) / (2 * delta)
+                for t in range(2):
+                    np.testing.assert_allclose(-db[i, t, d],
+                                               numerical[types == t].sum(axis=0),
+                                               rtol=1e-5, atol=1e-5)
+        # total virial is the lattice strain derivative
+        vb = vb.reshape(3, 2, 6, -1).sum(axis=0)
+        bs = []
+        for sign in [1, -1]:
+            strained = s.copy()
+            strained.apply_strain([sign * delta, 0, 0])
+            bs.append(sna.calculate([strained])[0][0])
+        numerical = (bs[0] - bs[1]) / (2 * delta)
+        for t in range(2):
+            np.testing.assert_allclose(-vb[t, 0], numerical[types == t].sum(axis=0),
+                                       rtol=1e-4, atol=1e-4)
+
+
+class FeatureCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_describe_all(self):
+        s = Structure.from_spacegroup(225, Lattice.cubic(5.69169),
+                                      ['Na', 'Cl'],
+                                      [[0, 0, 0], [0, 0, 0.5]])
+        structures = [s, s.copy(), s * [1, 1, 2]]
+        profile = dict(Na=dict(r=0.3, w=0.9),
+                       Cl=dict(r=0.7, w=3.0))
+        bc = BispectrumCoefficients(5, 3, profile, pot_fit=True,
+                                    backend='numpy', cache_dir=self.cache_dir)
+        df = bc.describe_all(structures, include_stress=True)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+        class CountingCalculator(object):
+
+            def __init__(self, calculator):
+                self.calculator = calculator
+                self.structures = []
+
+            def calculate(self, structures):
+                self.structures.extend(structures)
+                return self.calculator.calculate(structures)
+
+        calculator = CountingCalculator(bc.calculator)
+        bc.calculator = calculator
+        self.assertTrue(bc.describe_all(structures, include_stress=True).equals(df))
+        self.assertEqual(len(calculator.structures), 0)
+        bc.describe_all([s * [2, 1, 1]])
+        self.assertEqual(len(calculator.structures), 1)
+
+        # LAMMPS backends list the sites in sorted order, unlike the native
+        # one, so the entries written by one backend are not read by another
+        unsorted = Structure(Lattice.cubic(4.0), ['Cl', 'Na'], [[0, 0, 0], [0.5, 0.5, 0.5]])
+        bc.describe_all([unsorted])
+        for backend in ['subprocess', 'library']:
+            bc_lammps = BispectrumCoefficients(5, 3, profile, pot_fit=True, backend=backend,
+                                               cache_dir=self.cache_dir)
+            bc_lammps.calculator = CountingCalculator(bc.calculator.calculator)
+            bc_lammps.describe_all(structures + [unsorted], include_stress=True)
+            self.assertEqual(len(bc_lammps.calculator.structures), len(structures) + 1)
+
+    def test_evict(self):
+        cache = FeatureCache(self.cache_dir, max_size=2000)
+        for i in range(5):
+            cache.put('k%d' % i, (np.zeros(100), np.array(['Mo'])))
+            os.utime(os.path.join(self.cache_dir, 'k%d.npz' % i), (i, i))
+        self.assertEqual(cache.get('k0')[1].tolist(), ['Mo'])
+        cache.evict()
+        files = sorted(os.listdir(self.cache_dir))
+        self.assertIn('k0.npz', files)
+        self.assertNotIn('k1.npz', files)
+        self.assertLessEqual(sum(os.path.getsize(os.path.join(self.cache_dir, f))
+                                 for f in files), 2000)
+        self.assertIsNone(cache.get('missing'))
+
 
 if __name__ == "__main__":
     unittest.main()
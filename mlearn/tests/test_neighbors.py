@@ -0,0 +1,83 @@
+# coding: utf-8
+# Copyright (c) Materials Virtual Lab
+# Distributed under the terms of the BSD License.
+
+import itertools
+import unittest
+
+import numpy as np
+from mlearn.neighbors import find_neighbors, NeighborList
+
+
+def brute_force(cart_coords, lattice_matrix, cutoff):
+    n_max = np.floor(cutoff * np.linalg.norm(np.linalg.inv(lattice_matrix), axis=0)).astype(int) + 4
+    pairs = set()
+    for image in itertools.product(*[range(-n, n + 1) for n in n_max]):
+        diff = cart_coords[None, :, :] + np.dot(image, lattice_matrix) - cart_coords[:, None, :]
+        dist_sq = np.sum(diff ** 2, axis=-1)
+        for i, j in zip(*np.nonzero((dist_sq < cutoff ** 2) & (dist_sq > 1e-20))):
+            pairs.add((i, j) + image)
+    return pairs
+
+
+class FindNeighborsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+        self.cells = [(np.diag([3.1, 3.2, 3.3]), 2, 5.0),
+                      (np.array([[4.1, 0, 0], [3.5, 3.2, 0], [-3.1, 2.5, 5.3]]), 7, 4.0),
+                      (np.array([[2.5, 0, 0], [0, 30.5, 0], [1.3, 0, 8.2]]), 9, 6.0),
+                      (np.diag([20.3, 18.1, 25.7]), 60, 3.0)]
+
+    def test_find_neighbors(self):
+        for lattice_matrix, n_sites, cutoff in self.cells:
+            # sites are not required to be inside the cell
+            coords = np.dot(self.rng.rand(n_sites, 3) * 3 - 1, lattice_matrix)
+            pairs = find_neighbors(coords, lattice_matrix, cutoff, max_size=500)
+            self.assertEqual(set((i, j) + tuple(image) for i, j, image
+                                 in zip(pairs.centers, pairs.neighbors, pairs.images)),
+                             brute_force(coords, lattice_matrix, cutoff))
+            np.testing.assert_array_almost_equal(pairs.vectors, coords[pairs.neighbors]
+                                                 + np.dot(pairs.images, lattice_matrix)
+                                                 - coords[pairs.centers])
+            self.assertTrue(np.all(np.diff(pairs.centers) >= 0))
+            np.testing.assert_array_equal(pairs.offsets, np.searchsorted(pairs.centers,
+                                                                         np.arange(n_sites + 1)))
+
+        empty = find_neighbors(np.zeros((1, 3)), np.eye(3) * 10, 3.0)
+        self.assertEqual(len(empty.centers), 0)
+        np.testing.assert_array_equal(empty.offsets, [0, 0])
+
+    def test_within(self):
+        lattice_matrix, n_sites, _ = self.cells[1]
+        coords = np.dot(self.rng.rand(n_sites, 3), lattice_matrix)
+        pairs = find_neighbors(coords, lattice_matrix, 6.0).within(3.5)
+        ref = find_neighbors(coords, lattice_matrix, 3.5)
+        for name in ['centers', 'neighbors', 'images', 'vectors', 'offsets']:
+            np.testing.assert_array_equal(getattr(pairs, name), getattr(ref, name))
+        self.assertTrue(np.all(pairs.distances < 3.5))
+
+
+class NeighborListTest(unittest.TestCase):
+
+    def test_update(self):
+        rng = np.random.RandomState(0)
+        lattice_matrix = np.array([[12.0, 0, 0], [2.0, 11.0, 0], [1.0, -1.5, 10.0]])
+        coords = np.dot(rng.rand(100, 3), lattice_matrix)
+        neighbor_list = NeighborList(cutoff=4.0, skin=0.6)
+        for step in range(6):
+            pairs = neighbor_list.update(coords, lattice_matrix)
+            ref = find_neighbors(coords, lattice_matrix, 4.0)
+            np.testing.assert_array_equal(pairs.centers, ref.centers)
+            np.testing.assert_array_equal(pairs.neighbors, ref.neighbors)
+            np.testing.assert_array_almost_equal(pairs.vectors, ref.vectors)
+            coords = coords + rng.randn(*coords.shape) * 0.05
+        self.assertLess(neighbor_list.n_builds, 6)
+
+        n_builds = neighbor_list.n_builds
+        neighbor_list.update(coords, lattice_matrix * 1.01)
+        self.assertEqual(neighbor_list.n_builds, n_builds + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()